@@ -0,0 +1,109 @@
+"""Compares per-token decode latency with and without the accelerated mode on CPU.
+
+The eager mode is the default attention with no compilation or bucketing. The
+accelerated mode loads the model with SDPA attention, compiles the forward
+pass and pads prompts to buckets, warmed up before timing as at startup.
+Prompts of several lengths are decoded through `generate_batch`, with every
+token timestamped by a streamer.
+
+    python3 -m bench.accelerated --new-tokens 64 --threads 4
+    python3 -m bench.accelerated --model EleutherAI/pythia-160m --buckets 32,64,128,256
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+
+from lib import chatbot, loader
+from bench.tiny_model import build_tiny_model
+
+PROMPT = 'Below is an instruction that describes a task, paired with an input that provides further context. '
+
+
+def prompts_for(tokenizer, lengths):
+    ids = tokenizer.encode(PROMPT * 64)
+    return [ids[:length] for length in lengths]
+
+
+def decode(tokenizer, model, prompts, new_tokens: int, repeats: int) -> dict:
+    prefill, per_token, texts = [], [], []
+    for _ in range(repeats):
+        for ids in prompts:
+            stamps = []
+            started_at = time.monotonic()
+            generation = chatbot.generate_batch(
+                tokenizer, model, [''], [new_tokens], [-1],
+                streamers=[lambda token: stamps.append(time.monotonic())],
+                prompt_ids=[ids],
+            )[0]
+            prefill.append(stamps[0] - started_at)
+            per_token.extend(b - a for a, b in zip(stamps, stamps[1:]))
+            texts.append(generation.text)
+    return {
+        'prefill_ms': statistics.mean(prefill) * 1000,
+        'per_token_ms': statistics.mean(per_token) * 1000,
+        'per_token_p95_ms': sorted(per_token)[int(len(per_token) * 0.95)] * 1000,
+        'texts': texts,
+    }
+
+
+def run_mode(model_name: str, args, accelerated: bool) -> dict:
+    tokenizer = chatbot.load_tokenizer(model_name, args.cache_dir)
+    model = chatbot.load_model(
+        model_name, args.cache_dir, cpu_dtype=args.cpu_dtype,
+        attn_implementation='sdpa' if accelerated else '',
+    )
+    buckets = [int(bucket) for bucket in args.buckets.split(',')] if accelerated else []
+    chatbot.optimize(model, compile_decode=accelerated, prompt_buckets=buckets)
+
+    started_at = time.monotonic()
+    loader.warmup(tokenizer, model, warmup_tokens=4)
+    warmup = time.monotonic() - started_at
+
+    lengths = [int(length) for length in args.prompt_lengths.split(',')]
+    result = decode(tokenizer, model, prompts_for(tokenizer, lengths), args.new_tokens, args.repeats)
+    result['warmup_s'] = warmup
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='', help='model name or path, a tiny random model is built if empty')
+    parser.add_argument('--cache-dir', default='.cache')
+    parser.add_argument('--cpu-dtype', default='float32')
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--new-tokens', type=int, default=64)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--prompt-lengths', default='17,40,90,150,230', help='prompt lengths in tokens')
+    parser.add_argument('--buckets', default='32,64,128,256', help='prompt buckets of the accelerated mode')
+    args = parser.parse_args()
+
+    chatbot.configure_cpu(args.threads, 1)
+    workdir = tempfile.mkdtemp()
+    try:
+        model_name = args.model or build_tiny_model(os.path.join(workdir, 'tiny'), hidden_size=256, num_layers=6)
+        eager = run_mode(model_name, args, accelerated=False)
+        accelerated = run_mode(model_name, args, accelerated=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    identical = eager.pop('texts') == accelerated.pop('texts')
+    report = {
+        'model': args.model or 'tiny',
+        'new_tokens': args.new_tokens,
+        'prompt_lengths': args.prompt_lengths,
+        'buckets': args.buckets,
+        'eager': eager,
+        'accelerated': accelerated,
+        'per_token_speedup': eager['per_token_ms'] / accelerated['per_token_ms'] if accelerated['per_token_ms'] else 0.0,
+        # padding to a bucket may change the last bits of the logits, so greedy outputs can differ
+        'identical': identical,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
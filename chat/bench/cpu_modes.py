@@ -0,0 +1,81 @@
+"""Compares tokens/sec and memory of the CPU inference modes.
+
+Every mode runs in its own process so that peak memory is not shared.
+
+    python3 -m bench.cpu_modes --model .cache/tiny --new-tokens 64 --threads 4
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+from bench.tiny_model import build_tiny_model
+
+MODES = {
+    'float32': {'cpu_dtype': 'float32', 'cpu_quantize': False},
+    'bfloat16': {'cpu_dtype': 'bfloat16', 'cpu_quantize': False},
+    'float16': {'cpu_dtype': 'float16', 'cpu_quantize': False},
+    'int8-dynamic': {'cpu_dtype': 'float32', 'cpu_quantize': True},
+}
+
+PROMPT = 'Below is an instruction that describes a task. Could you list AWS Services related to AI/ML?'
+
+
+def run_mode(model_name: str, cache_dir: str, mode: dict, threads: int, new_tokens: int, repeats: int, results):
+    from lib import chatbot
+
+    chatbot.configure_cpu(threads, 1)
+    started_at = time.monotonic()
+    tokenizer, model = chatbot.setup_model(model_name, cache_dir, **mode)
+    load_time = time.monotonic() - started_at
+
+    chatbot.generate(tokenizer, model, PROMPT, max_new_tokens=4)
+    tokens, elapsed = 0, 0.0
+    for _ in range(repeats):
+        started_at = time.monotonic()
+        generation = chatbot.generate(tokenizer, model, PROMPT, max_new_tokens=new_tokens)
+        elapsed += time.monotonic() - started_at
+        tokens += generation.tokens
+
+    results.put({
+        'load_time': load_time,
+        'tokens_per_sec': tokens / elapsed if elapsed else 0.0,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='', help='model name or path, a tiny random model is built if empty')
+    parser.add_argument('--cache-dir', default='.cache')
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--new-tokens', type=int, default=64)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    model_name = args.model or build_tiny_model(os.path.join(workdir, 'tiny'), hidden_size=256, num_layers=4)
+    ctx = multiprocessing.get_context('spawn')
+    report = {'model': model_name, 'threads': args.threads, 'modes': {}}
+    try:
+        for name in args.modes.split(','):
+            results = ctx.Queue()
+            process = ctx.Process(target=run_mode, args=(
+                model_name, args.cache_dir, MODES[name], args.threads, args.new_tokens, args.repeats, results,
+            ))
+            process.start()
+            process.join()
+            report['modes'][name] = results.get() if process.exitcode == 0 else {'error': process.exitcode}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""Replays a JSON lines workload against the front or the chat service and reports latency.
+
+Each record's `prompt`, `user_input` or `title` is sent as one request. Load
+is either closed-loop (`--concurrency` requests in flight) or open-loop
+(Poisson arrivals at `--rate` requests/sec). `--spawn stub` or `--spawn tiny`
+starts a local chat service, and the front in front of it with `--target front`,
+so the run needs no network or GPU.
+
+    python3 -m bench.load --spawn stub --target front --concurrency 8 --requests 200 --out results/front.json
+    python3 -m bench.load --spawn tiny --target chat --rate 2 --requests 50
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import datetime
+import threading
+import subprocess
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+CHAT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FRONT_DIR = os.path.join(os.path.dirname(CHAT_DIR), 'front')
+DEFAULT_WORKLOAD = os.path.join(os.path.dirname(CHAT_DIR), 'requests.jsonl')
+
+
+def read_workload(path: str) -> List[str]:
+    prompts = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            text = record.get('prompt') or record.get('user_input') or record.get('title')
+            if text:
+                prompts.append(text.strip())
+    return prompts
+
+
+def percentiles(values: List[float]) -> Optional[dict]:
+    if not values:
+        return None
+    values = sorted(values)
+    rank = lambda q: values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+    return {
+        'p50': rank(0.50),
+        'p95': rank(0.95),
+        'p99': rank(0.99),
+        'mean': sum(values) / len(values),
+        'max': values[-1],
+    }
+
+
+def server_timing(header: str) -> dict:
+    timings = {}
+    for metric in filter(None, (part.strip() for part in header.split(','))):
+        name, *params = metric.split(';')
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'dur':
+                timings[name.strip()] = float(value) / 1000
+    return timings
+
+
+class Runner(object):
+    def __init__(self, url: str, target: str, max_new_tokens: int, timeout: float) -> None:
+        self.url = url.rstrip('/')
+        self.target = target
+        self.max_new_tokens = max_new_tokens
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def send(self, prompt: str) -> dict:
+        started_at = time.monotonic()
+        try:
+            if self.target == 'front':
+                result = self._front(prompt, started_at)
+            else:
+                result = self._chat(prompt, started_at)
+        except Exception as exc:
+            result = {'ok': False, 'stage': 'client', 'error': str(exc)}
+        result['latency'] = time.monotonic() - started_at
+        return result
+
+    def _front(self, prompt: str, started_at: float) -> dict:
+        resp = self.session.post(f'{self.url}/v1/chat', json={'prompt': prompt}, timeout=self.timeout)
+        result = {
+            'status_code': resp.status_code,
+            'timings': server_timing(resp.headers.get('Server-Timing', '')),
+        }
+        data = resp.json() if resp.status_code in (200, 429) else {}
+        result['ok'] = resp.status_code == 200 and data.get('status') == 'ok'
+        if not result['ok']:
+            result['stage'] = resp.headers.get('X-Error-Stage') or ('admission' if resp.status_code == 429 else 'front')
+            result['error'] = resp.headers.get('X-Error', '')
+        return result
+
+    def _chat(self, prompt: str, started_at: float) -> dict:
+        body = {'prompt': prompt, 'max_new_tokens': self.max_new_tokens}
+        result = {'ok': False}
+        with self.session.post(f'{self.url}/v1/chat/stream', json=body, stream=True, timeout=self.timeout) as resp:
+            result['status_code'] = resp.status_code
+            if resp.status_code != 200 or not resp.headers.get('content-type', '').startswith('text/event-stream'):
+                result['stage'] = 'admission' if resp.status_code == 429 else 'chat'
+                result['error'] = resp.headers.get('X-Error', '')
+                return result
+
+            event = None
+            for line in resp.iter_lines(decode_unicode=True):
+                if line.startswith('event: '):
+                    event = line[len('event: '):]
+                elif line.startswith('data: '):
+                    if 'time_to_first_token' not in result:
+                        result['time_to_first_token'] = time.monotonic() - started_at
+                    if event in ('done', 'error'):
+                        data = json.loads(line[len('data: '):])
+                        result['ok'] = event == 'done'
+                        if result['ok']:
+                            result['generated_tokens'] = data['generated_tokens']
+                        else:
+                            result['stage'] = 'generate'
+                            result['error'] = data.get('message', '')
+                elif not line:
+                    event = None
+        if not result['ok'] and 'stage' not in result:
+            result['stage'] = 'stream'
+        return result
+
+
+def run(runner: Runner, prompts: List[str], total: int, concurrency: int, rate: float, seed: int):
+    rng = random.Random(seed)
+    schedule = [prompts[i % len(prompts)] for i in range(total)]
+    started_at = time.monotonic()
+    if rate > 0:
+        # Open loop: requests start on a Poisson schedule regardless of how many are in flight.
+        with ThreadPoolExecutor(max_workers=max(concurrency, 256)) as executor:
+            futures, arrival = [], started_at
+            for prompt in schedule:
+                arrival += rng.expovariate(rate)
+                time.sleep(max(0.0, arrival - time.monotonic()))
+                futures.append(executor.submit(runner.send, prompt))
+            results = [future.result() for future in futures]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(runner.send, schedule))
+    return results, time.monotonic() - started_at
+
+
+def summarize(results: List[dict], wall_time: float) -> dict:
+    succeeded = [r for r in results if r['ok']]
+    errors = {}
+    for r in results:
+        if not r['ok']:
+            errors[r['stage']] = errors.get(r['stage'], 0) + 1
+
+    stages = {}
+    for r in succeeded:
+        for stage, elapsed in r.get('timings', {}).items():
+            stages.setdefault(stage, []).append(elapsed)
+
+    generated_tokens = sum(r.get('generated_tokens', 0) for r in succeeded)
+    return {
+        'requests': len(results),
+        'succeeded': len(succeeded),
+        'error_rate': 1 - len(succeeded) / len(results) if results else 0.0,
+        'errors_by_stage': {
+            stage: {'count': count, 'rate': count / len(results)} for stage, count in sorted(errors.items())
+        },
+        'wall_time': wall_time,
+        'throughput': len(succeeded) / wall_time if wall_time else 0.0,
+        'latency': percentiles([r['latency'] for r in succeeded]),
+        'time_to_first_token': percentiles([r['time_to_first_token'] for r in succeeded if 'time_to_first_token' in r]),
+        'generated_tokens': generated_tokens,
+        'tokens_per_sec': generated_tokens / wall_time if wall_time else 0.0,
+        'stages': {stage: percentiles(values) for stage, values in sorted(stages.items())},
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url: str, path: str, process: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'server exited with code {process.returncode} before it was ready')
+        try:
+            resp = requests.get(f'{url}{path}', timeout=1)
+            if resp.status_code == 200 and resp.json().get('status') in (True, 'ok'):
+                return
+        except (requests.RequestException, ValueError):
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f'{url}{path} was not ready in {timeout}s')
+
+
+def spawn(module: str, cwd: str, env: dict, ready_path: str, timeout: float):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', module, '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+        cwd=cwd,
+        env={**os.environ, **env},
+    )
+    url = f'http://127.0.0.1:{port}'
+    try:
+        wait_ready(url, ready_path, process, timeout)
+    except Exception:
+        process.terminate()
+        raise
+    return url, process
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', choices=('front', 'chat'), default='front')
+    parser.add_argument('--url', default='', help='service to load, required unless --spawn is set')
+    parser.add_argument('--spawn', choices=('', 'stub', 'tiny'), default='', help='start a local chat service')
+    parser.add_argument('--workload', default=DEFAULT_WORKLOAD)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=0.0, help='Poisson arrivals per second instead of a closed loop')
+    parser.add_argument('--max-new-tokens', type=int, default=64)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--token-delay-ms', type=float, default=20, help='per-token delay of the stub')
+    parser.add_argument('--batch-max-size', type=int, default=8, help='BATCH_MAX_SIZE of the tiny model server')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='', help='write the results as JSON to this path')
+    args = parser.parse_args()
+    if not args.url and not args.spawn:
+        parser.error('either --url or --spawn is required')
+
+    prompts = read_workload(args.workload)
+    if not prompts:
+        parser.error(f'no prompts in {args.workload}')
+
+    started_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    workdir = tempfile.mkdtemp()
+    processes = []
+    try:
+        url = args.url
+        if args.spawn:
+            if args.spawn == 'stub':
+                env = {'STUB_TOKEN_DELAY_MS': str(args.token_delay_ms)}
+                chat_url, process = spawn('bench.stub_server:api', CHAT_DIR, env, '/readyz', 30)
+            else:
+                from bench.tiny_model import build_tiny_model
+                env = {
+                    'MODEL_NAME': build_tiny_model(os.path.join(workdir, 'tiny')),
+                    'CACHE_DIR': os.path.join(workdir, 'cache'),
+                    'BATCH_MAX_SIZE': str(args.batch_max_size),
+                }
+                chat_url, process = spawn('main:api', CHAT_DIR, env, '/readyz', 300)
+            processes.append(process)
+            url = chat_url
+            if args.target == 'front':
+                url, process = spawn('main:api', FRONT_DIR, {'CHAT_ENDPOINT': f'{chat_url}/v1/chat/'}, '/healthz', 30)
+                processes.append(process)
+
+        runner = Runner(url, args.target, args.max_new_tokens, args.timeout)
+        results, wall_time = run(runner, prompts, args.requests, args.concurrency, args.rate, args.seed)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'started_at': started_at,
+        'config': {key: value for key, value in vars(args).items() if key != 'out'},
+        'summary': summarize(results, wall_time),
+    }
+    print(json.dumps(report['summary'], indent=2))
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
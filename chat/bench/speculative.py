@@ -0,0 +1,93 @@
+"""Compares greedy decoding with and without a draft model on CPU.
+
+Without `--target`, tiny random models are built: the target paired with a
+copy of itself, every draft token accepted, and with a much smaller random
+draft, almost none accepted, which shows the fallback. Outputs are checked to
+be identical to plain greedy decoding.
+
+    python3 -m bench.speculative --new-tokens 64 --threads 4
+    python3 -m bench.speculative --target EleutherAI/pythia-410m --draft EleutherAI/pythia-70m
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+from lib import chatbot
+from bench.tiny_model import build_tiny_model
+
+PROMPTS = [
+    'Below is an instruction that describes a task. Could you list AWS Services related to AI/ML?',
+    '[|Human|]: 입력받은 숫자가 prime number 인지 검사하는 python 코드\n[|SA|]:',
+    'Classify the following sentence into question, or statement.\nSentence: What is Amazon SageMaker?\nClass:',
+]
+
+
+def decode(tokenizer, model, new_tokens: int, repeats: int):
+    texts, tokens, elapsed = [], 0, 0.0
+    for _ in range(repeats):
+        for prompt in PROMPTS:
+            started_at = time.monotonic()
+            generation = chatbot.generate(tokenizer, model, prompt, max_new_tokens=new_tokens)
+            elapsed += time.monotonic() - started_at
+            tokens += generation.tokens
+            texts.append(generation.text)
+    return texts, tokens / elapsed if elapsed else 0.0
+
+
+def run_pair(tokenizer, model, draft, args) -> dict:
+    model.assistant = None
+    chatbot.generate(tokenizer, model, PROMPTS[0], max_new_tokens=4)
+    expected, plain = decode(tokenizer, model, args.new_tokens, args.repeats)
+
+    model.assistant = chatbot.Assistant(draft, args.num_tokens, args.min_accept_rate, window=args.window)
+    texts, assisted = decode(tokenizer, model, args.new_tokens, args.repeats)
+    return {
+        'plain_tokens_per_sec': plain,
+        'assisted_tokens_per_sec': assisted,
+        'speedup': assisted / plain if plain else 0.0,
+        'identical': texts == expected,
+        **model.assistant.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', default='', help='target model name or path, tiny random models are built if empty')
+    parser.add_argument('--draft', default='', help='draft model sharing the target tokenizer')
+    parser.add_argument('--cache-dir', default='.cache')
+    parser.add_argument('--cpu-dtype', default='float32')
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--new-tokens', type=int, default=64)
+    parser.add_argument('--repeats', type=int, default=2)
+    parser.add_argument('--num-tokens', type=int, default=5, help='tokens drafted per verification')
+    parser.add_argument('--min-accept-rate', type=float, default=0.3)
+    parser.add_argument('--window', type=int, default=64)
+    args = parser.parse_args()
+
+    chatbot.configure_cpu(args.threads, 1)
+    workdir = tempfile.mkdtemp()
+    try:
+        if args.target:
+            pairs = {'draft': (args.target, args.draft)}
+        else:
+            target = build_tiny_model(os.path.join(workdir, 'target'), hidden_size=256, num_layers=6)
+            small = build_tiny_model(os.path.join(workdir, 'small'), hidden_size=64, num_layers=1)
+            pairs = {'self': (target, target), 'small-random': (target, small)}
+
+        report = {'new_tokens': args.new_tokens, 'num_tokens': args.num_tokens, 'pairs': {}}
+        for name, (target_name, draft_name) in pairs.items():
+            tokenizer = chatbot.load_tokenizer(target_name, args.cache_dir)
+            model = chatbot.load_model(target_name, args.cache_dir, cpu_dtype=args.cpu_dtype)
+            draft = chatbot.load_model(draft_name, args.cache_dir, cpu_dtype=args.cpu_dtype)
+            report['pairs'][name] = {'target': target_name, 'draft': draft_name, **run_pair(tokenizer, model, draft, args)}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
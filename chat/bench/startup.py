@@ -0,0 +1,62 @@
+"""Measures time-to-ready of the model load pipeline.
+
+    python3 -m bench.startup --model .cache/tiny --runs 3 --snapshot-dir .cache/tiny-snapshot
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+from lib import loader
+from bench.tiny_model import build_tiny_model
+
+
+def measure(model_name: str, cache_dir: str, snapshot_dir: str, warmup_tokens: int) -> dict:
+    progress = loader.LoadProgress()
+    started_at = time.monotonic()
+    loader.load(
+        model_name=model_name,
+        cache_dir=cache_dir,
+        snapshot_dir=snapshot_dir,
+        warmup_tokens=warmup_tokens,
+        progress=progress,
+    )
+    return {
+        'time_to_ready': time.monotonic() - started_at,
+        'durations': progress.durations,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='', help='model name or path, a tiny random model is built if empty')
+    parser.add_argument('--cache-dir', default='.cache')
+    parser.add_argument('--snapshot-dir', default='', help='also measure loading from a converted snapshot')
+    parser.add_argument('--warmup-tokens', type=int, default=4)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    model_name = args.model or build_tiny_model(os.path.join(workdir, 'tiny'))
+    results = {'model': model_name, 'source': []}
+    try:
+        for _ in range(args.runs):
+            results['source'].append(measure(model_name, args.cache_dir, None, args.warmup_tokens))
+
+        if args.snapshot_dir:
+            tokenizer, model = loader.load(model_name, args.cache_dir, warmup_tokens=0)
+            loader.convert_snapshot(tokenizer, model, args.snapshot_dir)
+            results['snapshot'] = [
+                measure(model_name, args.cache_dir, args.snapshot_dir, args.warmup_tokens)
+                for _ in range(args.runs)
+            ]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""A stand-in for the chat service that answers without a model.
+
+Every endpoint the front calls is served with canned text, paced at
+`STUB_TOKEN_DELAY_MS` per generated token so latency scales like the real
+service.
+
+    STUB_TOKEN_DELAY_MS=20 python3 -m uvicorn bench.stub_server:api --port 8090
+"""
+import os
+import json
+import time
+import zlib
+from typing import Dict, List
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+
+STUB_TOKEN_DELAY_MS = float(os.environ.get('STUB_TOKEN_DELAY_MS', 20))
+STUB_PREFILL_DELAY_MS = float(os.environ.get('STUB_PREFILL_DELAY_MS', 50))
+
+WORDS = (
+    'Amazon SageMaker Bedrock Lambda ECS Fargate S3 CloudFront DynamoDB Aurora Kinesis '
+    'Glue Athena Redshift Comprehend Rekognition Textract Polly Transcribe Translate'
+).split()
+
+api = FastAPI()
+
+
+class Message(BaseModel):
+    prompt: str = ''
+    variables: Dict[str, str] = Field(default={})
+    max_new_tokens: int = 256
+    stop: List[str] = Field(default=[])
+
+
+class BatchMessage(BaseModel):
+    items: List[Message] = Field(min_items=1)
+
+
+class ScoreRequest(BaseModel):
+    prompt: str = ''
+    variables: Dict[str, str] = Field(default={})
+    candidates: List[str] = Field(min_items=1)
+    prefix: str = ''
+
+
+def prompt_text(message) -> str:
+    # every template is taken as known, its variables stand in for the prompt
+    return message.prompt or '\n'.join(message.variables.values())
+
+
+def tokens_for(message: Message) -> List[str]:
+    seed = zlib.crc32(prompt_text(message).encode('utf-8'))
+    count = min(message.max_new_tokens, 16 + seed % 48)
+    return [f' {WORDS[(seed + i) % len(WORDS)]}' for i in range(count)]
+
+
+def generate(message: Message) -> str:
+    tokens = tokens_for(message)
+    time.sleep((STUB_PREFILL_DELAY_MS + STUB_TOKEN_DELAY_MS * len(tokens)) / 1000)
+    return ''.join(tokens)
+
+
+@api.get('/readyz')
+@api.get('/readyz/')
+def readyz():
+    return {
+        'status': True,
+        'phase': 'ready',
+    }
+
+
+@api.post('/v1/chat')
+@api.post('/v1/chat/')
+def chat(message: Message):
+    return {
+        'status': 'ok',
+        'generation': generate(message),
+        'finish_reason': 'length',
+    }
+
+
+@api.post('/v1/chat/batch')
+@api.post('/v1/chat/batch/')
+def chat_batch(message: BatchMessage):
+    return {
+        'status': 'ok',
+        'results': [{
+            'status': 'ok',
+            'generation': generate(item),
+            'finish_reason': 'length',
+        } for item in message.items],
+    }
+
+
+@api.post('/v1/score')
+@api.post('/v1/score/')
+def score(request: ScoreRequest):
+    time.sleep(STUB_PREFILL_DELAY_MS / 1000)
+    return {
+        'status': 'ok',
+        'scores': [{
+            'candidate': candidate,
+            'logprob': -float(zlib.crc32((prompt_text(request) + candidate).encode('utf-8')) % 1000) / 100,
+            'tokens': 2,
+        } for candidate in request.candidates],
+    }
+
+
+@api.post('/v1/chat/stream')
+@api.post('/v1/chat/stream/')
+def chat_stream(message: Message):
+    def events():
+        started_at = time.monotonic()
+        time.sleep(STUB_PREFILL_DELAY_MS / 1000)
+        first_token_at = time.monotonic()
+        tokens = tokens_for(message)
+        for token in tokens:
+            time.sleep(STUB_TOKEN_DELAY_MS / 1000)
+            yield f'data: {json.dumps({"token": token})}\n\n'
+        finished_at = time.monotonic()
+        yield 'event: done\ndata: ' + json.dumps({
+            'status': 'ok',
+            'generation': ''.join(tokens),
+            'finish_reason': 'length',
+            'prompt_tokens': len(prompt_text(message).split()),
+            'generated_tokens': len(tokens),
+            'time_to_first_token': first_token_at - started_at,
+            'elapsed': finished_at - started_at,
+        }) + '\n\n'
+
+    return StreamingResponse(events(), media_type='text/event-stream')
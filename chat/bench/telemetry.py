@@ -0,0 +1,70 @@
+"""Measures the per-request overhead of each telemetry profile.
+
+A request is simulated the way the chat handler traces it: a root and a
+handler span, the message and generation as payload attributes, and the log
+lines. Every profile runs in its own process since profiles are read at import.
+
+    python3 -m bench.telemetry --requests 5000 --prompt-chars 2000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+from lib.telemetry import PROFILES
+
+
+def run_profile(name: str, requests: int, prompt_chars: int, results):
+    os.environ['TELEMETRY_PROFILE'] = name
+    # logs go to stdout, which would otherwise flood the report
+    sys.stdout = open(os.devnull, 'w')
+    from lib.logger import logger
+    from lib.o11y import tracer, set_payload
+
+    message = {'prompt': 'x' * prompt_chars, 'max_new_tokens': 256, 'top_k': 0, 'top_p': 1.0}
+    generation = 'y' * (prompt_chars // 2)
+
+    def request():
+        with tracer.start_as_current_span('root'):
+            with tracer.start_as_current_span('chat') as span:
+                logger.info('user_input: %s', message)
+                set_payload(span, 'message', lambda: json.dumps(message))
+                span.set_attribute('is_ready', True)
+                set_payload(span, 'generation', generation)
+                logger.info('generation: %s', generation)
+
+    for _ in range(min(100, requests)):
+        request()
+    started_at = time.perf_counter()
+    for _ in range(requests):
+        request()
+    elapsed = time.perf_counter() - started_at
+    results.put({'per_request_us': elapsed / requests * 1e6})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles', default=','.join(PROFILES))
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--prompt-chars', type=int, default=2000)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    report = {'requests': args.requests, 'prompt_chars': args.prompt_chars, 'profiles': {}}
+    for name in args.profiles.split(','):
+        results = ctx.Queue()
+        process = ctx.Process(target=run_profile, args=(name, args.requests, args.prompt_chars, results))
+        process.start()
+        process.join()
+        report['profiles'][name] = {
+            **PROFILES[name]._asdict(),
+            **(results.get() if process.exitcode == 0 else {'error': process.exitcode}),
+        }
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import os
+import argparse
+
+CORPUS = [
+    'Below is an instruction that describes a task, paired with an input that provides further context.',
+    'Write a response that appropriately completes the request.',
+    'Classify the following sentence into question, or statement.',
+    'Label the category towards the sentence.',
+    '[|Human|]: Could you list AWS Services related to AI/ML?',
+    '[|SA|]: Sure, Here are the services about Machine Learning (ML) and Artificial Intelligence (AI) on AWS.',
+    '입력받은 숫자가 prime number 인지 검사하는 python 코드',
+]
+
+
+def build_tiny_model(path: str, hidden_size: int = 64, num_layers: int = 2, vocab_size: int = 512):
+    """Saves a randomly initialised GPT-NeoX model and a small BPE tokenizer to `path`.
+
+    The layout matches what `chatbot.setup_model` expects, so benchmarks can run
+    offline on a laptop CPU.
+    """
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import GPTNeoXConfig, GPTNeoXForCausalLM, PreTrainedTokenizerFast
+
+    if os.path.exists(os.path.join(path, 'config.json')):
+        return path
+
+    bpe = Tokenizer(models.BPE(unk_token='<unk>'))
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=['<pad>', '<unk>', '</s>'],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    bpe.train_from_iterator(CORPUS * 8, trainer)
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=bpe,
+        pad_token='<pad>',
+        unk_token='<unk>',
+        eos_token='</s>',
+    )
+
+    config = GPTNeoXConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=4,
+        intermediate_size=hidden_size * 4,
+        max_position_embeddings=2048,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    model = GPTNeoXForCausalLM(config)
+    model.save_pretrained(path, safe_serialization=True)
+    tokenizer.save_pretrained(path)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a tiny random model for offline benchmarks')
+    parser.add_argument('path')
+    parser.add_argument('--hidden-size', type=int, default=64)
+    parser.add_argument('--num-layers', type=int, default=2)
+    args = parser.parse_args()
+    print(build_tiny_model(args.path, hidden_size=args.hidden_size, num_layers=args.num_layers))
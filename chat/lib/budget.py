@@ -0,0 +1,112 @@
+import re
+import resource
+from typing import List
+
+import torch
+
+POLICIES = ('clamp', 'reject')
+
+
+class GenerationTooLarge(Exception):
+    def __init__(self, needed: int, limit: int) -> None:
+        super().__init__(f'the generation needs about {needed} bytes, over the budget of {limit}')
+        self.needed = needed
+        self.limit = limit
+
+
+class GenerationBudget(object):
+    """Bounds the memory of a generation batch, estimated from the model config before it starts.
+
+    The estimate covers the attention cache of every sequence at its full
+    length, prompt plus `max_new_tokens`, and the logits computed over the
+    prompt at prefill. A request over the limit on its own is clamped or
+    rejected, as `policy` says. Clamping first drops extra sampled sequences,
+    since one of several samples picked at random is just a sample, then
+    lowers `max_new_tokens`.
+    """
+
+    def __init__(self, model, limit_bytes: int, policy: str = 'clamp') -> None:
+        if policy not in POLICIES:
+            raise ValueError(f'unknown memory policy: {policy}, expected one of {POLICIES}')
+        config = model.config
+        heads = config.num_attention_heads
+        kv_heads = getattr(config, 'num_key_value_heads', None) or heads
+        dtype_bytes = model.get_input_embeddings().weight.element_size()
+        # a key and a value per layer and attention head
+        self.cache_bytes_per_token = 2 * config.num_hidden_layers * kv_heads * (config.hidden_size // heads) * dtype_bytes
+        self.logits_bytes_per_token = config.vocab_size * dtype_bytes
+        self.limit = limit_bytes
+        self.policy = policy
+
+    def estimate(self, prompt_tokens: int, max_new_tokens: int, sequences: int = 1) -> int:
+        cache = self.cache_bytes_per_token * (prompt_tokens + max_new_tokens)
+        logits = self.logits_bytes_per_token * prompt_tokens
+        return (cache + logits) * sequences
+
+    def admit(self, params: dict, prompt_tokens: int) -> int:
+        """Returns the estimated bytes of a request, clamping its params in place to fit if allowed."""
+        needed = self.estimate(prompt_tokens, params['max_new_tokens'], params['num_return_sequences'])
+        if needed <= self.limit:
+            return needed
+        if self.policy == 'reject':
+            raise GenerationTooLarge(needed, self.limit)
+
+        params['num_return_sequences'] = 1
+        fixed = self.estimate(prompt_tokens, 0)
+        max_new_tokens = (self.limit - fixed) // self.cache_bytes_per_token
+        if max_new_tokens < 1:
+            raise GenerationTooLarge(fixed + self.cache_bytes_per_token, self.limit)
+        params['max_new_tokens'] = min(params['max_new_tokens'], max_new_tokens)
+        return self.estimate(prompt_tokens, params['max_new_tokens'])
+
+    def fit(self, requests: List) -> List:
+        """Returns the longest head of `requests` whose estimates fit the limit together, at least one."""
+        total = 0
+        for count, request in enumerate(requests):
+            total += request.memory
+            if count and total > self.limit:
+                return requests[:count]
+        return requests
+
+
+def _status_bytes(field: str) -> int:
+    with open('/proc/self/status') as f:
+        return int(re.search(rf'^{field}:\s+(\d+) kB', f.read(), re.MULTILINE).group(1)) * 1024
+
+
+class PeakMemory(object):
+    """Measures the peak memory of the work between `start` and `stop`, above what was in use at `start`.
+
+    On CUDA it reads the allocator's peak. On CPU it resets the peak resident
+    set size of the process through /proc/self/clear_refs, where the kernel
+    allows it. Elsewhere it falls back to the growth of `ru_maxrss`, which only
+    moves once the process goes past its previous peak.
+    """
+
+    def __init__(self, device) -> None:
+        self.device = device
+        self._base = 0
+        self._reset = False
+
+    def start(self):
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self._base = torch.cuda.memory_allocated(self.device)
+            return
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            self._reset = True
+            self._base = _status_bytes('VmRSS')
+        except (OSError, AttributeError):
+            self._reset = False
+            self._base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def stop(self) -> int:
+        if self.device.type == 'cuda':
+            peak = torch.cuda.max_memory_allocated(self.device)
+        elif self._reset:
+            peak = _status_bytes('VmHWM')
+        else:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return max(0, peak - self._base)
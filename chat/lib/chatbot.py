@@ -1,7 +1,25 @@
+import os
+import time
+import bisect
+import shutil
 import torch
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 from random import choice
+from typing import Callable, List, NamedTuple, Optional
 from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import (
+    LogitsProcessorList,
+    NoRepeatNGramLogitsProcessor,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
 from lib.logger import logger
+from lib import metrics
+from lib.profiling import Profile
 
 if torch.cuda.is_available():
     device = "cuda"
@@ -9,30 +27,331 @@ else:
     device = "cpu"
 
 
-def setup_model(model_name: str, cache_dir: str, load_in_8bit=False):
-    tokenizer = AutoTokenizer.from_pretrained(
+class Generation(NamedTuple):
+    text: str
+    finish_reason: str  # one of 'eos', 'stop' or 'length'
+    tokens: int
+
+
+class StopMatcher(object):
+    """Detects stop strings and stop token id sequences in a growing generation.
+
+    Only the last few tokens are decoded on every check, enough to cover the
+    longest stop string, so a match spanning token boundaries is still found.
+    """
+
+    def __init__(self, tokenizer: AutoTokenizer, stop: List[str] = None, stop_token_ids: List[List[int]] = None) -> None:
+        self.tokenizer = tokenizer
+        self.stop = [s for s in (stop or []) if s]
+        self.stop_token_ids = [ids for ids in (stop_token_ids or []) if ids]
+        self._window = max([len(s) for s in self.stop], default=0) + 2
+
+    def __bool__(self):
+        return bool(self.stop or self.stop_token_ids)
+
+    def match(self, token_ids: List[int]) -> bool:
+        for ids in self.stop_token_ids:
+            if token_ids[-len(ids):] == ids:
+                return True
+        if self.stop:
+            tail = self.tokenizer.decode(token_ids[-self._window:], skip_special_tokens=True)
+            return any(s in tail for s in self.stop)
+        return False
+
+    def strip_token_ids(self, token_ids: List[int]) -> List[int]:
+        for ids in self.stop_token_ids:
+            if token_ids[-len(ids):] == ids:
+                return token_ids[:-len(ids)]
+        return token_ids
+
+    def truncate(self, text: str) -> str:
+        indexes = [text.find(s) for s in self.stop if s in text]
+        return text[:min(indexes)] if indexes else text
+
+    def holdback(self, text: str) -> int:
+        """Returns how many trailing characters may be the start of a stop string."""
+        for size in range(min(len(text), self._window), 0, -1):
+            if any(s.startswith(text[-size:]) for s in self.stop):
+                return size
+        return 0
+
+
+class _StopCriteria(StoppingCriteria):
+    def __init__(self, matcher: StopMatcher, prompt_length: int) -> None:
+        self.matcher = matcher
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.tensor(
+            [self.matcher.match(ids[self.prompt_length:].tolist()) for ids in input_ids],
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+class _FirstTokenTimer(StoppingCriteria):
+    """Notes when the first token is out, which splits prefill from decode time."""
+
+    def __init__(self) -> None:
+        self.at = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.at is None:
+            self.at = time.monotonic()
+        return False
+
+
+class _StepTimer(StoppingCriteria):
+    """Records the duration of every decode step of a profiled generation."""
+
+    def __init__(self, profile: Profile) -> None:
+        self.profile = profile
+        self.at = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        now = time.monotonic()
+        if self.at is not None:
+            self.profile.step(now - self.at)
+        self.at = now
+        return False
+
+
+def _profile_stages(profile: Profile, started_at: float, tokenized_at: float, first_token_at: float, generated_at: float, finished_at: float):
+    profile.add('tokenize', tokenized_at - started_at)
+    profile.add('prefill', first_token_at - tokenized_at)
+    profile.add('decode', generated_at - first_token_at)
+    profile.add('detokenize', finished_at - generated_at)
+
+
+def _finish(tokenizer: AutoTokenizer, matcher: StopMatcher, token_ids: List[int], eos_token_id: int, prompt: str = None) -> Generation:
+    """Decodes generated token ids, cutting off any stop sequence."""
+    tokens = len(token_ids)
+    if matcher and matcher.match(token_ids):
+        finish_reason = 'stop'
+        token_ids = matcher.strip_token_ids(token_ids)
+    elif token_ids and token_ids[-1] == eos_token_id:
+        finish_reason = 'eos'
+    else:
+        finish_reason = 'length'
+
+    if prompt is None:
+        text = tokenizer.decode(token_ids, skip_special_tokens=True)
+    else:
+        prompt_ids = tokenizer.encode(prompt)
+        text = tokenizer.decode(prompt_ids + token_ids, skip_special_tokens=True)[len(prompt):]
+    if finish_reason == 'stop':
+        text = matcher.truncate(text)
+    return Generation(text, finish_reason, tokens)
+
+
+def load_tokenizer(model_name: str, cache_dir: str):
+    return AutoTokenizer.from_pretrained(
         model_name,
         cache_dir=cache_dir
     )
-    if device == "cuda":
-        logger.info(f"Model is loading on GPU for device: {device}")
+
+
+CPU_DTYPES = {
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+    'float32': torch.float32,
+}
+
+
+def configure_cpu(num_threads: int = 0, num_interop_threads: int = 0):
+    """Pins the intra-/inter-op thread pools, 0 keeps torch's default."""
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            logger.warning('inter-op threads can only be set before any parallel work has started')
+    logger.info(f'torch threads: {torch.get_num_threads()}, interop threads: {torch.get_num_interop_threads()}')
+
+
+def load_model(
+    model_name: str,
+    cache_dir: str,
+    load_in_8bit=False,
+    cpu_dtype: str = 'float16',
+    cpu_quantize: bool = False,
+    device_name: str = '',
+    attn_implementation: str = '',
+):
+    """Loads a model on `device_name`, or on the default device when empty.
+
+    `attn_implementation`, e.g. `sdpa`, picks the attention kernels of models
+    that support several, empty keeps the transformers default.
+    """
+    device_name = device_name or device
+    options = {'attn_implementation': attn_implementation} if attn_implementation else {}
+    if device_name == "cuda":
+        logger.info(f"Model is loading on GPU for device: {device_name}")
         model = AutoModelForCausalLM.from_pretrained(
             model_name,
             torch_dtype=torch.float16,
             load_in_8bit=load_in_8bit,
             device_map='auto',
             cache_dir=cache_dir,
+            **options,
         )
     else:
-        logger.info(f"Model is loading on CPU")
+        # dynamic quantization only takes float32 weights
+        torch_dtype = torch.float32 if cpu_quantize else CPU_DTYPES[cpu_dtype]
+        logger.info(f"Model is loading on CPU with dtype: {torch_dtype}, quantize: {cpu_quantize}")
         model = AutoModelForCausalLM.from_pretrained(
-            model_name, device_map={"": device},
-            torch_dtype=torch.float16,
+            model_name, device_map={"": device_name},
+            torch_dtype=torch_dtype,
             low_cpu_mem_usage=True,
             cache_dir=cache_dir,
+            **options,
         )
+        if cpu_quantize:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
     model.eval()
-    return tokenizer, model
+    logger.info(f'attention implementation: {getattr(model.config, "_attn_implementation", "eager")}')
+    return model
+
+
+def optimize(model, compile_decode: bool = False, prompt_buckets: List[int] = None):
+    """Turns on the accelerated decode path of a loaded model.
+
+    With `compile_decode`, the forward pass used by `generate_batch` is
+    compiled with dynamic shapes, so one graph serves every sequence length.
+    With `prompt_buckets`, prompts are left-padded up to the next bucket, which
+    keeps prefill to a few shapes that are warmed up at startup. Either one
+    sends single-sequence `generate` calls through `generate_batch`.
+    """
+    model.prompt_buckets = sorted(prompt_buckets or [])
+    model.compiled_forward = None
+    if compile_decode:
+        if hasattr(torch, 'compile'):
+            # the bound forward, a compiled module would register itself as a submodule
+            model.compiled_forward = torch.compile(model.forward, dynamic=True)
+        else:
+            logger.warning(f'torch.compile needs torch 2.0 or later, found {torch.__version__}, decoding runs eagerly')
+    logger.info(f'compiled decode: {model.compiled_forward is not None}, prompt buckets: {model.prompt_buckets}')
+
+
+def _accelerated(model) -> bool:
+    return bool(getattr(model, 'prompt_buckets', None)) or getattr(model, 'compiled_forward', None) is not None
+
+
+def _bucket(length: int, buckets: List[int]) -> int:
+    """Returns the smallest bucket holding `length`, or `length` itself past the largest one."""
+    index = bisect.bisect_left(buckets, length)
+    return buckets[index] if index < len(buckets) else length
+
+
+class Assistant(object):
+    """A small draft model that proposes tokens for the main model to verify.
+
+    The accept rate is checked every `window` proposed tokens. When it falls
+    under `min_accept_rate`, drafting is paused for the next `cooldown`
+    generations, after which it is tried again.
+    """
+
+    def __init__(self, model, num_tokens: int = 5, min_accept_rate: float = 0.3, window: int = 256, cooldown: int = 32) -> None:
+        self.model = model
+        self.num_tokens = max(1, num_tokens)
+        self.min_accept_rate = min_accept_rate
+        self.window = window
+        self.cooldown = cooldown
+        self.proposed = 0
+        self.accepted = 0
+        self.fallbacks = 0
+        self._window_proposed = 0
+        self._window_accepted = 0
+        self._paused_for = 0
+
+    @property
+    def paused(self) -> bool:
+        return self._paused_for > 0
+
+    def start(self) -> bool:
+        """Returns whether the next generation should draft, counting down a pause."""
+        if self._paused_for > 0:
+            self._paused_for -= 1
+            return False
+        return True
+
+    def record(self, proposed: int, accepted: int):
+        self.proposed += proposed
+        self.accepted += accepted
+        self._window_proposed += proposed
+        self._window_accepted += accepted
+        if self._window_proposed < self.window:
+            return
+        rate = self._window_accepted / self._window_proposed
+        self._window_proposed = self._window_accepted = 0
+        if rate < self.min_accept_rate:
+            logger.warning(f'draft accept rate {rate:.2f} is under {self.min_accept_rate}, pausing for {self.cooldown} generations')
+            self.fallbacks += 1
+            self._paused_for = self.cooldown
+
+    def stats(self) -> dict:
+        return {
+            'proposed': self.proposed,
+            'accepted': self.accepted,
+            'accept_rate': self.accepted / self.proposed if self.proposed else 0.0,
+            'fallbacks': self.fallbacks,
+            'paused': self.paused,
+        }
+
+
+def has_snapshot(snapshot_dir: str) -> bool:
+    return bool(snapshot_dir) and os.path.exists(os.path.join(snapshot_dir, 'config.json'))
+
+
+def setup_model(
+    model_name: str,
+    cache_dir: str,
+    load_in_8bit=False,
+    snapshot_dir: str = None,
+    cpu_dtype: str = 'float16',
+    cpu_quantize: bool = False,
+    draft_model_name: str = '',
+    draft_num_tokens: int = 5,
+    draft_min_accept_rate: float = 0.3,
+    device_name: str = '',
+    attn_implementation: str = '',
+):
+    """Loads the tokenizer, the model and the draft model, if any, in parallel.
+
+    A local snapshot written by `save_snapshot` is preferred over `model_name`
+    when one exists in `snapshot_dir`. The draft model must share the
+    tokenizer, it is attached to the model as `model.assistant`.
+    """
+    if has_snapshot(snapshot_dir):
+        logger.info(f"Loading from snapshot: {snapshot_dir}")
+        model_name = snapshot_dir
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        tokenizer = pool.submit(load_tokenizer, model_name, cache_dir)
+        model = pool.submit(load_model, model_name, cache_dir, load_in_8bit, cpu_dtype, cpu_quantize, device_name, attn_implementation)
+        draft = None
+        if draft_model_name:
+            draft = pool.submit(load_model, draft_model_name, cache_dir, False, cpu_dtype, cpu_quantize, device_name, attn_implementation)
+        tokenizer, model = tokenizer.result(), model.result()
+        if draft is not None:
+            model.assistant = Assistant(draft.result(), draft_num_tokens, draft_min_accept_rate)
+        return tokenizer, model
+
+
+def save_snapshot(tokenizer: AutoTokenizer, model: AutoModelForCausalLM, snapshot_dir: str, max_shard_size: str = '2GB'):
+    """Writes the loaded model as sharded safetensors, which later loads memory-map.
+
+    The snapshot is written next to `snapshot_dir` and renamed into place, so
+    replicas sharing the directory never see a partial snapshot.
+    """
+    staging_dir = f'{snapshot_dir}.{os.getpid()}.tmp'
+    model.save_pretrained(staging_dir, safe_serialization=True, max_shard_size=max_shard_size)
+    tokenizer.save_pretrained(staging_dir)
+    try:
+        os.rename(staging_dir, snapshot_dir)
+    except OSError:
+        logger.warning(f'snapshot already exists: {snapshot_dir}')
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
 
 def generate(
@@ -46,8 +365,52 @@ def generate(
     num_return_sequences: int = 1,
     do_sample: bool = False,
     eos_token_id: int = 2,
-):
-    input_ids = tokenizer.encode(prompt, return_tensors='pt').to(model.device)
+    stop: List[str] = None,
+    stop_token_ids: List[List[int]] = None,
+    prompt_ids: List[int] = None,
+    profile: Profile = None,
+) -> Generation:
+    """Generates for one prompt.
+
+    Greedy single-sequence requests are decoded with the model's assistant,
+    when it has one and drafting is not paused. Other single-sequence requests
+    go through `generate_batch` when the model is `optimize`d. When `prompt_ids` are given,
+    e.g. by a rendered template, the prompt is not tokenized again and only
+    the generated ids are decoded. A `profile`, if given, gets the time of
+    every stage and decode step. Greedy decoding yields the same sequence
+    every time, so it only ever computes one.
+    """
+    started_at = time.monotonic()
+    if not do_sample:
+        num_return_sequences = 1
+    assistant = getattr(model, 'assistant', None)
+    if assistant is not None and not do_sample and num_return_sequences == 1 and assistant.start():
+        return _generate_assisted(
+            tokenizer, model, assistant, prompt, max_new_tokens, eos_token_id,
+            StopMatcher(tokenizer, stop, stop_token_ids), started_at, prompt_ids, profile,
+        )
+    if num_return_sequences == 1 and _accelerated(model):
+        return generate_batch(
+            tokenizer, model, [prompt], [max_new_tokens], [eos_token_id],
+            top_k=top_k, top_p=top_p, temperature=temperature, do_sample=do_sample,
+            stops=[StopMatcher(tokenizer, stop, stop_token_ids)],
+            prompt_ids=[prompt_ids],
+            profiles=[profile],
+        )[0]
+
+    if prompt_ids is not None:
+        input_ids = torch.tensor([prompt_ids], device=model.device)
+    else:
+        input_ids = tokenizer.encode(prompt, return_tensors='pt').to(model.device)
+    tokenized_at = time.monotonic()
+    prompt_length = input_ids.shape[1]
+    matcher = StopMatcher(tokenizer, stop, stop_token_ids)
+    timer = _FirstTokenTimer()
+    stopping_criteria = StoppingCriteriaList([timer])
+    if matcher:
+        stopping_criteria.append(_StopCriteria(matcher, prompt_length))
+    if profile is not None:
+        stopping_criteria.append(_StepTimer(profile))
     with torch.no_grad():
         gen_tokens = model.generate(
             input_ids=input_ids,
@@ -60,13 +423,466 @@ def generate(
             eos_token_id=eos_token_id,
             pad_token_id=tokenizer.eos_token_id,
             no_repeat_ngram_size=6,
+            stopping_criteria=stopping_criteria,
+        )
+    gen_token = choice(gen_tokens)[prompt_length:].tolist()
+    # rows that finished early are padded up to the longest one
+    pad_token_id = tokenizer.eos_token_id
+    while len(gen_token) > 1 and gen_token[-1] == pad_token_id and gen_token[-2] in (pad_token_id, eos_token_id):
+        gen_token.pop()
+    generated_at = time.monotonic()
+    generation = _finish(tokenizer, matcher, gen_token, eos_token_id, prompt if prompt_ids is None else None)
+
+    finished_at = time.monotonic()
+    first_token_at = timer.at or finished_at
+    if profile is not None:
+        _profile_stages(profile, started_at, tokenized_at, first_token_at, generated_at, finished_at)
+    metrics.observe_timing(first_token_at - started_at, finished_at - first_token_at, generation.tokens)
+    metrics.observe_generation(prompt_length, generation.tokens, generation.finish_reason)
+    return generation
+
+
+def _logits_processors(top_k: int, top_p: float, temperature: float, do_sample: bool):
+    processors = LogitsProcessorList([NoRepeatNGramLogitsProcessor(6)])
+    if do_sample:
+        if temperature and temperature != 1.0:
+            processors.append(TemperatureLogitsWarper(temperature))
+        if top_k:
+            processors.append(TopKLogitsWarper(top_k))
+        if top_p < 1.0:
+            processors.append(TopPLogitsWarper(top_p))
+    return processors
+
+
+def _forward(model, input_ids, attention_mask, past_key_values=None, past_length=0, compiled: bool = False):
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    position_ids.masked_fill_(attention_mask == 0, 1)
+    if compiled and getattr(model, 'compiled_forward', None) is not None:
+        model = model.compiled_forward
+    return model(
+        input_ids=input_ids[:, past_length:],
+        attention_mask=attention_mask,
+        position_ids=position_ids[:, past_length:],
+        past_key_values=past_key_values,
+        use_cache=True,
+        return_dict=True,
+    )
+
+
+def _to_legacy_cache(past_key_values):
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return past_key_values.to_legacy_cache()
+    if hasattr(past_key_values, 'layers'):
+        # newer transformers dropped the conversion, the tensors are read off each layer
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+    return past_key_values
+
+
+def _from_legacy_cache(cache_cls, legacy_cache):
+    if hasattr(cache_cls, 'from_legacy_cache'):
+        return cache_cls.from_legacy_cache(legacy_cache)
+    if hasattr(cache_cls, 'batch_select_indices'):
+        # and takes the legacy layout in the constructor instead
+        return cache_cls(legacy_cache)
+    return legacy_cache
+
+
+def _crop(past_key_values, length: int):
+    if hasattr(past_key_values, 'crop'):
+        past_key_values.crop(length)
+        return past_key_values
+    legacy_cache = tuple(
+        tuple(t[:, :, :length] for t in layer)
+        for layer in _to_legacy_cache(past_key_values)
+    )
+    return _from_legacy_cache(type(past_key_values), legacy_cache)
+
+
+def _greedy(processors, ids: List[int], logits, device) -> int:
+    scores = processors(torch.tensor([ids], device=device), logits[None].float())
+    return int(torch.argmax(scores, dim=-1))
+
+
+def _generate_assisted(
+    tokenizer: AutoTokenizer,
+    model: AutoModelForCausalLM,
+    assistant: Assistant,
+    prompt: str,
+    max_new_tokens: int,
+    eos_token_id: int,
+    matcher: StopMatcher,
+    started_at: float,
+    prompt_ids: List[int] = None,
+    profile: Profile = None,
+) -> Generation:
+    """Greedy decoding where the assistant drafts tokens and the model verifies them in one pass.
+
+    Every token is still the model's own greedy choice, a draft token is kept
+    only while it equals that choice, so the output is the same as without
+    the assistant. Both attention caches are cropped back to the kept tokens.
+    """
+    ids = list(prompt_ids) if prompt_ids is not None else tokenizer.encode(prompt)
+    tokenized_at = time.monotonic()
+    prompt_length = len(ids)
+    device = model.device
+    processors = LogitsProcessorList([NoRepeatNGramLogitsProcessor(6)])
+    target_past, target_length = None, 0
+    draft_past, draft_length = None, 0
+    proposed = accepted = 0
+    first_token_at = None
+
+    with torch.no_grad():
+        while len(ids) - prompt_length < max_new_tokens:
+            remaining = max_new_tokens - (len(ids) - prompt_length)
+            drafts = []
+            for _ in range(0 if assistant.paused else min(assistant.num_tokens, remaining - 1)):
+                seq = ids + drafts
+                out = _forward(
+                    assistant.model,
+                    torch.tensor([seq], device=device),
+                    torch.ones((1, len(seq)), dtype=torch.long, device=device),
+                    draft_past, draft_length,
+                )
+                draft_past, draft_length = out.past_key_values, len(seq)
+                drafts.append(_greedy(processors, seq, out.logits[0, -1], device))
+
+            seq = ids + drafts
+            out = _forward(
+                model,
+                torch.tensor([seq], device=device),
+                torch.ones((1, len(seq)), dtype=torch.long, device=device),
+                target_past, target_length,
+            )
+            logits = out.logits[0, -(len(drafts) + 1):]
+            new_tokens = []
+            for pos in range(len(drafts) + 1):
+                new_tokens.append(_greedy(processors, ids + drafts[:pos], logits[pos], device))
+                if pos == len(drafts) or new_tokens[-1] != drafts[pos]:
+                    break
+            if first_token_at is None:
+                first_token_at = step_at = time.monotonic()
+            elif profile is not None:
+                now = time.monotonic()
+                profile.step(now - step_at)
+                step_at = now
+            proposed += len(drafts)
+            accepted += len(new_tokens) - 1
+
+            # only the prompt and the accepted drafts stay cached, the last new token is fed next
+            kept = len(ids) + len(new_tokens) - 1
+            target_past, target_length = _crop(out.past_key_values, kept), kept
+            if draft_length > kept:
+                draft_past, draft_length = _crop(draft_past, kept), kept
+
+            finished = False
+            for token in new_tokens:
+                ids.append(token)
+                if token == eos_token_id or (matcher and matcher.match(ids[prompt_length:])):
+                    finished = True
+                    break
+            if finished:
+                break
+
+    assistant.record(proposed, accepted)
+    generated_at = time.monotonic()
+    generation = _finish(tokenizer, matcher, ids[prompt_length:], eos_token_id, prompt if prompt_ids is None else None)
+
+    finished_at = time.monotonic()
+    first_token_at = first_token_at or finished_at
+    if profile is not None:
+        _profile_stages(profile, started_at, tokenized_at, first_token_at, generated_at, finished_at)
+    metrics.observe_timing(first_token_at - started_at, finished_at - first_token_at, generation.tokens)
+    metrics.observe_generation(prompt_length, generation.tokens, generation.finish_reason)
+    return generation
+
+
+def _select_rows(past_key_values, index):
+    if hasattr(past_key_values, 'batch_select_indices'):
+        past_key_values.batch_select_indices(index)
+        return past_key_values
+    return tuple(tuple(t[index] for t in layer) for layer in past_key_values)
+
+
+def encode_prefix(tokenizer: AutoTokenizer, model: AutoModelForCausalLM, prefix: str):
+    """Runs prefill over a static prompt prefix and returns its ids and attention cache.
+
+    The last token is left out: it may merge with whatever text follows the
+    prefix, so it is prefilled together with the suffix instead.
+    """
+    input_ids = tokenizer.encode(prefix)[:-1]
+    with torch.no_grad():
+        out = model(
+            input_ids=torch.tensor([input_ids], device=model.device),
+            use_cache=True,
+            return_dict=True,
         )
-    gen_token = choice(gen_tokens)
-    return tokenizer.decode(gen_token, skip_special_tokens=True)[len(prompt):]
+    past_key_values = out.past_key_values
+    return input_ids, _to_legacy_cache(past_key_values), type(past_key_values)
+
+
+def _expand_prefix(prefix, batch_size: int):
+    legacy_cache = tuple(
+        tuple(t.expand(batch_size, *t.shape[1:]).contiguous() for t in layer)
+        for layer in prefix.past_key_values
+    )
+    return _from_legacy_cache(prefix.cache_cls, legacy_cache)
+
+
+def generate_batch(
+    tokenizer: AutoTokenizer,
+    model: AutoModelForCausalLM,
+    prompts: List[str],
+    max_new_tokens: List[int],
+    eos_token_ids: List[int],
+    top_k: int = 0,
+    top_p: float = 1.0,
+    temperature: float = 0.5,
+    do_sample: bool = False,
+    streamers: Optional[List[Optional[Callable[[int], None]]]] = None,
+    prefix=None,
+    stops: Optional[List[StopMatcher]] = None,
+    prompt_ids: Optional[List[Optional[List[int]]]] = None,
+    profiles: Optional[List[Optional[Profile]]] = None,
+) -> List[Generation]:
+    """Generates for several prompts sharing the same sampling parameters.
+
+    Prompts are left-padded into one batch. Each row stops on its own eos token
+    or max_new_tokens and is dropped from the batch right away, so short
+    generations never wait on long ones. A row's streamer, if given, is called
+    with every token id as soon as it is decoded.
+
+    When a cached `prefix` is shared by every prompt, its attention cache is
+    reused and only the remaining suffixes are prefilled. A prompt whose ids
+    are given in `prompt_ids` is not tokenized again. On an `optimize`d model,
+    the padded width is rounded up to a prompt bucket. Each row's profile, if
+    given, gets the time of the stages and decode steps of the whole batch.
+    """
+    started_at = time.monotonic()
+    streamers = streamers or [None] * len(prompts)
+    stops = stops or [StopMatcher(tokenizer)] * len(prompts)
+    pad_token_id = tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = tokenizer.eos_token_id
+    prompt_ids = prompt_ids or [None] * len(prompts)
+    encoded = [
+        ids if ids is not None else tokenizer.encode(prompt)
+        for prompt, ids in zip(prompts, prompt_ids)
+    ]
+    tokenized_at = time.monotonic()
+    profiled = [profile for profile in profiles or [] if profile is not None]
+    if prefix is not None and not prefix.match_all(encoded):
+        prefix = None
+
+    head = prefix.input_ids if prefix is not None else []
+    suffixes = [ids[len(head):] for ids in encoded]
+    width = max(len(ids) for ids in suffixes)
+    if getattr(model, 'prompt_buckets', None):
+        width = _bucket(len(head) + width, model.prompt_buckets) - len(head)
+    input_ids = torch.tensor(
+        [head + [pad_token_id] * (width - len(ids)) + ids for ids in suffixes],
+        device=model.device,
+    )
+    attention_mask = torch.tensor(
+        [[1] * len(head) + [0] * (width - len(ids)) + [1] * len(ids) for ids in suffixes],
+        device=model.device,
+    )
+    processors = _logits_processors(top_k, top_p, temperature, do_sample)
+
+    rows = list(range(len(prompts)))
+    outputs = [[] for _ in prompts]
+    past_key_values = _expand_prefix(prefix, len(prompts)) if prefix is not None else None
+    past_length = len(head)
+    first_token_at = None
+    with torch.no_grad():
+        while rows:
+            out = _forward(model, input_ids, attention_mask, past_key_values, past_length, compiled=True)
+            past_key_values = out.past_key_values
+            past_length = input_ids.shape[1]
+            scores = processors(input_ids, out.logits[:, -1, :].float())
+            if do_sample:
+                probs = torch.nn.functional.softmax(scores, dim=-1)
+                next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+            else:
+                next_tokens = torch.argmax(scores, dim=-1)
+            if first_token_at is None:
+                first_token_at = step_at = time.monotonic()
+            elif profiled:
+                now = time.monotonic()
+                for profile in profiled:
+                    profile.step(now - step_at)
+                step_at = now
+
+            input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+            attention_mask = torch.cat(
+                [attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim=-1
+            )
+
+            keep = []
+            for pos, idx in enumerate(rows):
+                token = int(next_tokens[pos])
+                outputs[idx].append(token)
+                if streamers[idx] is not None:
+                    streamers[idx](token)
+                if token == eos_token_ids[idx] or len(outputs[idx]) >= max_new_tokens[idx]:
+                    continue
+                if stops[idx] and stops[idx].match(outputs[idx]):
+                    continue
+                keep.append(pos)
+            if len(keep) == len(rows):
+                continue
+
+            rows = [rows[pos] for pos in keep]
+            if rows:
+                index = torch.tensor(keep, device=input_ids.device)
+                input_ids = input_ids[index]
+                attention_mask = attention_mask[index]
+                past_key_values = _select_rows(past_key_values, index)
+
+    generated_at = time.monotonic()
+    generations = [
+        _finish(tokenizer, stops[idx], ids, eos_token_ids[idx])
+        for idx, ids in enumerate(outputs)
+    ]
+
+    finished_at = time.monotonic()
+    for profile in profiled:
+        _profile_stages(profile, started_at, tokenized_at, first_token_at, generated_at, finished_at)
+    metrics.observe_timing(
+        first_token_at - started_at,
+        finished_at - first_token_at,
+        sum(generation.tokens for generation in generations),
+    )
+    for ids, generation in zip(encoded, generations):
+        metrics.observe_generation(len(ids), generation.tokens, generation.finish_reason)
+    return generations
+
+
+def score(
+    tokenizer: AutoTokenizer,
+    model: AutoModelForCausalLM,
+    prompt: str,
+    candidates: List[str],
+    prefix=None,
+    chunk_size: int = 8,
+) -> List[dict]:
+    """Returns the log-likelihood of each candidate continuation of the prompt.
+
+    The tokens shared by every `prompt + candidate` are prefilled once, then all
+    candidates are scored together, `chunk_size` rows per forward pass. A
+    candidate is scored over every token past the shared ones, so the scores
+    stay comparable even when a candidate merges with the prompt's last token.
+    """
+    pad_token_id = tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = tokenizer.eos_token_id
+    encoded = [tokenizer.encode(prompt + candidate) for candidate in candidates]
+    prompt_ids = tokenizer.encode(prompt)
+    shared = 0
+    while shared < len(prompt_ids) and all(
+        len(ids) > shared and ids[shared] == prompt_ids[shared] for ids in encoded
+    ):
+        shared += 1
+    context = max(shared - 1, 0)
+
+    if prefix is not None and (len(prefix.input_ids) > context or not prefix.match_all(encoded)):
+        prefix = None
+    head = prefix.input_ids if prefix is not None else []
+
+    with torch.no_grad():
+        past_key_values = _expand_prefix(prefix, 1) if prefix is not None else None
+        if context > len(head):
+            out = _forward(
+                model,
+                torch.tensor([prompt_ids[:context]], device=model.device),
+                torch.ones((1, context), dtype=torch.long, device=model.device),
+                past_key_values,
+                len(head),
+            )
+            past_key_values = out.past_key_values
+            cache_cls = type(past_key_values)
+            past_key_values = _to_legacy_cache(past_key_values)
+        elif prefix is not None:
+            cache_cls = prefix.cache_cls
+            past_key_values = prefix.past_key_values
+
+        rests = [ids[context:] for ids in encoded]
+        scores = []
+        for start in range(0, len(rests), chunk_size):
+            chunk = rests[start:start + chunk_size]
+            width = max(len(ids) for ids in chunk)
+            input_ids = torch.tensor(
+                [prompt_ids[:context] + ids + [pad_token_id] * (width - len(ids)) for ids in chunk],
+                device=model.device,
+            )
+            attention_mask = torch.tensor(
+                [[1] * (context + len(ids)) + [0] * (width - len(ids)) for ids in chunk],
+                device=model.device,
+            )
+            chunk_past = None
+            if past_key_values is not None:
+                chunk_past = _from_legacy_cache(cache_cls, tuple(
+                    tuple(t.expand(len(chunk), *t.shape[1:]).contiguous() for t in layer)
+                    for layer in past_key_values
+                ))
+            out = _forward(model, input_ids, attention_mask, chunk_past, context)
+            logprobs = torch.log_softmax(out.logits.float(), dim=-1)
+
+            for row, ids in enumerate(chunk):
+                targets = torch.tensor(ids[1:], device=logprobs.device, dtype=torch.long)
+                picked = logprobs[row, :len(ids) - 1].gather(-1, targets[:, None])
+                scores.append({
+                    'candidate': candidates[start + row],
+                    'logprob': float(picked.sum()),
+                    'tokens': len(ids) - 1,
+                })
+    return scores
+
+
+class TextStreamer(object):
+    """Turns generated token ids into text chunks and hands them to a reader thread.
+
+    The whole sequence is decoded on every token so that multi-token characters
+    are only emitted once they are complete. Text that might be the start of a
+    stop string is held back until it is known not to be one.
+    """
+
+    def __init__(self, tokenizer: AutoTokenizer, stop: StopMatcher = None) -> None:
+        self.tokenizer = tokenizer
+        self.stop = stop or StopMatcher(tokenizer)
+        self.token_ids = []
+        self._offset = 0
+        self._queue = Queue()
+
+    def _emit(self, text: str):
+        chunk = text[self._offset:]
+        if chunk:
+            self._offset = len(text)
+            self._queue.put(chunk)
+
+    def __call__(self, token_id: int):
+        self.token_ids.append(token_id)
+        text = self.tokenizer.decode(self.token_ids, skip_special_tokens=True)
+        if text.endswith('\ufffd'):
+            return
+        truncated = self.stop.truncate(text)
+        if truncated == text:
+            truncated = text[:len(text) - self.stop.holdback(text)]
+        self._emit(truncated)
+
+    def end(self):
+        text = self.tokenizer.decode(self.token_ids, skip_special_tokens=True)
+        self._emit(self.stop.truncate(text))
+        self._queue.put(None)
+
+    def __iter__(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            yield chunk
 
 
 if __name__ == '__main__':
-    import os
     from dotenv import load_dotenv
     load_dotenv()
 
@@ -77,4 +893,4 @@ if __name__ == '__main__':
 
     prompt = "입력받은 숫자가 prime number 인지 검사하는 python 코드"
     generation = generate(tokenizer, model, prompt)
-    print(generation)
\ No newline at end of file
+    print(generation.text)
\ No newline at end of file
@@ -0,0 +1,130 @@
+import time
+import threading
+from typing import List
+
+from lib import chatbot
+from lib.logger import logger
+
+
+class LoadProgress(object):
+    """Tracks which phase of the model load pipeline is running and since when."""
+
+    PHASES = ('pending', 'loading', 'warmup', 'ready')
+
+    def __init__(self) -> None:
+        self.phase = 'pending'
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self.durations = {}
+        self._phase_started_at = None
+        self._lock = threading.Lock()
+
+    def set(self, phase: str):
+        with self._lock:
+            now = time.monotonic()
+            if self.started_at is None:
+                self.started_at = now
+            if self._phase_started_at is not None:
+                self.durations[self.phase] = now - self._phase_started_at
+            self.phase = phase
+            self._phase_started_at = now
+            if phase == 'ready':
+                self.finished_at = now
+        logger.info(f'load phase: {phase}')
+
+    def fail(self, exc: Exception):
+        with self._lock:
+            self.error = str(exc)
+            self.phase = 'failed'
+            self.finished_at = time.monotonic()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            if self.phase in self.PHASES:
+                progress = self.PHASES.index(self.phase) / (len(self.PHASES) - 1)
+            else:
+                progress = 0.0
+            elapsed = 0.0
+            if self.started_at is not None:
+                elapsed = (self.finished_at or time.monotonic()) - self.started_at
+            return {
+                'phase': self.phase,
+                'progress': progress,
+                'elapsed': elapsed,
+                'durations': dict(self.durations),
+                'error': self.error,
+            }
+
+
+def load(
+    model_name: str,
+    cache_dir: str,
+    load_in_8bit: bool = False,
+    snapshot_dir: str = None,
+    warmup_tokens: int = 4,
+    progress: LoadProgress = None,
+    cpu_dtype: str = 'float16',
+    cpu_quantize: bool = False,
+    draft_model_name: str = '',
+    draft_num_tokens: int = 5,
+    draft_min_accept_rate: float = 0.3,
+    device_name: str = '',
+    attn_implementation: str = '',
+    compile_decode: bool = False,
+    prompt_buckets: List[int] = None,
+):
+    """Loads the model and runs a short warmup generation so the first request is not slow."""
+    progress = progress or LoadProgress()
+    progress.set('loading')
+    tokenizer, model = chatbot.setup_model(
+        model_name=model_name,
+        cache_dir=cache_dir,
+        load_in_8bit=load_in_8bit,
+        snapshot_dir=snapshot_dir,
+        cpu_dtype=cpu_dtype,
+        cpu_quantize=cpu_quantize,
+        draft_model_name=draft_model_name,
+        draft_num_tokens=draft_num_tokens,
+        draft_min_accept_rate=draft_min_accept_rate,
+        device_name=device_name,
+        attn_implementation=attn_implementation,
+    )
+    chatbot.optimize(model, compile_decode, prompt_buckets)
+    return warmup(tokenizer, model, warmup_tokens, progress)
+
+
+def warmup(tokenizer, model, warmup_tokens: int = 4, progress: LoadProgress = None):
+    """Runs the warmup generation for a model that is already loaded.
+
+    An `optimize`d model is also run once per prompt bucket, so every prefill
+    shape is compiled before the model serves.
+    """
+    progress = progress or LoadProgress()
+    progress.set('warmup')
+    if warmup_tokens > 0:
+        chatbot.generate(tokenizer, model, 'Hello', max_new_tokens=warmup_tokens)
+        for bucket in getattr(model, 'prompt_buckets', None) or []:
+            started_at = time.monotonic()
+            # an eos id that never comes, so the decode step runs as well
+            chatbot.generate_batch(
+                tokenizer, model, [''], [max(warmup_tokens, 2)], [-1],
+                prompt_ids=[[tokenizer.eos_token_id or 0] * bucket],
+            )
+            logger.info(f'warmed up prompt bucket {bucket} in {time.monotonic() - started_at:.1f}s')
+
+    progress.set('ready')
+    return tokenizer, model
+
+
+def convert_snapshot(tokenizer, model, snapshot_dir: str, load_in_8bit: bool = False, cpu_quantize: bool = False):
+    """Writes a local snapshot once, so that later cold starts load from it."""
+    if not snapshot_dir or chatbot.has_snapshot(snapshot_dir):
+        return
+    if load_in_8bit or cpu_quantize:
+        logger.warning('quantized models are not snapshotted')
+        return
+    started_at = time.monotonic()
+    logger.info(f'saving snapshot to: {snapshot_dir}')
+    chatbot.save_snapshot(tokenizer, model, snapshot_dir)
+    logger.info(f'snapshot saved in {time.monotonic() - started_at:.1f}s')
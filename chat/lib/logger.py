@@ -1,12 +1,36 @@
+import os
 import sys
+import atexit
 import logging
+from queue import Queue
+from logging.handlers import QueueHandler, QueueListener
 from pythonjsonlogger import jsonlogger
 
+from lib.telemetry import PROFILE
+
 
 logger = logging.getLogger('api')
-logger.setLevel(logging.INFO)
+logger.setLevel(PROFILE.log_level)
 
 logHandler = logging.StreamHandler(sys.stdout)
 formatter = jsonlogger.JsonFormatter()
 logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
+if PROFILE.async_logging:
+    # JSON formatting and the write to stdout happen on the listener thread
+    log_queue = Queue()
+    listener = QueueListener(log_queue, logHandler)
+    listener.start()
+    atexit.register(listener.stop)
+    queueHandler = QueueHandler(log_queue)
+    logger.addHandler(queueHandler)
+
+    def _restart_listener():
+        # the listener thread does not survive a fork, and the queue may be left locked
+        global log_queue, listener
+        log_queue = queueHandler.queue = Queue()
+        listener = QueueListener(log_queue, logHandler)
+        listener.start()
+
+    os.register_at_fork(after_in_child=_restart_listener)
+else:
+    logger.addHandler(logHandler)
@@ -0,0 +1,221 @@
+import bisect
+import resource
+import threading
+from typing import Callable, Iterable, Tuple
+
+import torch
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (1, 4, 16, 32, 64, 128, 256, 512, 1024, 2048)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+BYTE_BUCKETS = tuple(2 ** power for power in range(20, 36, 2))  # 1MiB to 16GiB
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _CounterChild(object):
+    def __init__(self) -> None:
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name: str, labels: str):
+        yield f'{name}{labels} {self.value}'
+
+
+class _GaugeChild(_CounterChild):
+    def set(self, value: float):
+        self.value = value
+
+
+class _HistogramChild(object):
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name: str, names: Tuple[str, ...], values: Tuple[str, ...]):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            labels = _format_labels(names, values, 'le="' + le + '"')
+            yield f'{name}_bucket{labels} {cumulative}'
+        yield f'{name}_sum{_format_labels(names, values)} {total}'
+        yield f'{name}_count{_format_labels(names, values)} {cumulative}'
+
+
+class Metric(object):
+    """A metric family whose children are bound to label values once and reused.
+
+    Bind children at import time, `labels()` is not meant for the request path.
+    """
+
+    def __init__(self, kind: str, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets=None) -> None:
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets) if buckets else None
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.label_names:
+            self._default = self.labels()
+
+    def _new_child(self):
+        if self.kind == 'histogram':
+            return _HistogramChild(self.buckets)
+        if self.kind == 'gauge':
+            return _GaugeChild()
+        return _CounterChild()
+
+    def labels(self, *values: str):
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self._new_child()
+            return child
+
+    def inc(self, amount: float = 1.0):
+        self._default.inc(amount)
+
+    def set(self, value: float):
+        self._default.set(value)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def samples(self):
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in children:
+            if self.kind == 'histogram':
+                yield from child.samples(self.name, self.label_names, values)
+            else:
+                yield from child.samples(self.name, _format_labels(self.label_names, values))
+
+
+class _Callback(object):
+    def __init__(self, kind: str, name: str, documentation: str, labels: Tuple[str, ...], collect: Callable) -> None:
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.collect = collect
+
+    def samples(self):
+        for values, value in self.collect():
+            yield f'{self.name}{_format_labels(self.label_names, values)} {value}'
+
+
+class Registry(object):
+    """Holds the metric families and renders them in the Prometheus text format."""
+
+    def __init__(self) -> None:
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Metric:
+        return self._register(Metric('counter', name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Metric:
+        return self._register(Metric('gauge', name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, buckets, labels: Tuple[str, ...] = ()) -> Metric:
+        return self._register(Metric('histogram', name, documentation, labels, buckets))
+
+    def callback(self, kind: str, name: str, documentation: str, collect: Callable[[], Iterable], labels: Tuple[str, ...] = ()):
+        """Registers values read at scrape time, `collect` yields `(label_values, value)` pairs."""
+        return self._register(_Callback(kind, name, documentation, labels, collect))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+QUEUE_WAIT = REGISTRY.histogram(
+    'chat_queue_wait_seconds', 'Time a request waited in the admission queue', LATENCY_BUCKETS, ('priority',))
+BATCH_SIZE = REGISTRY.histogram(
+    'chat_batch_size', 'Requests dispatched together in one batch', SIZE_BUCKETS)
+PREFILL = REGISTRY.histogram(
+    'chat_prefill_seconds', 'Prompt prefill time up to the first generated token', LATENCY_BUCKETS)
+DECODE = REGISTRY.histogram(
+    'chat_decode_seconds', 'Decode time after the first generated token', LATENCY_BUCKETS)
+PROMPT_TOKENS = REGISTRY.histogram(
+    'chat_prompt_tokens', 'Prompt length in tokens', TOKEN_BUCKETS)
+GENERATED_TOKENS = REGISTRY.histogram(
+    'chat_generated_tokens', 'Generated tokens per sequence', TOKEN_BUCKETS)
+TOKENS_PER_SECOND = REGISTRY.histogram(
+    'chat_tokens_per_second', 'Generated tokens per second of one generate call', RATE_BUCKETS)
+FINISHED = REGISTRY.counter(
+    'chat_generations_total', 'Finished generations', ('finish_reason',))
+FINISHED_BY_REASON = {reason: FINISHED.labels(reason) for reason in ('eos', 'stop', 'length')}
+GENERATION_MEMORY = REGISTRY.histogram(
+    'chat_generation_memory_bytes', 'Estimated memory of one generation and measured peak of one batch', BYTE_BUCKETS, ('kind',))
+GENERATION_MEMORY_BY_KIND = {kind: GENERATION_MEMORY.labels(kind) for kind in ('estimated', 'peak')}
+MODEL_BYTES = REGISTRY.gauge(
+    'chat_model_parameter_bytes', 'Bytes held by the model parameters and buffers', ('model',))
+
+
+def observe_generation(prompt_tokens: int, generated_tokens: int, finish_reason: str):
+    PROMPT_TOKENS.observe(prompt_tokens)
+    GENERATED_TOKENS.observe(generated_tokens)
+    FINISHED_BY_REASON[finish_reason].inc()
+
+
+def observe_timing(prefill: float, decode: float, generated_tokens: int):
+    PREFILL.observe(prefill)
+    DECODE.observe(decode)
+    if prefill + decode > 0:
+        TOKENS_PER_SECOND.observe(generated_tokens / (prefill + decode))
+
+
+def set_model(name: str, parameter_bytes: int):
+    MODEL_BYTES.labels(name).set(parameter_bytes)
+
+
+def _cuda_memory():
+    if torch.cuda.is_available():
+        yield ('allocated',), torch.cuda.memory_allocated()
+        yield ('reserved',), torch.cuda.memory_reserved()
+        yield ('max_allocated',), torch.cuda.max_memory_allocated()
+
+
+REGISTRY.callback('gauge', 'chat_cuda_memory_bytes', 'CUDA memory held by the process', _cuda_memory, ('kind',))
+
+
+def _peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    yield (), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+REGISTRY.callback('gauge', 'chat_process_peak_rss_bytes', 'Peak resident memory of the process', _peak_rss)
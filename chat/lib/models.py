@@ -0,0 +1,151 @@
+import json
+from typing import Dict, List, NamedTuple
+
+import torch
+
+from lib import chatbot, loader
+from lib.logger import logger
+from lib.prefix_cache import PrefixCache
+from lib.scheduler import BatchScheduler
+from lib.templates import TemplateRegistry
+
+DEFAULT_MODEL = 'default'
+
+
+class ModelSpec(NamedTuple):
+    model_name: str
+    device: str = ''  # the default device when empty
+    cpu_dtype: str = 'float16'
+    cpu_quantize: bool = False
+    load_in_8bit: bool = False
+    attn_implementation: str = ''
+    compile_decode: bool = False
+    prompt_buckets: List[int] = []
+
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+class UnknownModel(Exception):
+    def __init__(self, name: str) -> None:
+        super().__init__(f'unknown model: {name}')
+        self.name = name
+
+
+def parse_specs(value: str) -> Dict[str, ModelSpec]:
+    """Parses a JSON object of model names to `ModelSpec` fields, e.g. `{"small": {"model_name": "..."}}`."""
+    if not value:
+        return {}
+    return {name: ModelSpec(**fields) for name, fields in json.loads(value).items()}
+
+
+def parameter_bytes(model) -> int:
+    return sum(
+        t.numel() * t.element_size()
+        for t in list(model.parameters()) + list(model.buffers())
+    )
+
+
+def bytes_per_parameter(spec: ModelSpec) -> int:
+    if (spec.device or chatbot.device) == 'cuda':
+        return 1 if spec.load_in_8bit else 2
+    if spec.cpu_quantize:
+        # loaded as float32 before it is quantized
+        return 4
+    return torch.tensor([], dtype=chatbot.CPU_DTYPES[spec.cpu_dtype]).element_size()
+
+
+def estimate_bytes(spec: ModelSpec, cache_dir: str) -> int:
+    """Estimates the peak parameter bytes of loading a model, from its config only."""
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    config = AutoConfig.from_pretrained(spec.model_name, cache_dir=cache_dir)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config)
+    return sum(p.numel() for p in model.parameters()) * bytes_per_parameter(spec)
+
+
+def available_bytes(device: str) -> int:
+    if device == 'cuda':
+        return torch.cuda.mem_get_info()[0]
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class ServedModel(object):
+    """One named model with its own tokenizer, scheduler, prefix cache and templates."""
+
+    def __init__(self, name: str, spec: ModelSpec) -> None:
+        self.name = name
+        self.spec = spec
+        self.progress = loader.LoadProgress()
+        self.tokenizer = None
+        self.model = None
+        self.scheduler = None
+        self.prefix_cache = None
+        self.templates = None
+        self.parameter_bytes = 0
+        self.is_ready = False
+
+    def serve(self, tokenizer, model, prefix_cache_size: int = 8, **scheduler_options):
+        """Starts the scheduler of a loaded model, after which it takes requests."""
+        self.tokenizer = tokenizer
+        self.model = model
+        self.parameter_bytes = parameter_bytes(model)
+        self.prefix_cache = PrefixCache(
+            tokenizer=tokenizer,
+            model=model,
+            max_entries=prefix_cache_size,
+        )
+        self.scheduler = BatchScheduler(
+            tokenizer=tokenizer,
+            model=model,
+            prefix_cache=self.prefix_cache,
+            **scheduler_options,
+        )
+        self.scheduler.start()
+        self.templates = TemplateRegistry(tokenizer)
+        self.is_ready = True
+
+    def load(self, cache_dir: str, budget: int = 0, loaded: int = 0, warmup_tokens: int = 4):
+        """Loads the model once it fits in the memory budget, returns the tokenizer and the model."""
+        self.check_budget(cache_dir, budget, loaded)
+        return loader.load(
+            model_name=self.spec.model_name,
+            cache_dir=cache_dir,
+            load_in_8bit=self.spec.load_in_8bit,
+            warmup_tokens=warmup_tokens,
+            progress=self.progress,
+            cpu_dtype=self.spec.cpu_dtype,
+            cpu_quantize=self.spec.cpu_quantize,
+            device_name=self.spec.device,
+            attn_implementation=self.spec.attn_implementation,
+            compile_decode=self.spec.compile_decode,
+            prompt_buckets=self.spec.prompt_buckets,
+        )
+
+    def check_budget(self, cache_dir: str, budget: int, loaded: int):
+        """Raises MemoryBudgetExceeded if loading this model would exceed `budget` or the free memory."""
+        estimate = estimate_bytes(self.spec, cache_dir)
+        available = available_bytes(self.spec.device or chatbot.device)
+        logger.info(f'model {self.name} needs about {estimate} bytes, {loaded} are loaded, {available} are available')
+        if budget > 0 and loaded + estimate > budget:
+            raise MemoryBudgetExceeded(f'model {self.name} needs {estimate} bytes, over the budget of {budget} with {loaded} loaded')
+        if estimate > available:
+            raise MemoryBudgetExceeded(f'model {self.name} needs {estimate} bytes, only {available} are available')
+
+    def stats(self) -> dict:
+        return {
+            'status': self.is_ready,
+            'model_name': self.spec.model_name,
+            'device': self.spec.device or chatbot.device,
+            **self.progress.to_dict(),
+            'parameter_bytes': self.parameter_bytes,
+            'queue': self.scheduler.stats() if self.scheduler is not None else None,
+        }
+
@@ -2,20 +2,28 @@ import os
 from opentelemetry import trace, propagate
 from opentelemetry.propagators.aws import AwsXRayPropagator
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.sampling import ALWAYS_ON
+from opentelemetry.sdk.trace import SpanLimits, TracerProvider
+from opentelemetry.sdk.trace.sampling import ALWAYS_ON, ParentBased, TraceIdRatioBased
 from opentelemetry.sdk.extension.aws.resource.ecs import AwsEcsResourceDetector
 from opentelemetry.sdk.resources import get_aggregated_resources
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
 from opentelemetry.sdk.extension.aws.trace import AwsXRayIdGenerator
 from opentelemetry.instrumentation.requests import RequestsInstrumentor
 
+from lib.telemetry import PROFILE
+
 endpoint = os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT', '0.0.0.0:4317')
 otlp_exporter = OTLPSpanExporter(endpoint=endpoint)
 span_processor = BatchSpanProcessor(otlp_exporter)
+if PROFILE.sample_ratio >= 1:
+    sampler = ALWAYS_ON
+else:
+    # follow the caller's decision so a trace is kept or dropped as a whole
+    sampler = ParentBased(TraceIdRatioBased(PROFILE.sample_ratio))
 trace.set_tracer_provider(
     TracerProvider(
-        sampler=ALWAYS_ON,
+        sampler=sampler,
+        span_limits=SpanLimits(max_attribute_length=PROFILE.max_attribute_length or None),
         resource=get_aggregated_resources(
             [ AwsEcsResourceDetector() ]
         ),
@@ -31,4 +39,19 @@ tracer = trace.get_tracer('chatbot')
 
 
 def context_from_headers(headers):
-    return propagate.get_global_textmap().extract(headers)
\ No newline at end of file
+    return propagate.get_global_textmap().extract(headers)
+
+
+def set_payload(span, key: str, value):
+    """Sets a payload attribute, computing it only when the span is recorded.
+
+    `value` may be a callable returning the value. Payloads are skipped when the
+    telemetry profile leaves them out and capped at its attribute length.
+    """
+    if not PROFILE.payloads or not span.is_recording():
+        return
+    if callable(value):
+        value = value()
+    if PROFILE.max_attribute_length and len(value) > PROFILE.max_attribute_length:
+        value = value[:PROFILE.max_attribute_length]
+    span.set_attribute(key, value)
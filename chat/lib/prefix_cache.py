@@ -0,0 +1,93 @@
+import threading
+from typing import List, Optional
+from collections import OrderedDict
+
+from lib import chatbot
+from lib.logger import logger
+
+
+class CachedPrefix(object):
+    def __init__(self, text: str, input_ids: List[int], past_key_values, cache_cls) -> None:
+        self.text = text
+        self.input_ids = input_ids
+        self.past_key_values = past_key_values
+        self.cache_cls = cache_cls
+        self.hits = 0
+        self.misses = 0
+
+    def match_all(self, encoded: List[List[int]]) -> bool:
+        size = len(self.input_ids)
+        matched = all(
+            len(ids) > size and ids[:size] == self.input_ids for ids in encoded
+        )
+        if matched:
+            self.hits += len(encoded)
+        else:
+            self.misses += len(encoded)
+        return matched
+
+
+class PrefixCache(object):
+    """Keeps the prefill attention cache of static prompt prefixes in memory.
+
+    A prefix is registered the first time a request names it, and every later
+    prompt starting with a registered prefix reuses its cache. Entries are
+    evicted least recently used first.
+    """
+
+    def __init__(self, tokenizer, model, max_entries: int = 8) -> None:
+        self.tokenizer = tokenizer
+        self.model = model
+        self.max_entries = max(1, max_entries)
+        self.unmatched = 0
+        self._entries = OrderedDict()
+        self._known = []
+        self._lock = threading.Lock()
+
+    def match(self, prompt: str, prefix: str = '') -> Optional[str]:
+        """Returns the longest known prefix of the prompt, registering `prefix` if it is new."""
+        with self._lock:
+            if prefix and prompt.startswith(prefix) and prefix not in self._known:
+                self._known.append(prefix)
+                self._known.sort(key=len, reverse=True)
+            for text in self._known:
+                if prompt.startswith(text):
+                    return text
+            self.unmatched += 1
+            return None
+
+    def get(self, text: str) -> CachedPrefix:
+        """Returns the cached prefix, running prefill for it first if needed.
+
+        Must be called from the thread that owns the model.
+        """
+        with self._lock:
+            entry = self._entries.get(text)
+            if entry is not None:
+                self._entries.move_to_end(text)
+                return entry
+
+        logger.info(f'prefilling prefix of {len(text)} characters')
+        input_ids, past_key_values, cache_cls = chatbot.encode_prefix(self.tokenizer, self.model, text)
+        entry = CachedPrefix(text, input_ids, past_key_values, cache_cls)
+        with self._lock:
+            self._entries[text] = entry
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                if evicted in self._known:
+                    self._known.remove(evicted)
+        return entry
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = list(self._entries.values())
+            unmatched = self.unmatched
+        return {
+            'entries': [{
+                'tokens': len(entry.input_ids),
+                'hits': entry.hits,
+                'misses': entry.misses,
+            } for entry in entries],
+            'hits': sum(entry.hits for entry in entries),
+            'misses': sum(entry.misses for entry in entries) + unmatched,
+        }
@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import uuid
+import random
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import List, Optional
+
+import torch
+
+from lib.logger import logger
+
+_NULL = nullcontext()
+# X-Profile values that turn profiling on, anything else leaves it to sampling
+PROFILE_HEADER_VALUES = ('1', 'true', 'torch')
+
+
+class Profile(object):
+    """Timed stages of one profiled request.
+
+    Requests that are not profiled carry no Profile at all, so every hook on
+    the hot path is a single `profile is not None` check.
+    """
+
+    def __init__(self, profile_id: str, torch_trace: bool = False) -> None:
+        self.profile_id = profile_id
+        self.torch_trace = torch_trace
+        self.trace_path = None
+        self.stages = []  # (name, seconds) in the order they ran
+        self.decode_steps = []
+
+    def add(self, name: str, seconds: float):
+        self.stages.append((name, seconds))
+
+    @contextmanager
+    def stage(self, name: str):
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - started_at)
+
+    def step(self, seconds: float):
+        self.decode_steps.append(seconds)
+
+    def to_dict(self) -> dict:
+        steps = self.decode_steps
+        return {
+            'id': self.profile_id,
+            'stages': [{'name': name, 'seconds': seconds} for name, seconds in self.stages],
+            'decode_steps': {
+                'count': len(steps),
+                'mean_seconds': sum(steps) / len(steps) if steps else 0.0,
+                'max_seconds': max(steps) if steps else 0.0,
+            },
+            'trace': self.trace_path,
+        }
+
+    def add_events(self, span):
+        for name, seconds in self.stages:
+            span.add_event(f'stage.{name}', {'seconds': seconds})
+        if self.decode_steps:
+            summary = self.to_dict()['decode_steps']
+            span.add_event('stage.decode_steps', {
+                'count': summary['count'],
+                'mean_seconds': summary['mean_seconds'],
+                'max_seconds': summary['max_seconds'],
+            })
+
+
+def stage(profile: Optional[Profile], name: str):
+    """Times a stage of `profile`, a shared no-op context when the request is not profiled."""
+    return profile.stage(name) if profile is not None else _NULL
+
+
+def start(header: str, sample_rate: float, span) -> Optional[Profile]:
+    """Returns a Profile when the request asks for one or is sampled, None otherwise.
+
+    Only `X-Profile: 1`, `true` or `torch` ask for one, and `torch` also
+    captures a torch profiler trace.
+    """
+    header = header.strip().lower()
+    if header in PROFILE_HEADER_VALUES:
+        torch_trace = header == 'torch'
+    elif sample_rate > 0 and random.random() < sample_rate:
+        torch_trace = False
+    else:
+        return None
+    span_context = span.get_span_context()
+    if span_context.is_valid:
+        # the front calls the chat service several times within one trace, the span tells them apart
+        profile_id = f'{span_context.trace_id:032x}-{span_context.span_id:016x}'
+    else:
+        profile_id = uuid.uuid4().hex
+    return Profile(profile_id, torch_trace)
+
+
+@contextmanager
+def torch_trace(profiles: List[Profile]):
+    """Captures one torch profiler trace of the enclosed work for every profile that asked for it."""
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities) as prof:
+        yield
+    for profile in profiles:
+        try:
+            prof.export_chrome_trace(profile.trace_path)
+        except Exception:
+            logger.exception(f'failed to write the trace of profile {profile.profile_id}')
+
+
+class ProfileStore(object):
+    """Writes profiles to a local directory holding at most `max_files`, removing the oldest first."""
+
+    def __init__(self, path: str, max_files: int = 100) -> None:
+        self.path = path
+        self.max_files = max(1, max_files)
+        self._lock = threading.Lock()
+
+    def trace_path(self, profile_id: str) -> str:
+        os.makedirs(self.path, exist_ok=True)
+        return os.path.join(self.path, f'{profile_id}.trace.json')
+
+    def save(self, profile: Profile):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, f'{profile.profile_id}.json'), 'w') as f:
+            json.dump(profile.to_dict(), f)
+        self._rotate()
+
+    def _rotate(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.path):
+                path = os.path.join(self.path, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    continue
+            entries.sort()
+            for _, path in entries[:max(0, len(entries) - self.max_files)]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
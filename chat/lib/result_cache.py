@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from lib.chatbot import Generation
+from lib.logger import logger
+
+
+class ResultCache(object):
+    """Caches results of deterministic (non-sampling and scoring) requests in process.
+
+    Entries are keyed on the exact prompt plus every request parameter, since
+    prompts differing only in whitespace or Unicode normalization tokenize,
+    and so generate, differently. They are evicted least recently used first
+    once `max_entries` is reached, and expire after `ttl` seconds. When `path`
+    is set, entries are loaded from and saved to that file so they survive
+    restarts.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600, path: str = '') -> None:
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cacheable(params: dict) -> bool:
+        return not params.get('do_sample', False)
+
+    @staticmethod
+    def key(params: dict) -> str:
+        params = dict(params)
+        params.pop('prefix', None)
+        params.pop('priority', None)
+        payload = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, params: dict):
+        key = self.key(params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, params: dict, value):
+        self._put(self.key(params), time.time() + self.ttl, value)
+
+    def _put(self, key: str, expires_at: float, value):
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        now = time.time()
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry['expires_at'] <= now:
+                    continue
+                value = entry['value']
+                if entry['type'] == 'generation':
+                    value = Generation(**value)
+                self._put(entry['key'], entry['expires_at'], value)
+        logger.info(f'loaded {len(self._entries)} cached results from: {self.path}')
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            entries = list(self._entries.items())
+        staging_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(staging_path, 'w', encoding='utf-8') as f:
+            for key, (expires_at, value) in entries:
+                is_generation = isinstance(value, Generation)
+                f.write(json.dumps({
+                    'key': key,
+                    'expires_at': expires_at,
+                    'type': 'generation' if is_generation else 'json',
+                    'value': value._asdict() if is_generation else value,
+                }, ensure_ascii=False) + '\n')
+        os.replace(staging_path, self.path)
+        logger.info(f'saved {len(entries)} cached results to: {self.path}')
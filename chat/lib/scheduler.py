@@ -0,0 +1,289 @@
+import math
+import time
+import threading
+from concurrent.futures import Future
+
+from lib import chatbot, metrics, profiling
+from lib.budget import GenerationBudget, PeakMemory
+from lib.logger import logger
+from lib.prefix_cache import PrefixCache
+
+
+PRIORITIES = ('high', 'low')
+_QUEUE_WAIT = [metrics.QUEUE_WAIT.labels(name) for name in PRIORITIES]
+
+
+class QueueFull(Exception):
+    def __init__(self, priority: str, retry_after: float) -> None:
+        super().__init__(f'the {priority} priority queue is full, retry after {retry_after:.1f}s')
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+class GenerationRequest(object):
+    def __init__(self, params: dict, key: tuple, streamer=None, prefix: str = None, task=None, priority: int = 0, profile=None, memory: int = 0) -> None:
+        self.params = params
+        self.key = key
+        self.streamer = streamer
+        self.prefix = prefix
+        self.task = task
+        self.priority = priority
+        self.profile = profile
+        self.memory = memory  # estimated bytes, 0 when there is no memory budget
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class BatchScheduler(threading.Thread):
+    """Queues generation requests and runs compatible ones as a single batch.
+
+    Requests are compatible when they share the sampling parameters, the cached
+    prompt prefix, if any, and their prompt lengths fall into the same bucket.
+    A batch is dispatched once it is full or the oldest request has waited
+    `max_wait_ms`.
+
+    Admission is bounded: every priority lane holds at most `max_queue`
+    requests and rejects more with QueueFull. High priority requests, scoring
+    and short deterministic generations by default, are always dispatched
+    before low priority ones.
+
+    With a `memory_budget` in bytes, every generation is estimated before it
+    is queued and clamped or rejected with GenerationTooLarge when it cannot
+    fit alone, as `memory_policy` says. A batch then only takes the requests
+    that fit the budget together, the others stay queued for the next one.
+    Once done, a future's `memory` attribute holds the estimated bytes, the
+    `max_new_tokens` it ran with and the peak bytes of the batch it ran in.
+    """
+
+    def __init__(self,
+        tokenizer,
+        model,
+        max_batch_size: int = 1,
+        max_wait_ms: int = 10,
+        length_bucket: int = 64,
+        prefix_cache: PrefixCache = None,
+        max_queue: int = 64,
+        short_max_new_tokens: int = 64,
+        memory_budget: int = 0,
+        memory_policy: str = 'clamp',
+    ) -> None:
+        super().__init__(daemon=True)
+        self.tokenizer = tokenizer
+        self.model = model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.length_bucket = max(1, length_bucket)
+        self.prefix_cache = prefix_cache
+        self.max_queue = max(1, max_queue)
+        self.short_max_new_tokens = short_max_new_tokens
+        self.budget = GenerationBudget(model, memory_budget, memory_policy) if memory_budget > 0 else None
+        self._lanes = [[] for _ in PRIORITIES]
+        self._running = 0
+        self._batch_seconds = None
+        self._cond = threading.Condition()
+
+    def _key(self, params: dict, prefix: str, length: int) -> tuple:
+        if params['num_return_sequences'] != 1:
+            # never batched, a unique key keeps it in a batch of its own
+            return (object(),)
+        if params['do_sample']:
+            sampling = (True, params['top_k'], params['top_p'], params['temperature'])
+        else:
+            sampling = (False,)
+        return sampling + (prefix, length // self.length_bucket)
+
+    def _match_prefix(self, prompt: str, prefix: str):
+        if self.prefix_cache is None:
+            return None
+        return self.prefix_cache.match(prompt, prefix)
+
+    def _priority(self, params: dict, priority: str) -> int:
+        if priority:
+            return PRIORITIES.index(priority)
+        if not params['do_sample'] and params['max_new_tokens'] <= self.short_max_new_tokens:
+            return 0
+        return 1
+
+    def _estimated_wait(self, priority: int) -> float:
+        if self._batch_seconds is None:
+            return 0.0
+        ahead = sum(len(lane) for lane in self._lanes[:priority + 1])
+        return (math.ceil(ahead / self.max_batch_size) + self._running) * self._batch_seconds
+
+    def _enqueue(self, request: GenerationRequest) -> Future:
+        with self._cond:
+            if len(self._lanes[request.priority]) >= self.max_queue:
+                raise QueueFull(PRIORITIES[request.priority], max(self._estimated_wait(request.priority), 1.0))
+            self._lanes[request.priority].append(request)
+            self._cond.notify()
+        return request.future
+
+    def submit(self, streamer=None, prefix: str = '', priority: str = '', profile=None, **params) -> Future:
+        if streamer is not None:
+            # a stream carries a single sequence, which also makes it batchable
+            params['num_return_sequences'] = 1
+        if not params['do_sample']:
+            # greedy sequences are all the same, one is enough
+            params['num_return_sequences'] = 1
+        prompt_ids = params.get('prompt_ids')
+        length = len(prompt_ids) if prompt_ids is not None else len(self.tokenizer.encode(params['prompt']))
+        memory = self.budget.admit(params, length) if self.budget is not None else 0
+        prefix = self._match_prefix(params['prompt'], prefix)
+        return self._enqueue(GenerationRequest(
+            params, self._key(params, prefix, length), streamer, prefix,
+            priority=self._priority(params, priority),
+            profile=profile,
+            memory=memory,
+        ))
+
+    def submit_score(self, prompt: str, candidates: list, prefix: str = '') -> Future:
+        prefix = self._match_prefix(prompt, prefix)
+
+        def task():
+            entry = self.prefix_cache.get(prefix) if prefix is not None else None
+            return chatbot.score(
+                tokenizer=self.tokenizer,
+                model=self.model,
+                prompt=prompt,
+                candidates=candidates,
+                prefix=entry,
+            )
+
+        # scoring is already batched over the candidates, so it runs on its own
+        return self._enqueue(GenerationRequest({}, (object(),), prefix=prefix, task=task, priority=0))
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'queue_depth': {name: len(lane) for name, lane in zip(PRIORITIES, self._lanes)},
+                'max_queue': self.max_queue,
+                'estimated_wait': {
+                    name: self._estimated_wait(priority) for priority, name in enumerate(PRIORITIES)
+                },
+            }
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                while not any(self._lanes):
+                    self._cond.wait()
+
+                head = next(lane[0] for lane in self._lanes if lane)
+                deadline = head.enqueued_at + self.max_wait
+                while True:
+                    candidates = [r for lane in self._lanes for r in lane if r.key == head.key][:self.max_batch_size]
+                    batch = self.budget.fit(candidates) if self.budget is not None else candidates
+                    remaining = deadline - time.monotonic()
+                    if len(batch) >= self.max_batch_size or len(batch) < len(candidates) or remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                for request in batch:
+                    self._lanes[request.priority].remove(request)
+                # a request whose caller went away while it was queued is cancelled, and dropped here
+                batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+                if batch:
+                    self._running = 1
+                    return batch
+
+    def _finish_batch(self, started_at: float):
+        elapsed = time.monotonic() - started_at
+        with self._cond:
+            self._running = 0
+            if self._batch_seconds is None:
+                self._batch_seconds = elapsed
+            else:
+                self._batch_seconds = 0.8 * self._batch_seconds + 0.2 * elapsed
+
+    def _assisted(self, params: dict) -> bool:
+        """Returns whether a lone request with a cached prefix is drafted, worth more than the prefill it saves.
+
+        Like `chatbot.generate` does for requests without a prefix, this counts
+        down a paused assistant's cooldown, so drafting resumes for them too.
+        """
+        assistant = getattr(self.model, 'assistant', None)
+        return (assistant is not None and not params['do_sample']
+            and params['num_return_sequences'] == 1 and assistant.start())
+
+    def _generate(self, batch):
+        head = batch[0]
+        if head.task is not None:
+            return [head.task()]
+        if len(batch) == 1 and head.streamer is None and (head.prefix is None or self._assisted(head.params)):
+            return [chatbot.generate(
+                tokenizer=self.tokenizer,
+                model=self.model,
+                profile=head.profile,
+                **batch[0].params,
+            )]
+
+        params = head.params
+        prefix = None
+        if head.prefix is not None:
+            prefix = self.prefix_cache.get(head.prefix)
+        return chatbot.generate_batch(
+            tokenizer=self.tokenizer,
+            model=self.model,
+            prompts=[r.params['prompt'] for r in batch],
+            prompt_ids=[r.params.get('prompt_ids') for r in batch],
+            max_new_tokens=[r.params['max_new_tokens'] for r in batch],
+            eos_token_ids=[r.params['eos_token_id'] for r in batch],
+            top_k=params['top_k'],
+            top_p=params['top_p'],
+            temperature=params['temperature'],
+            do_sample=params['do_sample'],
+            streamers=[r.streamer for r in batch],
+            stops=[chatbot.StopMatcher(
+                self.tokenizer,
+                r.params.get('stop'),
+                r.params.get('stop_token_ids'),
+            ) for r in batch],
+            prefix=prefix,
+            profiles=[r.profile for r in batch],
+        )
+
+    def run(self):
+        while True:
+            batch = self._next_batch()
+            logger.info('dispatching batch of size: %d', len(batch))
+            started_at = time.monotonic()
+            metrics.BATCH_SIZE.observe(len(batch))
+            traced = []
+            for request in batch:
+                _QUEUE_WAIT[request.priority].observe(started_at - request.enqueued_at)
+                if request.profile is not None:
+                    request.profile.add('queue', started_at - request.enqueued_at)
+                    if request.profile.trace_path:
+                        traced.append(request.profile)
+            peak_memory = PeakMemory(self.model.device) if self.budget is not None else None
+            if peak_memory is not None:
+                peak_memory.start()
+            try:
+                if traced:
+                    with profiling.torch_trace(traced):
+                        generations = self._generate(batch)
+                else:
+                    generations = self._generate(batch)
+            except Exception as exc:
+                logger.exception('failed to generate batch')
+                for request in batch:
+                    request.future.set_exception(exc)
+                continue
+            finally:
+                self._finish_batch(started_at)
+                for request in batch:
+                    if request.streamer is not None:
+                        request.streamer.end()
+
+            if peak_memory is not None:
+                peak = peak_memory.stop()
+                metrics.GENERATION_MEMORY_BY_KIND['peak'].observe(peak)
+            for request, generation in zip(batch, generations):
+                if self.budget is not None and request.task is None:
+                    request.future.memory = {
+                        'estimated_bytes': request.memory,
+                        'peak_bytes': peak,
+                        'max_new_tokens': request.params['max_new_tokens'],
+                    }
+                    metrics.GENERATION_MEMORY_BY_KIND['estimated'].observe(request.memory)
+                request.future.set_result(generation)
@@ -0,0 +1,122 @@
+import threading
+from string import Formatter
+from typing import Dict, List, Tuple
+
+
+class UnknownTemplate(Exception):
+    def __init__(self, name: str, version: str) -> None:
+        super().__init__(f'unknown template: {name}@{version}')
+        self.name = name
+        self.version = version
+
+
+class TemplateConflict(Exception):
+    pass
+
+
+# values a template is rendered with at registration, to check its segments tokenize like the whole text
+SAMPLE_VALUES = ('a', 'What is Amazon S3?', ' 파이썬 코드를 보여줘.')
+
+
+class Template(object):
+    """A prompt template whose static segments are tokenized once, at registration.
+
+    Rendering only tokenizes the variables and joins their ids with the cached
+    ones. That is only right when tokenizing segments on their own gives the
+    ids of the whole text: byte-level BPE mostly does, but SentencePiece
+    tokenizers such as LLaMA's add a `▁` at the start of every segment. So at
+    registration the template is rendered with sample values and compared to
+    encoding the whole text. If any differ, the template is not `segmented`
+    and every render encodes the whole text.
+    """
+
+    def __init__(self, tokenizer, name: str, version: str, text: str) -> None:
+        self.name = name
+        self.version = version
+        self.text = text
+        self.special_ids = tokenizer.encode('')  # the special tokens the tokenizer adds, e.g. bos
+        self.parts = []  # (literal, literal ids, variable or None)
+        for literal, field, _, _ in Formatter().parse(text):
+            literal_ids = tokenizer.encode(literal, add_special_tokens=False) if literal else []
+            self.parts.append((literal, literal_ids, field))
+        self.variables = [field for _, _, field in self.parts if field is not None]
+        # the text up to the first variable, the same for every request, so its attention cache is reused
+        self.head = self.parts[0][0] if self.parts and self.variables else ''
+        self.segmented = True
+        for value in SAMPLE_VALUES:
+            text, ids = self.render(tokenizer, {field: value for field in self.variables})
+            if ids != tokenizer.encode(text):
+                self.segmented = False
+                break
+
+    def render(self, tokenizer, variables: Dict[str, str]) -> Tuple[str, List[int]]:
+        if not self.segmented:
+            text = self.format(variables)
+            return text, tokenizer.encode(text)
+
+        text, ids = [], list(self.special_ids)
+        for literal, literal_ids, field in self.parts:
+            text.append(literal)
+            ids.extend(literal_ids)
+            if field is None:
+                continue
+            if field not in variables:
+                raise ValueError(f'missing variable {field} for template {self.name}@{self.version}')
+            value = variables[field]
+            text.append(value)
+            if value:
+                ids.extend(tokenizer.encode(value, add_special_tokens=False))
+        return ''.join(text), ids
+
+    def format(self, variables: Dict[str, str]) -> str:
+        """Renders the text only, for callers that tokenize it themselves."""
+        try:
+            return self.text.format(**variables)
+        except KeyError as exc:
+            raise ValueError(f'missing variable {exc.args[0]} for template {self.name}@{self.version}')
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'version': self.version,
+            'variables': self.variables,
+            'segmented': self.segmented,
+            'static_tokens': sum(len(literal_ids) for _, literal_ids, _ in self.parts),
+        }
+
+
+class TemplateRegistry(object):
+    """Holds every registered version of each template.
+
+    Versions are kept side by side, so clients still sending an older version
+    keep working while a newer one is rolled out.
+    """
+
+    def __init__(self, tokenizer) -> None:
+        self.tokenizer = tokenizer
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, version: str, text: str) -> Template:
+        with self._lock:
+            template = self._templates.get((name, version))
+        if template is not None:
+            if template.text != text:
+                raise TemplateConflict(f'template {name}@{version} is already registered with another text')
+            return template
+
+        template = Template(self.tokenizer, name, version, text)
+        with self._lock:
+            return self._templates.setdefault((name, version), template)
+
+    def get(self, name: str, version: str) -> Template:
+        with self._lock:
+            template = self._templates.get((name, version))
+        if template is None:
+            raise UnknownTemplate(name, version)
+        return template
+
+    def list(self) -> List[dict]:
+        with self._lock:
+            templates = list(self._templates.values())
+        return [template.to_dict() for template in templates]
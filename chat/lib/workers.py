@@ -0,0 +1,60 @@
+import os
+import multiprocessing
+from typing import List
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# set by serve.py before the workers are forked
+preloaded = None  # (tokenizer, model) loaded once in the master
+preloaded_models = {}  # name -> (tokenizer, model) of each extra model, or the exception it failed with
+table = None  # WorkerTable
+
+
+def memory(pid: int) -> dict:
+    """Returns resident and shared memory of a process, shared includes the forked weights."""
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            resident, shared = (int(v) for v in f.read().split()[1:3])
+    except (OSError, ValueError):
+        return {'rss_bytes': None, 'shared_bytes': None}
+    return {'rss_bytes': resident * PAGE_SIZE, 'shared_bytes': shared * PAGE_SIZE}
+
+
+def core_slices(num_workers: int, cores: List[int] = None) -> List[List[int]]:
+    """Splits the usable cores into one contiguous slice per worker."""
+    cores = sorted(cores if cores is not None else os.sched_getaffinity(0))
+    num_workers = max(1, min(num_workers, len(cores)))
+    size, extra = divmod(len(cores), num_workers)
+    slices, start = [], 0
+    for worker in range(num_workers):
+        end = start + size + (1 if worker < extra else 0)
+        slices.append(cores[start:end])
+        start = end
+    return slices
+
+
+class WorkerTable(object):
+    """Pid and readiness of every worker, in shared memory so any worker can report all of them."""
+
+    def __init__(self, cores: List[List[int]]) -> None:
+        self.cores = cores
+        self.worker = None  # index of the current process, None in the master
+        self._pids = multiprocessing.Array('q', len(cores), lock=False)
+        self._ready = multiprocessing.Array('b', len(cores), lock=False)
+
+    def started(self, worker: int, pid: int):
+        self._pids[worker] = pid
+        self._ready[worker] = 0
+
+    def set_ready(self, ready: bool = True):
+        if self.worker is not None:
+            self._ready[self.worker] = int(ready)
+
+    def status(self) -> List[dict]:
+        return [{
+            'worker': worker,
+            'pid': self._pids[worker],
+            'ready': bool(self._ready[worker]),
+            'cores': cores,
+            **memory(self._pids[worker]),
+        } for worker, cores in enumerate(self.cores)]
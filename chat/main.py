@@ -1,45 +1,227 @@
 import os
+import json
+import asyncio
+import math
+import time
 import traceback
 import threading
+from concurrent.futures import Future
 
-from fastapi import FastAPI, Request, Response
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Header, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from typing import Dict, List
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from opentelemetry import trace
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 
 from lib.logger import logger
-from lib import chatbot
-from lib.o11y import tracer, context_from_headers
+from lib import chatbot, loader, metrics, profiling, workers
+from lib.scheduler import QueueFull, PRIORITIES
+from lib.budget import GenerationTooLarge
+from lib.result_cache import ResultCache
+from lib.templates import TemplateConflict, UnknownTemplate
+from lib.models import DEFAULT_MODEL, ModelSpec, ServedModel, UnknownModel, parse_specs
+from lib.o11y import tracer, context_from_headers, set_payload
 
 load_dotenv()
 model_name = os.environ['MODEL_NAME']
 cache_dir= os.environ['CACHE_DIR']
 load_in_8bit= bool(os.environ.get('LOAD_IN_8BIT', False))
+snapshot_dir = os.environ.get('SNAPSHOT_DIR', '')
+warmup_tokens = int(os.environ.get('WARMUP_TOKENS', 4))
+cpu_dtype = os.environ.get('CPU_DTYPE', 'float16')
+cpu_quantize = bool(os.environ.get('CPU_QUANTIZE', False))
+cpu_threads = int(os.environ.get('CPU_THREADS', 0))
+cpu_interop_threads = int(os.environ.get('CPU_INTEROP_THREADS', 0))
+batch_max_size = int(os.environ.get('BATCH_MAX_SIZE', 1))
+batch_max_wait_ms = int(os.environ.get('BATCH_MAX_WAIT_MS', 10))
+batch_length_bucket = int(os.environ.get('BATCH_LENGTH_BUCKET', 64))
+prefix_cache_size = int(os.environ.get('PREFIX_CACHE_SIZE', 8))
+admission_max_queue = int(os.environ.get('ADMISSION_MAX_QUEUE', 64))
+admission_short_max_new_tokens = int(os.environ.get('ADMISSION_SHORT_MAX_NEW_TOKENS', 64))
+result_cache_size = int(os.environ.get('RESULT_CACHE_SIZE', 1024))
+result_cache_ttl = float(os.environ.get('RESULT_CACHE_TTL', 3600))
+result_cache_path = os.environ.get('RESULT_CACHE_PATH', '')
+draft_model_name = os.environ.get('DRAFT_MODEL_NAME', '')
+draft_num_tokens = int(os.environ.get('DRAFT_NUM_TOKENS', 5))
+draft_min_accept_rate = float(os.environ.get('DRAFT_MIN_ACCEPT_RATE', 0.3))
+attn_implementation = os.environ.get('ATTN_IMPLEMENTATION', '')
+compile_decode = bool(os.environ.get('COMPILE_DECODE', False))
+prompt_buckets = [int(bucket) for bucket in os.environ.get('PROMPT_BUCKETS', '').split(',') if bucket]
+extra_models = os.environ.get('MODELS', '')
+profile_sample_rate = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+profile_dir = os.environ.get('PROFILE_DIR', 'profiles')
+profile_max_files = int(os.environ.get('PROFILE_MAX_FILES', 100))
+model_memory_budget_gb = float(os.environ.get('MODEL_MEMORY_BUDGET_GB', 0))
+generation_memory_budget_mb = float(os.environ.get('GENERATION_MEMORY_BUDGET_MB', 0))
+generation_memory_policy = os.environ.get('GENERATION_MEMORY_POLICY', 'clamp')
 logger.info(f'model_name: {model_name}, cache_dir: {cache_dir}, load_in_8bit: {load_in_8bit}')
+logger.info(f'snapshot_dir: {snapshot_dir}, warmup_tokens: {warmup_tokens}')
+logger.info(f'cpu_dtype: {cpu_dtype}, cpu_quantize: {cpu_quantize}, cpu_threads: {cpu_threads}, cpu_interop_threads: {cpu_interop_threads}')
+logger.info(f'batch_max_size: {batch_max_size}, batch_max_wait_ms: {batch_max_wait_ms}, batch_length_bucket: {batch_length_bucket}')
+logger.info(f'prefix_cache_size: {prefix_cache_size}')
+logger.info(f'admission_max_queue: {admission_max_queue}, admission_short_max_new_tokens: {admission_short_max_new_tokens}')
+logger.info(f'result_cache_size: {result_cache_size}, result_cache_ttl: {result_cache_ttl}, result_cache_path: {result_cache_path}')
+logger.info(f'draft_model_name: {draft_model_name}, draft_num_tokens: {draft_num_tokens}, draft_min_accept_rate: {draft_min_accept_rate}')
+logger.info(f'attn_implementation: {attn_implementation}, compile_decode: {compile_decode}, prompt_buckets: {prompt_buckets}')
+logger.info(f'extra_models: {extra_models}, model_memory_budget_gb: {model_memory_budget_gb}')
+logger.info(f'generation_memory_budget_mb: {generation_memory_budget_mb}, generation_memory_policy: {generation_memory_policy}')
+logger.info(f'profile_sample_rate: {profile_sample_rate}, profile_dir: {profile_dir}, profile_max_files: {profile_max_files}')
 
-model, tokenizer, is_ready = None, None, False
+models = {DEFAULT_MODEL: ServedModel(DEFAULT_MODEL, ModelSpec(
+    model_name, '', cpu_dtype, cpu_quantize, load_in_8bit, attn_implementation, compile_decode, prompt_buckets,
+))}
+models.update((name, ServedModel(name, spec)) for name, spec in parse_specs(extra_models).items())
+default = models[DEFAULT_MODEL]
+profile_store = profiling.ProfileStore(profile_dir, profile_max_files) if profile_dir else None
+result_cache = None
+if result_cache_size > 0:
+    result_cache = ResultCache(
+        max_entries=result_cache_size,
+        ttl=result_cache_ttl,
+        path=result_cache_path,
+    )
 
 api = FastAPI()
-FastAPIInstrumentor.instrument_app(api, excluded_urls="healthz/")
+FastAPIInstrumentor.instrument_app(api, excluded_urls="healthz/,metrics")
+
+
+def _queue_depth():
+    for served in models.values():
+        if served.scheduler is not None:
+            for name, depth in served.scheduler.stats()['queue_depth'].items():
+                yield (served.name, name), depth
+
+
+def _cache_lookups():
+    if result_cache is not None:
+        stats = result_cache.stats()
+        yield ('result', 'hit'), stats['hits']
+        yield ('result', 'miss'), stats['misses']
+    hits = misses = 0
+    for served in models.values():
+        if served.prefix_cache is not None:
+            stats = served.prefix_cache.stats()
+            hits, misses = hits + stats['hits'], misses + stats['misses']
+    yield ('prefix', 'hit'), hits
+    yield ('prefix', 'miss'), misses
+
+
+def _draft_tokens():
+    assistant = getattr(default.model, 'assistant', None)
+    if assistant is not None:
+        yield ('proposed',), assistant.proposed
+        yield ('accepted',), assistant.accepted
+
+
+metrics.REGISTRY.callback('counter', 'chat_draft_tokens_total', 'Tokens proposed by the draft model and accepted', _draft_tokens, ('result',))
+metrics.REGISTRY.callback('gauge', 'chat_queue_depth', 'Requests waiting in each priority lane', _queue_depth, ('model', 'priority'))
+metrics.REGISTRY.callback('counter', 'chat_cache_lookups_total', 'Result and prefix cache lookups', _cache_lookups, ('cache', 'result'))
 
 
 class BackgroundModelLoader(threading.Thread):
     def run(self, *args, **kwargs):
-        global model, tokenizer, is_ready
         logger.info(f'Loading model: {model_name} with cache_dir: {cache_dir}')
-        tokenizer, model = chatbot.setup_model(
-            model_name=model_name,
-            cache_dir=cache_dir,
-            load_in_8bit=load_in_8bit,
+        scheduler_options = dict(
+            prefix_cache_size=prefix_cache_size,
+            max_batch_size=batch_max_size,
+            max_wait_ms=batch_max_wait_ms,
+            length_bucket=batch_length_bucket,
+            max_queue=admission_max_queue,
+            short_max_new_tokens=admission_short_max_new_tokens,
+            memory_budget=int(generation_memory_budget_mb * 1024 ** 2),
+            memory_policy=generation_memory_policy,
         )
+        try:
+            if workers.preloaded is not None:
+                # forked by serve.py, the model is shared with the master
+                tokenizer, model = loader.warmup(*workers.preloaded, warmup_tokens=warmup_tokens, progress=default.progress)
+            else:
+                tokenizer, model = loader.load(
+                    model_name=model_name,
+                    cache_dir=cache_dir,
+                    load_in_8bit=load_in_8bit,
+                    snapshot_dir=snapshot_dir,
+                    warmup_tokens=warmup_tokens,
+                    progress=default.progress,
+                    cpu_dtype=cpu_dtype,
+                    cpu_quantize=cpu_quantize,
+                    draft_model_name=draft_model_name,
+                    draft_num_tokens=draft_num_tokens,
+                    draft_min_accept_rate=draft_min_accept_rate,
+                    attn_implementation=attn_implementation,
+                    compile_decode=compile_decode,
+                    prompt_buckets=prompt_buckets,
+                )
+        except Exception as exc:
+            logger.exception(traceback.format_exc())
+            default.progress.fail(exc)
+            return
         logger.info('Model loaded')
-        is_ready = True
+        default.serve(tokenizer, model, **scheduler_options)
+        metrics.set_model(default.name, default.parameter_bytes)
+        if workers.table is not None:
+            workers.table.set_ready()
+
+        try:
+            loader.convert_snapshot(
+                tokenizer, model, snapshot_dir,
+                load_in_8bit=load_in_8bit,
+                cpu_quantize=cpu_quantize,
+            )
+        except Exception:
+            logger.exception(traceback.format_exc())
+
+        # the extra models load one at a time, after the default one serves
+        for served in models.values():
+            if served is default:
+                continue
+            logger.info(f'Loading model {served.name}: {served.spec}')
+            try:
+                preloaded = workers.preloaded_models.get(served.name)
+                if isinstance(preloaded, Exception):
+                    raise preloaded
+                if preloaded is not None:
+                    tokenizer, model = loader.warmup(*preloaded, warmup_tokens=warmup_tokens, progress=served.progress)
+                else:
+                    tokenizer, model = served.load(
+                        cache_dir,
+                        budget=int(model_memory_budget_gb * 2 ** 30),
+                        loaded=sum(m.parameter_bytes for m in models.values()),
+                        warmup_tokens=warmup_tokens,
+                    )
+            except Exception as exc:
+                logger.exception(traceback.format_exc())
+                served.progress.fail(exc)
+                continue
+            served.serve(tokenizer, model, **scheduler_options)
+            metrics.set_model(served.name, served.parameter_bytes)
 
 
 class Message(BaseModel):
-    prompt: str
+    model: str = Field(
+        default='', title='model', description=f'Name of the model to serve the request, {DEFAULT_MODEL} when empty',
+    )
+    prompt: str = Field(
+        default='', title='prompt', description='Full prompt, leave empty when a template is given',
+    )
+    template: str = Field(
+        default='', title='template', description='Name of a registered template, replaces the prompt',
+    )
+    template_version: str = Field(
+        default='', title='template_version',
+    )
+    template_text: str = Field(
+        default='', title='template_text', description='Text of the template, registered first if this worker does not know it',
+    )
+    variables: Dict[str, str] = Field(
+        default={}, title='variables', description='Values of the template variables',
+    )
+    prefix: str = Field(
+        default='', title='prefix', description='Static head of the prompt whose attention cache is kept and reused',
+    )
     top_k: int = Field(
         default=0, title='top_k',
     )
@@ -61,11 +243,65 @@ class Message(BaseModel):
     eos_token_id: int = Field(
         default=2, title='eos_token_id', description='End of sentence token id, default is <\\s>'
     )
+    stop: List[str] = Field(
+        default=[], title='stop', description='Strings that end the generation, excluded from the output',
+    )
+    stop_token_ids: List[List[int]] = Field(
+        default=[], title='stop_token_ids', description='Token id sequences that end the generation',
+    )
+    priority: str = Field(
+        default='', title='priority', regex=f'^({"|".join(PRIORITIES)})?$',
+        description='Admission lane, chosen from the generation parameters when empty',
+    )
+
+
+class BatchMessage(BaseModel):
+    items: List[Message] = Field(
+        min_items=1, title='items', description='Prompts with their own generation parameters',
+    )
+
+
+class ScoreRequest(BaseModel):
+    model: str = Field(
+        default='', title='model', description=f'Name of the model to serve the request, {DEFAULT_MODEL} when empty',
+    )
+    prompt: str = Field(
+        default='', title='prompt', description='Full prompt, leave empty when a template is given',
+    )
+    template: str = Field(
+        default='', title='template', description='Name of a registered template, replaces the prompt',
+    )
+    template_version: str = Field(
+        default='', title='template_version',
+    )
+    template_text: str = Field(
+        default='', title='template_text', description='Text of the template, registered first if this worker does not know it',
+    )
+    variables: Dict[str, str] = Field(
+        default={}, title='variables', description='Values of the template variables',
+    )
+    candidates: List[str] = Field(
+        min_items=1, title='candidates', description='Continuations of the prompt to score',
+    )
+    prefix: str = Field(
+        default='', title='prefix', description='Static head of the prompt whose attention cache is kept and reused',
+    )
+
+
+class TemplateRequest(BaseModel):
+    model: str = Field(
+        default='', title='model', description=f'Name of the model to serve the request, {DEFAULT_MODEL} when empty',
+    )
+    name: str
+    version: str
+    text: str = Field(
+        title='text', description='Template text, variables are written as {name}',
+    )
 
 
 @api.middleware("otel")
 async def init_otel_span(request: Request, call_next):
-    if request.url.path == '/healthz/':
+    if request.url.path in ('/healthz/', '/metrics'):
         return await call_next(request)
 
     context = context_from_headers(request.headers)
@@ -87,10 +323,20 @@ async def init_otel_span(request: Request, call_next):
 
 @api.on_event('startup')
 def startup_event():
+    if chatbot.device == 'cpu':
+        chatbot.configure_cpu(cpu_threads, cpu_interop_threads)
+    if result_cache is not None:
+        result_cache.load()
     t = BackgroundModelLoader()
     t.start()
 
 
+@api.on_event('shutdown')
+def shutdown_event():
+    if result_cache is not None:
+        result_cache.save()
+
+
 @api.get('/healthz')
 @api.get('/healthz/')
 def healthz():
@@ -99,23 +345,209 @@ def healthz():
     }
 
 
+@api.get('/metrics')
+def metrics_endpoint():
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @api.get('/readyz')
 @api.get('/readyz/')
-def readyz():
+async def readyz():
+    assistant = getattr(default.model, 'assistant', None)
     return {
-        'status': is_ready,
+        'status': default.is_ready,
+        **default.progress.to_dict(),
+        'queue': default.scheduler.stats() if default.scheduler is not None else None,
+        'assistant': assistant.stats() if assistant is not None else None,
+        'models': {name: served.stats() for name, served in models.items()},
+        'memory': workers.memory(os.getpid()),
+        'worker': workers.table.worker if workers.table is not None else None,
+        'workers': workers.table.status() if workers.table is not None else None,
     }
 
 
+def get_model(name: str) -> ServedModel:
+    served = models.get(name or DEFAULT_MODEL)
+    if served is None:
+        raise UnknownModel(name)
+    return served
+
+
+def not_found_response(span, exc: Exception, code: str) -> JSONResponse:
+    span.record_exception(exc)
+    span.set_status(trace.Status(trace.StatusCode.ERROR))
+    return JSONResponse(status_code=404, content={
+        'status': 'error',
+        'code': code,
+        'message': str(exc),
+    }, headers={'X-Error': str(exc)})
+
+
+@api.get('/v1/prefixes')
+@api.get('/v1/prefixes/')
+def prefixes(model: str = ''):
+    served = models.get(model or DEFAULT_MODEL)
+    if served is None or served.prefix_cache is None:
+        return {
+            'status': served is not None and served.is_ready,
+        }
+    return {
+        'status': served.is_ready,
+        **served.prefix_cache.stats(),
+    }
+
+
+@api.get('/v1/templates')
+@api.get('/v1/templates/')
+def list_templates(model: str = ''):
+    served = models.get(model or DEFAULT_MODEL)
+    return {
+        'status': served is not None and served.is_ready,
+        'templates': served.templates.list() if served is not None and served.templates is not None else [],
+    }
+
+
+@api.post('/v1/templates')
+@api.post('/v1/templates/')
+def register_template(request: TemplateRequest):
+    with tracer.start_as_current_span('register template') as span:
+        logger.info('register template: %s@%s', request.name, request.version)
+        span.set_attribute('template.name', request.name)
+        span.set_attribute('template.version', request.version)
+
+        try:
+            served = get_model(request.model)
+        except UnknownModel as exc:
+            return not_found_response(span, exc, 'unknown_model')
+        span.set_attribute('model', served.name)
+
+        if not served.is_ready:
+            exc = Exception('the model is not ready yet')
+            span.record_exception(exc)
+            span.set_status(trace.Status(trace.StatusCode.ERROR))
+            return JSONResponse(content={
+                'status': 'error',
+                'message': str(exc),
+            }, headers={'X-Error': str(exc)})
+
+        try:
+            template = served.templates.register(request.name, request.version, request.text)
+        except TemplateConflict as exc:
+            return conflict_response(span, exc)
+        return {
+            'status': 'ok',
+            'template': template.to_dict(),
+        }
+
+
+def conflict_response(span, exc: TemplateConflict) -> JSONResponse:
+    span.record_exception(exc)
+    span.set_status(trace.Status(trace.StatusCode.ERROR))
+    return JSONResponse(status_code=409, content={
+        'status': 'error',
+        'code': 'template_conflict',
+        'message': str(exc),
+    }, headers={'X-Error': str(exc)})
+
+
+def render_template(served: ServedModel, params: dict, tokenize: bool = True) -> dict:
+    """Replaces a template reference with the rendered prompt and, if `tokenize`, its token ids.
+
+    A request carrying the `template_text` registers it first, so the worker
+    that serves it knows the template even when it never saw its registration.
+    """
+    params = dict(params)
+    params.pop('model', None)
+    name = params.pop('template', '')
+    version = params.pop('template_version', '')
+    text = params.pop('template_text', '')
+    variables = params.pop('variables', {})
+    if not name:
+        if not params['prompt']:
+            raise ValueError('either a prompt or a template is required')
+        return params
+
+    if text:
+        template = served.templates.register(name, version, text)
+    else:
+        template = served.templates.get(name, version)
+    if tokenize:
+        params['prompt'], params['prompt_ids'] = template.render(served.tokenizer, variables)
+    else:
+        params['prompt'] = template.format(variables)
+    params['prefix'] = params.get('prefix') or template.head
+    return params
+
+
+def queue_full_response(span, exc: QueueFull, content: dict) -> JSONResponse:
+    span.record_exception(exc)
+    span.set_attribute('admission.rejected', exc.priority)
+    span.set_status(trace.Status(trace.StatusCode.ERROR))
+    return JSONResponse(status_code=429, content=content, headers={
+        'Retry-After': str(math.ceil(exc.retry_after)),
+        'X-Error': str(exc),
+    })
+
+
+def too_large_response(span, exc: GenerationTooLarge, content: dict) -> JSONResponse:
+    span.record_exception(exc)
+    span.set_attribute('memory.needed_bytes', exc.needed)
+    span.set_attribute('memory.limit_bytes', exc.limit)
+    span.set_status(trace.Status(trace.StatusCode.ERROR))
+    return JSONResponse(status_code=413, content=content, headers={'X-Error': str(exc)})
+
+
+def cache_params(served: ServedModel, params: dict) -> dict:
+    # the default model keeps the cache keys it had before models were named
+    if served is default:
+        return params
+    return {**params, 'model': served.name}
+
+
+def submit_generation(served: ServedModel, params: dict, profile: profiling.Profile = None):
+    """Returns a future of the generation and whether it was served from the result cache."""
+    cacheable = result_cache is not None and result_cache.cacheable(params)
+    key = cache_params(served, params)
+    if cacheable:
+        generation = result_cache.get(key)
+        if generation is not None:
+            future = Future()
+            future.set_result(generation)
+            return future, True
+
+    future = served.scheduler.submit(profile=profile, **params)
+    if cacheable:
+        def put(done: Future):
+            if done.exception() is None:
+                result_cache.put(key, done.result())
+        future.add_done_callback(put)
+    return future, False
+
+
+def finish_profile(span, profile: profiling.Profile, response: Response):
+    profile.add_events(span)
+    response.headers['X-Profile-Id'] = profile.profile_id
+    if profile_store is not None:
+        profile_store.save(profile)
+
+
 @api.post('/v1/chat')
 @api.post('/v1/chat/')
-def chat(message: Message):
+async def chat(message: Message, x_profile: str = Header(default='')):
     with tracer.start_as_current_span('chat') as span:
-        logger.info(f'user_input: {message.json()}')
-        span.set_attribute('message', message.json())
-        span.set_attribute('is_ready', is_ready)
+        # None unless asked for by the X-Profile header or sampled
+        profile = profiling.start(x_profile, profile_sample_rate, span)
+        with profiling.stage(profile, 'trace'):
+            logger.info('user_input: %s', message)
+            set_payload(span, 'message', message.json)
+        try:
+            served = get_model(message.model)
+        except UnknownModel as exc:
+            return not_found_response(span, exc, 'unknown_model')
+        span.set_attribute('model', served.name)
+        span.set_attribute('is_ready', served.is_ready)
 
-        if not is_ready:
+        if not served.is_ready:
             exc = Exception('the model is not ready yet')
             span.record_exception(exc)
             span.set_status(trace.Status(trace.StatusCode.ERROR))
@@ -125,23 +557,194 @@ def chat(message: Message):
             }, headers={'X-Error': str(exc)})
 
         try:
-            generation = chatbot.generate(
-                tokenizer=tokenizer,
-                model=model,
-                prompt=message.prompt,
-                top_k=message.top_k,
-                top_p=message.top_p,
-                max_new_tokens=message.max_new_tokens,
-                temperature=message.temperature,
-                num_return_sequences=message.num_return_sequences,
-                do_sample=message.do_sample,
-                eos_token_id=message.eos_token_id,
-            )
-            span.set_attribute('generation', generation)
+            # tokenizing runs on the threadpool, but no thread is held while the request is queued
+            with profiling.stage(profile, 'render'):
+                params = await run_in_threadpool(render_template, served, message.dict())
+            if profile is not None and profile.torch_trace and profile_store is not None:
+                profile.trace_path = profile_store.trace_path(profile.profile_id)
+            future, cache_hit = await run_in_threadpool(submit_generation, served, params, profile)
+            if result_cache is not None:
+                span.set_attribute('result_cache.hit', cache_hit)
+                for name, value in result_cache.stats().items():
+                    span.set_attribute(f'result_cache.{name}', value)
+
+            with profiling.stage(profile, 'wait'):
+                generation = await asyncio.wrap_future(future)
+            with profiling.stage(profile, 'respond'):
+                set_payload(span, 'generation', generation.text)
+                span.set_attribute('finish_reason', generation.finish_reason)
+                content = {
+                    'status': 'ok',
+                    'generation': generation.text,
+                    'finish_reason': generation.finish_reason,
+                }
+                # set by the scheduler when it has a memory budget, never on a cache hit
+                memory = getattr(future, 'memory', None)
+                if memory is not None:
+                    for name, value in memory.items():
+                        if value is not None:
+                            span.set_attribute(f'memory.{name}', value)
+                    content['memory'] = memory
+                response = JSONResponse(content=content)
+            if profile is not None:
+                finish_profile(span, profile, response)
+            return response
+        except QueueFull as exc:
+            return queue_full_response(span, exc, {
+                'status': 'error',
+                'generation': str(exc),
+            })
+        except GenerationTooLarge as exc:
+            return too_large_response(span, exc, {
+                'status': 'error',
+                'generation': str(exc),
+            })
+        except UnknownTemplate as exc:
+            return not_found_response(span, exc, 'unknown_template')
+        except TemplateConflict as exc:
+            return conflict_response(span, exc)
+        except Exception as exc:
+            logger.exception(traceback.format_exc())
+            span.record_exception(exc)
+            span.set_attribute('traceback', traceback.format_exc())
+            span.set_status(trace.Status(trace.StatusCode.ERROR))
+            return JSONResponse(content={
+                'status': 'error',
+                'message': traceback.format_exc(),
+            }, headers={'X-Error': str(exc)})
+
+
+@api.post('/v1/chat/batch')
+@api.post('/v1/chat/batch/')
+async def chat_batch(message: BatchMessage):
+    with tracer.start_as_current_span('chat batch') as span:
+        logger.info('batch size: %d', len(message.items))
+        span.set_attribute('batch_size', len(message.items))
+
+        def submit_items():
+            # readiness is per model, so every item reports its own
+            futures = []
+            for item in message.items:
+                try:
+                    served = get_model(item.model)
+                    if not served.is_ready:
+                        raise Exception(f'the model {served.name} is not ready yet')
+                    futures.append(submit_generation(served, render_template(served, item.dict()))[0])
+                except Exception as exc:
+                    future = Future()
+                    future.set_exception(exc)
+                    futures.append(future)
+            return futures
+
+        results = []
+        for future in await run_in_threadpool(submit_items):
+            try:
+                generation = await asyncio.wrap_future(future)
+                results.append({
+                    'status': 'ok',
+                    'generation': generation.text,
+                    'finish_reason': generation.finish_reason,
+                })
+            except QueueFull as exc:
+                results.append({
+                    'status': 'error',
+                    'message': str(exc),
+                    'retry_after': exc.retry_after,
+                })
+            except GenerationTooLarge as exc:
+                results.append({
+                    'status': 'error',
+                    'code': 'generation_too_large',
+                    'message': str(exc),
+                })
+            except UnknownTemplate as exc:
+                results.append({
+                    'status': 'error',
+                    'code': 'unknown_template',
+                    'message': str(exc),
+                })
+            except TemplateConflict as exc:
+                results.append({
+                    'status': 'error',
+                    'code': 'template_conflict',
+                    'message': str(exc),
+                })
+            except UnknownModel as exc:
+                results.append({
+                    'status': 'error',
+                    'code': 'unknown_model',
+                    'message': str(exc),
+                })
+            except Exception as exc:
+                logger.exception(traceback.format_exc())
+                span.record_exception(exc)
+                results.append({
+                    'status': 'error',
+                    'message': str(exc),
+                })
+
+        span.set_attribute('errors', sum(r['status'] == 'error' for r in results))
+        return JSONResponse(content={
+            'status': 'ok',
+            'results': results,
+        })
+
+
+@api.post('/v1/score')
+@api.post('/v1/score/')
+async def score(request: ScoreRequest):
+    with tracer.start_as_current_span('score') as span:
+        logger.info('score request: %s', request)
+        set_payload(span, 'request', request.json)
+        try:
+            served = get_model(request.model)
+        except UnknownModel as exc:
+            return not_found_response(span, exc, 'unknown_model')
+        span.set_attribute('model', served.name)
+        span.set_attribute('is_ready', served.is_ready)
+
+        if not served.is_ready:
+            exc = Exception('the model is not ready yet')
+            span.record_exception(exc)
+            span.set_status(trace.Status(trace.StatusCode.ERROR))
+            return JSONResponse(content={
+                'status': 'error',
+                'message': str(exc),
+            }, headers={'X-Error': str(exc)})
+
+        try:
+            params = {'endpoint': 'score', **render_template(served, request.dict(), tokenize=False)}
+            key = cache_params(served, params)
+            scores = result_cache.get(key) if result_cache is not None else None
+            if result_cache is not None:
+                span.set_attribute('result_cache.hit', scores is not None)
+                for name, value in result_cache.stats().items():
+                    span.set_attribute(f'result_cache.{name}', value)
+
+            if scores is None:
+                future = await run_in_threadpool(
+                    served.scheduler.submit_score,
+                    prompt=params['prompt'],
+                    candidates=params['candidates'],
+                    prefix=params['prefix'],
+                )
+                scores = await asyncio.wrap_future(future)
+                if result_cache is not None:
+                    result_cache.put(key, scores)
+            set_payload(span, 'scores', lambda: json.dumps(scores))
             return JSONResponse(content={
                 'status': 'ok',
-                'generation': generation,
+                'scores': scores,
             })
+        except QueueFull as exc:
+            return queue_full_response(span, exc, {
+                'status': 'error',
+                'message': str(exc),
+            })
+        except UnknownTemplate as exc:
+            return not_found_response(span, exc, 'unknown_template')
+        except TemplateConflict as exc:
+            return conflict_response(span, exc)
         except Exception as exc:
             logger.exception(traceback.format_exc())
             span.record_exception(exc)
@@ -153,6 +756,96 @@ def chat(message: Message):
             }, headers={'X-Error': str(exc)})
 
 
+def sse_event(data: dict, event: str = None) -> str:
+    prefix = f'event: {event}\n' if event else ''
+    return f'{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+@api.post('/v1/chat/stream')
+@api.post('/v1/chat/stream/')
+def chat_stream(message: Message):
+    with tracer.start_as_current_span('chat stream') as span:
+        logger.info('user_input: %s', message)
+        set_payload(span, 'message', message.json)
+        try:
+            served = get_model(message.model)
+        except UnknownModel as exc:
+            return not_found_response(span, exc, 'unknown_model')
+        span.set_attribute('model', served.name)
+        span.set_attribute('is_ready', served.is_ready)
+
+        if not served.is_ready:
+            exc = Exception('the model is not ready yet')
+            span.record_exception(exc)
+            span.set_status(trace.Status(trace.StatusCode.ERROR))
+            return JSONResponse(content={
+                'status': 'error',
+                'generation': str(exc),
+            }, headers={'X-Error': str(exc)})
+
+        started_at = time.monotonic()
+        streamer = chatbot.TextStreamer(
+            served.tokenizer,
+            chatbot.StopMatcher(served.tokenizer, message.stop, message.stop_token_ids),
+        )
+        try:
+            params = render_template(served, message.dict())
+            future = served.scheduler.submit(streamer=streamer, **params)
+        except QueueFull as exc:
+            return queue_full_response(span, exc, {
+                'status': 'error',
+                'generation': str(exc),
+            })
+        except GenerationTooLarge as exc:
+            return too_large_response(span, exc, {
+                'status': 'error',
+                'generation': str(exc),
+            })
+        except UnknownTemplate as exc:
+            return not_found_response(span, exc, 'unknown_template')
+        except TemplateConflict as exc:
+            return conflict_response(span, exc)
+        except Exception as exc:
+            logger.exception(traceback.format_exc())
+            span.record_exception(exc)
+            span.set_attribute('traceback', traceback.format_exc())
+            span.set_status(trace.Status(trace.StatusCode.ERROR))
+            return JSONResponse(content={
+                'status': 'error',
+                'message': traceback.format_exc(),
+            }, headers={'X-Error': str(exc)})
+
+    def events():
+        first_token_at = None
+        for chunk in streamer:
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+            yield sse_event({'token': chunk})
+
+        try:
+            generation = future.result()
+        except Exception as exc:
+            logger.exception(traceback.format_exc())
+            yield sse_event({
+                'status': 'error',
+                'message': str(exc),
+            }, event='error')
+            return
+
+        finished_at = time.monotonic()
+        yield sse_event({
+            'status': 'ok',
+            'generation': generation.text,
+            'finish_reason': generation.finish_reason,
+            'prompt_tokens': len(params['prompt_ids']) if 'prompt_ids' in params else len(served.tokenizer.encode(params['prompt'])),
+            'generated_tokens': generation.tokens,
+            'time_to_first_token': (first_token_at or finished_at) - started_at,
+            'elapsed': finished_at - started_at,
+        }, event='done')
+
+    return StreamingResponse(events(), media_type='text/event-stream')
+
+
 if __name__ == '__main__':
     import uvicorn
     uvicorn.run(api, host='0.0.0.0', port=8080)
\ No newline at end of file
@@ -0,0 +1,131 @@
+"""Serves the chat API from several worker processes sharing one copy of the model.
+
+The models are loaded once in this process and every worker is forked from them,
+so the weights are shared copy-on-write instead of loaded per worker. Workers
+accept from one listening socket and each is pinned to its own slice of cores.
+
+    WORKERS=4 PORT=8080 python3 serve.py
+"""
+import os
+import gc
+import signal
+import socket
+
+import torch
+import uvicorn
+
+# fast tokenizers warn and disable their thread pool once forked
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+
+import main
+from lib import chatbot, loader, models, workers
+from lib.logger import logger
+
+WORKERS = int(os.environ.get('WORKERS', 1))
+HOST = os.environ.get('HOST', '0.0.0.0')
+PORT = int(os.environ.get('PORT', 8080))
+logger.info(f'WORKERS: {WORKERS}, HOST: {HOST}, PORT: {PORT}')
+
+
+def bind(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock: socket.socket, worker: int):
+    workers.table.worker = worker
+    cores = workers.table.cores[worker]
+    os.sched_setaffinity(0, cores)
+    chatbot.configure_cpu(len(cores), 1)
+    logger.info(f'worker {worker} pinned to cores: {cores}')
+    uvicorn.Server(uvicorn.Config(main.api)).run(sockets=[sock])
+
+
+def spawn(sock: socket.socket, worker: int) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            run_worker(sock, worker)
+            code = 0
+        except Exception:
+            logger.exception(f'worker {worker} failed')
+        finally:
+            os._exit(code)
+    workers.table.started(worker, pid)
+    return pid
+
+
+def serve():
+    if chatbot.device != 'cpu' or WORKERS <= 1:
+        uvicorn.run(main.api, host=HOST, port=PORT)
+        return
+
+    # no OpenMP thread pool is started in the master, it would not survive the fork
+    torch.set_num_threads(1)
+    tokenizer, model = loader.load(
+        model_name=main.model_name,
+        cache_dir=main.cache_dir,
+        snapshot_dir=main.snapshot_dir,
+        warmup_tokens=0,
+        cpu_dtype=main.cpu_dtype,
+        cpu_quantize=main.cpu_quantize,
+        draft_model_name=main.draft_model_name,
+        draft_num_tokens=main.draft_num_tokens,
+        draft_min_accept_rate=main.draft_min_accept_rate,
+        attn_implementation=main.attn_implementation,
+        compile_decode=main.compile_decode,
+        prompt_buckets=main.prompt_buckets,
+    )
+    loader.convert_snapshot(tokenizer, model, main.snapshot_dir, cpu_quantize=main.cpu_quantize)
+    workers.preloaded = (tokenizer, model)
+    loaded = models.parameter_bytes(model)
+    for served in main.models.values():
+        if served is main.default:
+            continue
+        try:
+            workers.preloaded_models[served.name] = served.load(
+                main.cache_dir,
+                budget=int(main.model_memory_budget_gb * 2 ** 30),
+                loaded=loaded,
+                warmup_tokens=0,
+            )
+        except Exception as exc:
+            # reported by every worker in /readyz, none of them retries it
+            logger.exception(f'failed to preload model {served.name}')
+            workers.preloaded_models[served.name] = exc
+            continue
+        loaded += models.parameter_bytes(workers.preloaded_models[served.name][1])
+    workers.table = workers.WorkerTable(workers.core_slices(WORKERS))
+    sock = bind(HOST, PORT)
+    # keeps the collector from writing to, and so copying, every object the workers inherit
+    gc.freeze()
+
+    children = {spawn(sock, worker): worker for worker in range(len(workers.table.cores))}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker = children.pop(pid, None)
+        if worker is not None and not stopping:
+            logger.warning(f'worker {worker} exited with status {status}, restarting')
+            children[spawn(sock, worker)] = worker
+
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,53 @@
+import pytest
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM, GPTNeoXForCausalLM
+
+from bench.tiny_model import build_tiny_model
+
+
+@pytest.fixture(scope='session')
+def tiny_model_path(tmp_path_factory):
+    torch.manual_seed(0)
+    return build_tiny_model(str(tmp_path_factory.mktemp('tiny')))
+
+
+@pytest.fixture(scope='session')
+def tokenizer(tiny_model_path):
+    return AutoTokenizer.from_pretrained(tiny_model_path)
+
+
+@pytest.fixture(scope='session')
+def model(tiny_model_path):
+    return AutoModelForCausalLM.from_pretrained(tiny_model_path).eval()
+
+
+@pytest.fixture(scope='session')
+def other_model(model):
+    """A model of the same shape with other random weights, a draft that is mostly wrong."""
+    torch.manual_seed(1)
+    return GPTNeoXForCausalLM(model.config).eval()
+
+
+def make_params(prompt: str, **overrides) -> dict:
+    """Returns the request params `BatchScheduler.submit` and `chatbot.generate` take, decoding greedily past eos."""
+    params = {
+        'prompt': prompt,
+        'top_k': 0,
+        'top_p': 1.0,
+        'max_new_tokens': 12,
+        'temperature': 0.5,
+        'num_return_sequences': 1,
+        'do_sample': False,
+        'eos_token_id': -1,
+    }
+    params.update(overrides)
+    return params
+
+
+def stop_in(text: str) -> str:
+    """Returns a printable three character stop string from the middle of a generation of the random model."""
+    for start in range(2, len(text) - 3):
+        stop = text[start:start + 3]
+        if stop.isprintable() and '\ufffd' not in stop:
+            return stop
+    raise AssertionError(f'no usable stop string in {text!r}')
@@ -0,0 +1,64 @@
+import pytest
+
+from lib import chatbot
+
+from conftest import make_params, stop_in
+
+PROMPTS = [
+    'Write a response that',
+    'Classify the following sentence',
+    '입력받은 숫자가',
+]
+
+
+@pytest.fixture(params=['same', 'other'])
+def draft(request, model, other_model):
+    return model if request.param == 'same' else other_model
+
+
+@pytest.mark.parametrize('prompt', PROMPTS)
+def test_assisted_matches_greedy(tokenizer, model, draft, prompt, monkeypatch):
+    params = make_params(prompt, max_new_tokens=16)
+    expected = chatbot.generate(tokenizer, model, **params)
+
+    assistant = chatbot.Assistant(draft, num_tokens=3)
+    monkeypatch.setattr(model, 'assistant', assistant, raising=False)
+    assert chatbot.generate(tokenizer, model, **params) == expected
+    assert assistant.proposed > 0
+    if draft is model:
+        assert assistant.accepted == assistant.proposed
+
+
+def test_assisted_stops_like_greedy(tokenizer, model, other_model, monkeypatch):
+    params = make_params(PROMPTS[1], max_new_tokens=16)
+    stop = stop_in(chatbot.generate(tokenizer, model, **params).text)
+    expected = chatbot.generate(tokenizer, model, **params, stop=[stop])
+    assert expected.finish_reason == 'stop'
+
+    monkeypatch.setattr(model, 'assistant', chatbot.Assistant(other_model, num_tokens=3), raising=False)
+    assert chatbot.generate(tokenizer, model, **params, stop=[stop]) == expected
+
+
+def test_assisted_with_prompt_ids(tokenizer, model, monkeypatch):
+    params = make_params(PROMPTS[0], max_new_tokens=8)
+    expected = chatbot.generate(tokenizer, model, **params)
+
+    monkeypatch.setattr(model, 'assistant', chatbot.Assistant(model, num_tokens=2), raising=False)
+    assert chatbot.generate(tokenizer, model, **params, prompt_ids=tokenizer.encode(PROMPTS[0])) == expected
+
+
+def test_assistant_pauses_and_resumes(model):
+    assistant = chatbot.Assistant(model, num_tokens=4, min_accept_rate=0.5, window=8, cooldown=2)
+    assert assistant.start()
+
+    assistant.record(4, 4)
+    assistant.record(4, 3)
+    assert not assistant.paused
+
+    assistant.record(4, 0)
+    assistant.record(4, 1)
+    assert assistant.paused
+    assert assistant.stats()['fallbacks'] == 1
+    assert [assistant.start() for _ in range(3)] == [False, False, True]
+    assert not assistant.paused
+    assert assistant.stats()['accept_rate'] == 8 / 16
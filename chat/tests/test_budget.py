@@ -0,0 +1,68 @@
+import pytest
+
+from lib.budget import GenerationBudget, GenerationTooLarge
+from lib.scheduler import GenerationRequest
+
+
+def _params(max_new_tokens: int = 64, num_return_sequences: int = 1) -> dict:
+    return {'max_new_tokens': max_new_tokens, 'num_return_sequences': num_return_sequences}
+
+
+def test_estimate_grows_with_length_and_sequences(model):
+    budget = GenerationBudget(model, 1)
+    assert budget.cache_bytes_per_token > 0
+    assert budget.estimate(10, 20) == budget.cache_bytes_per_token * 30 + budget.logits_bytes_per_token * 10
+    assert budget.estimate(10, 20, 3) == 3 * budget.estimate(10, 20)
+
+
+def test_admit_within_limit(model):
+    limit = GenerationBudget(model, 1).estimate(16, 64, 2)
+    params = _params(num_return_sequences=2)
+    assert GenerationBudget(model, limit).admit(params, 16) == limit
+    assert params == _params(num_return_sequences=2)
+
+
+def test_admit_clamps(model):
+    budget = GenerationBudget(model, 1)
+    budget.limit = budget.estimate(16, 40)
+    params = _params(max_new_tokens=64, num_return_sequences=4)
+    assert budget.admit(params, 16) == budget.estimate(16, 40)
+    assert params == _params(max_new_tokens=40)
+
+
+def test_admit_clamps_sequences_first(model):
+    budget = GenerationBudget(model, 1)
+    budget.limit = budget.estimate(16, 64)
+    params = _params(max_new_tokens=64, num_return_sequences=4)
+    budget.admit(params, 16)
+    assert params == _params(max_new_tokens=64)
+
+
+def test_admit_rejects(model):
+    budget = GenerationBudget(model, 1, policy='reject')
+    budget.limit = budget.estimate(16, 40)
+    with pytest.raises(GenerationTooLarge) as exc_info:
+        budget.admit(_params(), 16)
+    assert exc_info.value.needed == budget.estimate(16, 64)
+
+
+def test_admit_rejects_prompt_over_limit_when_clamping(model):
+    budget = GenerationBudget(model, 1)
+    budget.limit = budget.estimate(16, 0)
+    with pytest.raises(GenerationTooLarge):
+        budget.admit(_params(), 16)
+
+
+def test_unknown_policy(model):
+    with pytest.raises(ValueError):
+        GenerationBudget(model, 1, policy='drop')
+
+
+def test_fit_keeps_head_within_limit(model):
+    budget = GenerationBudget(model, 100)
+    requests = [GenerationRequest({}, (), memory=memory) for memory in (40, 50, 20, 10)]
+    assert budget.fit(requests) == requests[:2]
+    assert budget.fit(requests[2:]) == requests[2:]
+    # a request over the limit alone still runs, on its own
+    over = [GenerationRequest({}, (), memory=150)] + requests
+    assert budget.fit(over) == over[:1]
@@ -0,0 +1,64 @@
+import time
+
+from lib.chatbot import Generation
+from lib.result_cache import ResultCache
+
+from conftest import make_params
+
+
+def test_key_is_exact_prompt_and_params():
+    params = make_params('What is S3?')
+    assert ResultCache.key(params) == ResultCache.key(dict(params))
+    assert ResultCache.key(params) != ResultCache.key(make_params('What is S3? '))
+    assert ResultCache.key(params) != ResultCache.key(make_params('what is S3?'))
+    assert ResultCache.key(params) != ResultCache.key(make_params('What is S3?', max_new_tokens=13))
+    # where and how soon it runs does not change the result
+    assert ResultCache.key(params) == ResultCache.key({**params, 'prefix': 'What', 'priority': 'high'})
+
+
+def test_cacheable():
+    assert ResultCache.cacheable(make_params('a'))
+    assert not ResultCache.cacheable(make_params('a', do_sample=True))
+
+
+def test_hits_and_misses():
+    cache = ResultCache()
+    params = make_params('a')
+    assert cache.get(params) is None
+    cache.put(params, Generation('b', 'length', 1))
+    assert cache.get(params) == Generation('b', 'length', 1)
+    assert cache.stats() == {'entries': 1, 'hits': 1, 'misses': 1, 'hit_rate': 0.5}
+
+
+def test_expired_entries_are_dropped():
+    cache = ResultCache(ttl=-1)
+    cache.put(make_params('a'), 'b')
+    assert cache.get(make_params('a')) is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_evicts_least_recently_used():
+    cache = ResultCache(max_entries=2)
+    for prompt in ('a', 'b'):
+        cache.put(make_params(prompt), prompt)
+    cache.get(make_params('a'))
+    cache.put(make_params('c'), 'c')
+    assert cache.get(make_params('b')) is None
+    assert cache.get(make_params('a')) == 'a'
+    assert cache.get(make_params('c')) == 'c'
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'results.jsonl')
+    cache = ResultCache(path=path)
+    cache.put(make_params('a'), Generation('b', 'eos', 2))
+    cache.put(make_params('c'), [{'candidate': 'd', 'logprob': -1.0, 'tokens': 1}])
+    cache._put('expired', time.time() - 1, 'e')
+    cache.save()
+
+    loaded = ResultCache(path=path)
+    loaded.load()
+    assert loaded.stats()['entries'] == 2
+    assert loaded.get(make_params('a')) == Generation('b', 'eos', 2)
+    assert isinstance(loaded.get(make_params('a')), Generation)
+    assert loaded.get(make_params('c')) == [{'candidate': 'd', 'logprob': -1.0, 'tokens': 1}]
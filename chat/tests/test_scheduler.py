@@ -0,0 +1,111 @@
+from types import SimpleNamespace
+
+import pytest
+
+from lib import chatbot
+from lib.budget import GenerationBudget
+from lib.prefix_cache import PrefixCache
+from lib.scheduler import BatchScheduler, QueueFull
+
+from conftest import make_params
+
+PROMPTS = [
+    'Write a response that',
+    'Classify the following sentence',
+    'Label the category towards',
+]
+
+
+def test_batch_matches_single_generations(tokenizer, model):
+    singles = [chatbot.generate(tokenizer, model, **make_params(prompt)) for prompt in PROMPTS]
+    batch = chatbot.generate_batch(tokenizer, model, PROMPTS, [12] * 3, [-1] * 3)
+    assert batch == singles
+
+
+def test_batch_drops_finished_rows(tokenizer, model):
+    max_new_tokens = [12, 3, 7]
+    singles = [
+        chatbot.generate(tokenizer, model, **make_params(prompt, max_new_tokens=n))
+        for prompt, n in zip(PROMPTS, max_new_tokens)
+    ]
+    batch = chatbot.generate_batch(tokenizer, model, PROMPTS, max_new_tokens, [-1] * 3)
+    assert batch == singles
+    assert [generation.tokens for generation in batch] == max_new_tokens
+    assert all(generation.finish_reason == 'length' for generation in batch)
+
+
+def test_batch_with_cached_prefix(tokenizer, model):
+    prefix = PrefixCache(tokenizer, model).get('Classify the following')
+    prompts = ['Classify the following sentence', 'Classify the following question into']
+    without = chatbot.generate_batch(tokenizer, model, prompts, [8, 8], [-1, -1])
+    assert chatbot.generate_batch(tokenizer, model, prompts, [8, 8], [-1, -1], prefix=prefix) == without
+
+
+def test_scheduler_batches_compatible_requests(tokenizer, model):
+    scheduler = BatchScheduler(tokenizer, model, max_batch_size=len(PROMPTS), max_wait_ms=1000, length_bucket=64)
+    futures = [scheduler.submit(**make_params(prompt, max_new_tokens=4 + i)) for i, prompt in enumerate(PROMPTS)]
+    scheduler.start()
+    results = [future.result(timeout=60) for future in futures]
+    assert results == [
+        chatbot.generate(tokenizer, model, **make_params(prompt, max_new_tokens=4 + i))
+        for i, prompt in enumerate(PROMPTS)
+    ]
+
+
+def test_next_batch_groups_by_key(tokenizer, model):
+    scheduler = BatchScheduler(tokenizer, model, max_batch_size=4, max_wait_ms=0)
+    greedy = [scheduler.submit(**make_params(prompt)) for prompt in PROMPTS[:2]]
+    sampled = scheduler.submit(**make_params(PROMPTS[2], do_sample=True, priority='high'))
+    assert [r.future for r in scheduler._next_batch()] == greedy
+    assert [r.future for r in scheduler._next_batch()] == [sampled]
+
+
+def test_high_priority_goes_first(tokenizer, model):
+    scheduler = BatchScheduler(tokenizer, model, max_batch_size=1, max_wait_ms=0, short_max_new_tokens=8)
+    long = scheduler.submit(**make_params(PROMPTS[0], max_new_tokens=32))
+    short = scheduler.submit(**make_params(PROMPTS[1], max_new_tokens=8))
+    scored = scheduler.submit_score(PROMPTS[2], ['a', 'b'])
+    assert [scheduler._next_batch()[0].future for _ in range(3)] == [short, scored, long]
+
+
+def test_full_lane_rejects(tokenizer, model):
+    scheduler = BatchScheduler(tokenizer, model, max_queue=1)
+    scheduler.submit(**make_params(PROMPTS[0], priority='low'))
+    scheduler.submit(**make_params(PROMPTS[1], priority='high'))
+    with pytest.raises(QueueFull) as exc_info:
+        scheduler.submit(**make_params(PROMPTS[2], priority='low'))
+    assert exc_info.value.priority == 'low'
+    assert scheduler.stats()['queue_depth'] == {'high': 1, 'low': 1}
+
+
+def test_cancelled_requests_are_dropped(tokenizer, model):
+    scheduler = BatchScheduler(tokenizer, model, max_batch_size=4, max_wait_ms=0)
+    cancelled, kept = [scheduler.submit(**make_params(prompt)) for prompt in PROMPTS[:2]]
+    assert cancelled.cancel()
+    assert [r.future for r in scheduler._next_batch()] == [kept]
+    assert kept.running()
+
+
+def test_greedy_returns_one_sequence(tokenizer, model):
+    scheduler = BatchScheduler(tokenizer, model)
+    scheduler.submit(**make_params(PROMPTS[0], num_return_sequences=3))
+    request = scheduler._next_batch()[0]
+    assert request.params['num_return_sequences'] == 1
+
+
+def test_budget_caps_batch(tokenizer, model):
+    length = len(tokenizer.encode(PROMPTS[0]))
+    needed = GenerationBudget(model, 1).estimate(length, 12)
+    scheduler = BatchScheduler(tokenizer, model, max_batch_size=4, max_wait_ms=0, memory_budget=needed + needed // 2)
+    futures = [scheduler.submit(**make_params(prompt)) for prompt in [PROMPTS[0]] * 2]
+    assert [r.future for r in scheduler._next_batch()] == futures[:1]
+    assert [r.future for r in scheduler._next_batch()] == futures[1:]
+
+
+def test_paused_assistant_counts_down_for_prefixed_requests(tokenizer, model):
+    assistant = chatbot.Assistant(model, window=1, min_accept_rate=0.5, cooldown=2)
+    assistant.record(1, 0)
+    scheduler = BatchScheduler(tokenizer, SimpleNamespace(assistant=assistant))
+    params = make_params(PROMPTS[0])
+    assert [scheduler._assisted(params) for _ in range(3)] == [False, False, True]
+    assert not scheduler._assisted(make_params(PROMPTS[0], do_sample=True))
@@ -0,0 +1,57 @@
+from lib import chatbot
+from lib.chatbot import StopMatcher
+
+from conftest import make_params, stop_in
+
+STOP = '[|Human|]:'
+
+
+def _ids(tokenizer, text: str):
+    return tokenizer.encode(text, add_special_tokens=False)
+
+
+def test_matches_across_token_boundaries(tokenizer):
+    ids = _ids(tokenizer, 'Sure, here it is. [|Human|]:')
+    assert len(_ids(tokenizer, STOP)) > 1
+    matcher = StopMatcher(tokenizer, [STOP])
+    assert matcher.match(ids)
+    assert not matcher.match(ids[:-1])
+
+
+def test_matches_stop_token_ids(tokenizer):
+    ids = _ids(tokenizer, 'Sure, here it is. [|Human|]:')
+    matcher = StopMatcher(tokenizer, stop_token_ids=[ids[-2:]])
+    assert matcher.match(ids)
+    assert not matcher.match(ids[:-1])
+    assert matcher.strip_token_ids(ids) == ids[:-2]
+
+
+def test_truncate_and_holdback(tokenizer):
+    matcher = StopMatcher(tokenizer, [STOP, '###'])
+    assert matcher.truncate('answer ### more [|Human|]: next') == 'answer '
+    assert matcher.truncate('answer') == 'answer'
+    assert matcher.holdback('answer [|Hu') == len('[|Hu')
+    assert matcher.holdback('answer #') == 1
+    assert matcher.holdback('answer') == 0
+
+
+def test_empty_matcher_is_falsy(tokenizer):
+    assert not StopMatcher(tokenizer, [''], [[]])
+    assert StopMatcher(tokenizer, ['x'])
+
+
+def test_generation_stops_and_truncates(tokenizer, model):
+    params = make_params('Classify the following sentence', max_new_tokens=16)
+    full = chatbot.generate(tokenizer, model, **params)
+    stop = stop_in(full.text)
+
+    stopped = chatbot.generate(tokenizer, model, **params, stop=[stop])
+    assert stopped.finish_reason == 'stop'
+    assert stopped.text == full.text[:full.text.find(stop)]
+    assert stopped.tokens < full.tokens
+
+    batched = chatbot.generate_batch(
+        tokenizer, model, [params['prompt']], [16], [-1],
+        stops=[StopMatcher(tokenizer, [stop])],
+    )
+    assert batched == [stopped]
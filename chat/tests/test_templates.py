@@ -0,0 +1,104 @@
+import io
+
+import pytest
+
+from lib.templates import Template, TemplateConflict, TemplateRegistry, UnknownTemplate
+
+from bench.tiny_model import CORPUS
+
+TEMPLATES = [
+    'Below is an instruction.\n\n### Instruction:\n{question}\n\n### Response:\n',
+    '[|Human|]: {question}\n[|SA|]:',
+    'Label the category towards the sentence: {sentence} among {categories}.',
+    'Class:{x}.',
+    '{question}',
+    'no variables at all',
+]
+VARIABLES = ['What is Amazon S3?', ' 파이썬 코드를 보여줘.', 'x', '', 'Sure,  two  spaces\n']
+
+
+class SentencePieceTokenizer(object):
+    """A LLaMA-like tokenizer, which adds a `▁` at the start of every text it encodes, and a bos token."""
+
+    bos_token_id = 1
+
+    def __init__(self) -> None:
+        import sentencepiece as spm
+
+        model = io.BytesIO()
+        spm.SentencePieceTrainer.train(
+            sentence_iterator=iter(CORPUS * 8),
+            model_writer=model,
+            vocab_size=400,
+            hard_vocab_limit=False,
+            character_coverage=1.0,
+            byte_fallback=True,
+            minloglevel=2,
+        )
+        self.processor = spm.SentencePieceProcessor(model_proto=model.getvalue())
+
+    def encode(self, text: str, add_special_tokens: bool = True):
+        ids = self.processor.encode(text)
+        return [self.bos_token_id] + ids if add_special_tokens else ids
+
+
+@pytest.fixture(scope='module')
+def sentencepiece_tokenizer():
+    return SentencePieceTokenizer()
+
+
+def _values(template: Template, value: str) -> dict:
+    return {field: value for field in template.variables}
+
+
+@pytest.mark.parametrize('text', TEMPLATES)
+def test_render_matches_full_encode(tokenizer, text):
+    template = Template(tokenizer, 'name', '1', text)
+    for value in VARIABLES:
+        rendered, ids = template.render(tokenizer, _values(template, value))
+        assert rendered == template.format(_values(template, value))
+        assert ids == tokenizer.encode(rendered)
+
+
+@pytest.mark.parametrize('text', TEMPLATES)
+def test_sentencepiece_render_matches_full_encode(sentencepiece_tokenizer, text):
+    template = Template(sentencepiece_tokenizer, 'name', '1', text)
+    for value in VARIABLES:
+        rendered, ids = template.render(sentencepiece_tokenizer, _values(template, value))
+        assert ids == sentencepiece_tokenizer.encode(rendered)
+
+
+def test_sentencepiece_segments_fall_back(sentencepiece_tokenizer):
+    # a value glued to the text before it would start with a `▁` when encoded on its own
+    template = Template(sentencepiece_tokenizer, 'name', '1', 'Class:{x}.')
+    assert not template.segmented
+    assert template.to_dict()['segmented'] is False
+
+
+def test_byte_level_segments_are_reused(tokenizer):
+    template = Template(tokenizer, 'name', '1', TEMPLATES[0])
+    assert template.segmented
+    assert template.head == 'Below is an instruction.\n\n### Instruction:\n'
+    assert template.to_dict()['static_tokens'] > 0
+
+
+def test_missing_variable(tokenizer):
+    template = Template(tokenizer, 'name', '1', TEMPLATES[2])
+    with pytest.raises(ValueError):
+        template.render(tokenizer, {'sentence': 'a'})
+    with pytest.raises(ValueError):
+        template.format({'sentence': 'a'})
+
+
+def test_registry(tokenizer):
+    registry = TemplateRegistry(tokenizer)
+    template = registry.register('chat', '1', TEMPLATES[1])
+    assert registry.register('chat', '1', TEMPLATES[1]) is template
+    assert registry.get('chat', '1') is template
+    registry.register('chat', '2', TEMPLATES[0])
+    assert [t['version'] for t in registry.list()] == ['1', '2']
+
+    with pytest.raises(TemplateConflict):
+        registry.register('chat', '1', TEMPLATES[0])
+    with pytest.raises(UnknownTemplate):
+        registry.get('chat', '3')
@@ -1,53 +1,257 @@
 import json
-import requests
+import time
+import httpx
+import asyncio
+from contextlib import contextmanager
+from typing import Dict, List, Union
+from urllib.parse import urljoin
 
 from opentelemetry import trace
 
-from .o11y import tracer
+from . import metrics
+from .o11y import tracer, set_payload
 from .logger import logger
+from .prompt import TEMPLATES
+
+_REQUEST = {
+    (operation, outcome): metrics.CHAT_REQUEST.labels(operation, outcome)
+    for operation in ('generate', 'generate_many', 'score')
+    for outcome in ('ok', 'busy', 'error')
+}
+
+
+class ChatbotBusy(Exception):
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f'chat server is busy, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+@contextmanager
+def _measure(operation: str):
+    started_at = time.monotonic()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    except ChatbotBusy:
+        outcome = 'busy'
+        raise
+    finally:
+        _REQUEST[operation, outcome].observe(time.monotonic() - started_at)
 
 
 class ChatbotAdapter(object):
-    def __init__(self, endpoint: str) -> None:
+    """Async client for the chat service, sharing one keep-alive connection pool."""
+
+    def __init__(self,
+        endpoint: str,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        timeout: float = 30.0,
+        connect_timeout: float = 5.0,
+        max_retries: int = 2,
+        max_retry_wait: float = 5.0,
+    ) -> None:
         self._endpoint = endpoint
+        self._score_endpoint = urljoin(endpoint, '/v1/score')
+        self._batch_endpoint = urljoin(endpoint, '/v1/chat/batch')
+        self._max_retries = max_retries
+        self._max_retry_wait = max_retry_wait
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+            ),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        )
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def _post(self, url: str, body: dict, headers: dict) -> httpx.Response:
+        """Posts to the chat server, retrying while it sheds load with 429."""
+        for attempt in range(self._max_retries + 1):
+            resp = await self._client.post(url, json=body, headers=headers)
+            if resp.status_code != 429:
+                return resp
+            retry_after = float(resp.headers.get('Retry-After', 1))
+            if attempt == self._max_retries or retry_after > self._max_retry_wait:
+                raise ChatbotBusy(retry_after)
+            logger.warning('chat server is busy, retrying after %ss', retry_after)
+            metrics.CHAT_RETRIES.inc()
+            await asyncio.sleep(retry_after)
+
+    @staticmethod
+    def _template_fields(template: str, variables: Dict[str, str]) -> dict:
+        if not template:
+            return {}
+        return {
+            'template': template,
+            'template_version': TEMPLATES[template].version,
+            'variables': variables or {},
+        }
+
+    @staticmethod
+    def _with_text(body: dict) -> dict:
+        """Returns a request naming a template that also carries its text, for the serving worker to register."""
+        logger.info('sending template %s@%s with its text', body['template'], body['template_version'])
+        return {**body, 'template_text': TEMPLATES[body['template']].text}
+
+    async def _post_template(self, url: str, body: dict, headers: dict) -> httpx.Response:
+        """Posts a request naming a template, sending its text along if the chat server does not know it.
 
-    def generate(self,
-        prompt: str,
+        The chat server keeps templates in memory, so this covers its restarts
+        as well as a front deployed with new template versions. Every prefork
+        worker of the chat server has its own templates, so the text goes with
+        the retry itself and the worker that serves it registers it.
+        """
+        resp = await self._post(url, body, headers)
+        if resp.status_code == 404 and body.get('template') and resp.json().get('code') == 'unknown_template':
+            resp = await self._post(url, self._with_text(body), headers)
+        return resp
+
+    def _headers(self, span) -> dict:
+        headers = {}
+        span_context = span.get_span_context()
+        if span_context.is_valid:
+            headers['X-Amzn-Trace-Id'] = f'Root={span_context.trace_id};Parent={span_context.span_id};Sampled={int(span_context.trace_flags.sampled)}'
+        return headers
+
+    async def generate(self,
+        prompt: str = '',
         top_k: int = 0,
         top_p: float = 1.0,
         max_new_tokens: int = 32,
         temperature: float = 0.5,
         num_return_sequences: int = 1,
         do_sample: bool = False,
+        eos_token_id: int = 2,
+        stop: List[str] = None,
+        stop_token_ids: List[List[int]] = None,
+        prefix: str = '',
+        priority: str = '',
+        template: str = '',
+        variables: Dict[str, str] = None,
+        model: str = '',
     ) -> str:
-        with tracer.start_as_current_span('chatbot adapter') as span:
+        """Generates for a prompt, or for a chat server `template` filled with `variables`.
+
+        `model` names one of the chat server's models, its default one when empty.
+        """
+        with tracer.start_as_current_span('chatbot adapter') as span, _measure('generate'):
             body = {
+                'model': model,
                 'prompt': prompt,
+                **self._template_fields(template, variables),
                 'top_k': top_k,
                 'top_p': top_p,
                 'max_new_tokens': max_new_tokens,
                 'temperature': temperature,
                 'num_return_sequences': num_return_sequences,
                 'do_sample': do_sample,
+                'eos_token_id': eos_token_id,
+                'stop': stop or [],
+                'stop_token_ids': stop_token_ids or [],
+                'prefix': prefix,
+                'priority': priority,
             }
-            span.set_attribute('body', json.dumps(body))
+            set_payload(span, 'body', lambda: json.dumps(body))
 
-            headers = {}
-            span_context = span.get_span_context()
-            if span_context.is_valid:
-                headers['X-Amzn-Trace-Id'] = f'Root={span_context.trace_id};Parent={span_context.span_id};Sampled=1'
+            headers = self._headers(span)
+            resp = await self._post_template(self._endpoint, body, headers)
+            if resp.status_code != 200:
+                raise Exception('failed to request to chat server..')
 
-            resp = requests.post(self._endpoint, json=body, headers=headers, timeout=30)
+            data = resp.json()
+            logger.info('resp: %s', data)
+            set_payload(span, 'response', lambda: json.dumps(data))
+            if data['status'] == 'error':
+                exc = Exception('failed to generate text..')
+                span.record_exception(exc)
+                span.set_status(trace.Status(trace.StatusCode.ERROR))
+                raise exc
+
+            return data['generation']
+
+    async def generate_many(self, items: List[dict]) -> List[Union[str, Exception]]:
+        """Generates for several prompts in one request.
+
+        Each item takes the keyword arguments of `generate`. Results come back
+        in order, with an Exception in place of every item that failed.
+        """
+        with tracer.start_as_current_span('chatbot adapter batch') as span, _measure('generate_many'):
+            body = {
+                'items': [{
+                    **{k: v for k, v in item.items() if k not in ('template', 'variables')},
+                    **self._template_fields(item.get('template'), item.get('variables')),
+                    'stop': item.get('stop') or [],
+                    'stop_token_ids': item.get('stop_token_ids') or [],
+                } for item in items],
+            }
+            span.set_attribute('batch_size', len(items))
+            metrics.BATCH_SIZE.observe(len(items))
+
+            headers = self._headers(span)
+            resp = await self._post(self._batch_endpoint, body, headers)
             if resp.status_code != 200:
                 raise Exception('failed to request to chat server..')
 
             data = resp.json()
-            logger.info(f'resp: {data}')
-            span.set_attribute('response', json.dumps(data))
+            # only the items the chat server did not know the template of are sent again, with its text
+            unknown = [i for i, result in enumerate(data.get('results', [])) if result.get('code') == 'unknown_template']
+            if unknown:
+                resp = await self._post(self._batch_endpoint, {
+                    'items': [self._with_text(body['items'][i]) for i in unknown],
+                }, headers)
+                if resp.status_code != 200:
+                    raise Exception('failed to request to chat server..')
+                for i, result in zip(unknown, resp.json()['results']):
+                    data['results'][i] = result
+
+            logger.info('resp: %s', data)
+            set_payload(span, 'response', lambda: json.dumps(data))
             if data['status'] == 'error':
                 exc = Exception('failed to generate text..')
                 span.record_exception(exc)
                 span.set_status(trace.Status(trace.StatusCode.ERROR))
                 raise exc
 
-            return data['generation']
\ No newline at end of file
+            return [
+                result['generation'] if result['status'] == 'ok' else Exception(result['message'])
+                for result in data['results']
+            ]
+
+    async def score(self,
+        prompt: str = '',
+        candidates: List[str] = None,
+        prefix: str = '',
+        template: str = '',
+        variables: Dict[str, str] = None,
+        model: str = '',
+    ) -> List[float]:
+        """Returns the per-token log-likelihood of each candidate continuation, in order."""
+        with tracer.start_as_current_span('chatbot adapter score') as span, _measure('score'):
+            body = {
+                'model': model,
+                'prompt': prompt,
+                **self._template_fields(template, variables),
+                'candidates': candidates,
+                'prefix': prefix,
+            }
+            set_payload(span, 'body', lambda: json.dumps(body))
+
+            headers = self._headers(span)
+            resp = await self._post_template(self._score_endpoint, body, headers)
+            if resp.status_code != 200:
+                raise Exception('failed to request to chat server..')
+
+            data = resp.json()
+            logger.info('resp: %s', data)
+            set_payload(span, 'response', lambda: json.dumps(data))
+            if data['status'] == 'error':
+                exc = Exception('failed to score candidates..')
+                span.record_exception(exc)
+                span.set_status(trace.Status(trace.StatusCode.ERROR))
+                raise exc
+
+            return [item['logprob'] / max(item['tokens'], 1) for item in data['scores']]
\ No newline at end of file
@@ -0,0 +1,102 @@
+import os
+import re
+from functools import lru_cache
+from typing import List, Tuple
+
+from .logger import logger
+
+TURN_PATTERN = re.compile(r'(?=\[\|(?:Human|SA)\|\]:)')
+HUMAN_MARK = '[|Human|]:'
+
+
+def load_tokenizer(name: str):
+    """Loads a `tokenizers` tokenizer from a tokenizer.json path or a hub model name."""
+    from tokenizers import Tokenizer
+
+    if os.path.isfile(name):
+        return Tokenizer.from_file(name)
+    return Tokenizer.from_pretrained(name)
+
+
+class ContextManager(object):
+    """Fits the conversation context into a token budget.
+
+    The context is split into `[|Human|]`/`[|SA|]` turns. The most recent turns
+    are kept whole while they fit in `max_tokens`, the older ones are compacted
+    into a digest of what the human asked, at most `digest_tokens` long.
+    Token counts are memoized per turn, so a growing conversation only
+    tokenizes its new turns. Without a tokenizer, every UTF-8 byte is counted
+    as a token: Korean often falls back to byte tokens, so anything less
+    could overflow the model's context window.
+    """
+
+    def __init__(self, max_tokens: int = 1024, digest_tokens: int = 64, tokenizer=None, cache_size: int = 4096) -> None:
+        self.max_tokens = max_tokens
+        self.digest_tokens = digest_tokens
+        self.tokenizer = tokenizer
+        self.count = lru_cache(maxsize=cache_size)(self._tokenize)
+
+    @classmethod
+    def from_env(cls, max_tokens: int, digest_tokens: int, tokenizer_name: str = '') -> 'ContextManager':
+        tokenizer = None
+        if tokenizer_name:
+            try:
+                tokenizer = load_tokenizer(tokenizer_name)
+            except Exception:
+                logger.exception(f'failed to load tokenizer: {tokenizer_name}, estimating tokens instead')
+        return cls(max_tokens, digest_tokens, tokenizer)
+
+    def _tokenize(self, text: str) -> int:
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+        return len(text.encode('utf-8'))
+
+    @staticmethod
+    def split_turns(context: str) -> List[str]:
+        return [turn for turn in TURN_PATTERN.split(context) if turn.strip()]
+
+    def _digest(self, turns: List[str]) -> str:
+        asked = []
+        for turn in reversed(turns):
+            if not turn.startswith(HUMAN_MARK):
+                continue
+            question = turn[len(HUMAN_MARK):].strip().split('\n')[0]
+            digest = self._format_digest([question] + asked)
+            if self._tokenize(digest) > self.digest_tokens:
+                break
+            asked.insert(0, question)
+        return self._format_digest(asked) if asked else ''
+
+    @staticmethod
+    def _format_digest(asked: List[str]) -> str:
+        return 'Earlier, the human asked: ' + ' / '.join(asked) + '\n\n'
+
+    def fit(self, context: str) -> Tuple[str, dict]:
+        """Returns the context trimmed to the budget and its token counts."""
+        turns = self.split_turns(context)
+        counts = [self.count(turn) for turn in turns]
+        stats = {
+            'tokens_before': sum(counts),
+            'tokens_after': sum(counts),
+            'turns': len(turns),
+            'kept_turns': len(turns),
+        }
+        if stats['tokens_before'] <= self.max_tokens:
+            return context, stats
+
+        budget = self.max_tokens - self.digest_tokens
+        kept, used = 0, 0
+        for count in reversed(counts):
+            if used + count > budget:
+                break
+            kept, used = kept + 1, used + count
+        # never start on an answer whose question was dropped
+        while kept and not turns[len(turns) - kept].startswith(HUMAN_MARK):
+            kept, used = kept - 1, used - counts[len(turns) - kept]
+
+        dropped = turns[:len(turns) - kept]
+        digest = self._digest(dropped)
+        trimmed = digest + ''.join(turns[len(turns) - kept:])
+        stats['tokens_after'] = used + (self._tokenize(digest) if digest else 0)
+        stats['kept_turns'] = kept
+        return trimmed, stats
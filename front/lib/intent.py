@@ -0,0 +1,262 @@
+import re
+import json
+import math
+import random
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional
+
+from .prompt import PROMPT, CATEGORY_UNKNOWN
+
+INTENT_LOG_MESSAGE = 'intent label'
+
+
+class Example(NamedTuple):
+    user_input: str
+    is_question: bool
+    category: str = ''
+
+
+class Prediction(NamedTuple):
+    is_question: bool
+    question_confidence: float
+    category: str
+    category_confidence: float
+
+
+def few_shot_examples() -> List[Example]:
+    """Returns the labelled examples embedded in the classifier prompts."""
+    examples = []
+    for sentence, label in re.findall(r'Sentence: (.+)\nClass: (\w+)\.', PROMPT['question']):
+        examples.append(Example(sentence, label == 'question'))
+    for sentence, label in re.findall(r'Sentence: (.+)\nCategory: (.+)\.', PROMPT['category']):
+        category = label if label == CATEGORY_UNKNOWN else label.lower()
+        examples.append(Example(sentence, True, category))
+    return examples
+
+
+def read_examples(path: str) -> List[Example]:
+    """Reads `(user_input, is_question, category)` triples from JSON lines.
+
+    Both plain triples and the front's own log records are accepted.
+    """
+    examples = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if 'user_input' not in record or 'is_question' not in record:
+                continue
+            examples.append(Example(
+                record['user_input'],
+                bool(record['is_question']),
+                record.get('category') or '',
+            ))
+    return examples
+
+
+class _Head(object):
+    """Softmax regression over sparse features."""
+
+    def __init__(self, labels: List[str]) -> None:
+        self.labels = labels
+        self.bias = [0.0] * len(labels)
+        self.weights: Dict[int, List[float]] = {}
+
+    def probabilities(self, features: Dict[int, float]) -> List[float]:
+        scores = list(self.bias)
+        for idx, value in features.items():
+            row = self.weights.get(idx)
+            if row is not None:
+                for k, w in enumerate(row):
+                    scores[k] += w * value
+        top = max(scores)
+        exps = [math.exp(score - top) for score in scores]
+        total = sum(exps)
+        return [e / total for e in exps]
+
+    def fit(self, samples, epochs: int, learning_rate: float, l2: float):
+        samples = list(samples)
+        for _ in range(epochs):
+            random.shuffle(samples)
+            for features, label in samples:
+                probs = self.probabilities(features)
+                target = self.labels.index(label)
+                for k in range(len(self.labels)):
+                    grad = probs[k] - (1.0 if k == target else 0.0)
+                    self.bias[k] -= learning_rate * grad
+                    for idx, value in features.items():
+                        row = self.weights.setdefault(idx, [0.0] * len(self.labels))
+                        row[k] -= learning_rate * (grad * value + l2 * row[k])
+
+    def to_dict(self) -> dict:
+        return {
+            'labels': self.labels,
+            'bias': self.bias,
+            'weights': {str(idx): row for idx, row in self.weights.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> '_Head':
+        head = cls(data['labels'])
+        head.bias = data['bias']
+        head.weights = {int(idx): row for idx, row in data['weights'].items()}
+        return head
+
+
+class IntentModel(object):
+    """Char n-gram TF-IDF features with a linear head for each classifier.
+
+    The question head decides question vs statement and the category head picks
+    one of the categories the LLM classifier returns.
+    """
+
+    def __init__(self, min_n: int = 2, max_n: int = 4) -> None:
+        self.min_n = min_n
+        self.max_n = max_n
+        self.vocab: Dict[str, int] = {}
+        self.idf: List[float] = []
+        self.question: Optional[_Head] = None
+        self.category: Optional[_Head] = None
+
+    def _ngrams(self, text: str) -> Counter:
+        text = f' {text.lower().strip()} '
+        return Counter(
+            text[i:i + n]
+            for n in range(self.min_n, self.max_n + 1)
+            for i in range(len(text) - n + 1)
+        )
+
+    def _features(self, text: str) -> Dict[int, float]:
+        features = {}
+        for gram, count in self._ngrams(text).items():
+            idx = self.vocab.get(gram)
+            if idx is not None:
+                features[idx] = (1 + math.log(count)) * self.idf[idx]
+        norm = math.sqrt(sum(v * v for v in features.values())) or 1.0
+        return {idx: v / norm for idx, v in features.items()}
+
+    def fit(self, examples: List[Example], epochs: int = 20, learning_rate: float = 0.5, l2: float = 1e-5):
+        document_frequency = Counter()
+        for example in examples:
+            document_frequency.update(self._ngrams(example.user_input).keys())
+        self.vocab = {gram: idx for idx, gram in enumerate(sorted(document_frequency))}
+        self.idf = [
+            math.log((1 + len(examples)) / (1 + document_frequency[gram])) + 1
+            for gram in sorted(document_frequency)
+        ]
+
+        features = [self._features(example.user_input) for example in examples]
+        self.question = _Head(['question', 'statement'])
+        self.question.fit(
+            [(f, 'question' if e.is_question else 'statement') for f, e in zip(features, examples)],
+            epochs, learning_rate, l2,
+        )
+        categorized = [(f, e.category) for f, e in zip(features, examples) if e.is_question and e.category]
+        self.category = _Head(sorted({label for _, label in categorized} | {CATEGORY_UNKNOWN}))
+        self.category.fit(categorized, epochs, learning_rate, l2)
+        return self
+
+    def predict(self, user_input: str) -> Prediction:
+        features = self._features(user_input)
+        question = self.question.probabilities(features)
+        category = self.category.probabilities(features)
+        best = category.index(max(category))
+        return Prediction(
+            is_question=question[0] >= question[1],
+            question_confidence=max(question),
+            category=self.category.labels[best],
+            category_confidence=category[best],
+        )
+
+    def save(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'min_n': self.min_n,
+                'max_n': self.max_n,
+                'vocab': self.vocab,
+                'idf': self.idf,
+                'question': self.question.to_dict(),
+                'category': self.category.to_dict(),
+            }, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> 'IntentModel':
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        model = cls(data['min_n'], data['max_n'])
+        model.vocab = data['vocab']
+        model.idf = data['idf']
+        model.question = _Head.from_dict(data['question'])
+        model.category = _Head.from_dict(data['category'])
+        return model
+
+
+def evaluate(model: IntentModel, examples: List[Example], threshold: float) -> dict:
+    """Reports accuracy against the LLM labels, overall and above the threshold."""
+    question_total = question_correct = question_covered = question_covered_correct = 0
+    category_total = category_correct = category_covered = category_covered_correct = 0
+    for example in examples:
+        prediction = model.predict(example.user_input)
+        correct = prediction.is_question == example.is_question
+        question_total += 1
+        question_correct += correct
+        if prediction.question_confidence >= threshold:
+            question_covered += 1
+            question_covered_correct += correct
+
+        if example.is_question and example.category:
+            correct = prediction.category == example.category
+            category_total += 1
+            category_correct += correct
+            if prediction.category_confidence >= threshold:
+                category_covered += 1
+                category_covered_correct += correct
+
+    ratio = lambda a, b: a / b if b else 0.0
+    return {
+        'threshold': threshold,
+        'question': {
+            'examples': question_total,
+            'accuracy': ratio(question_correct, question_total),
+            'coverage': ratio(question_covered, question_total),
+            'covered_accuracy': ratio(question_covered_correct, question_covered),
+        },
+        'category': {
+            'examples': category_total,
+            'accuracy': ratio(category_correct, category_total),
+            'coverage': ratio(category_covered, category_total),
+            'covered_accuracy': ratio(category_covered_correct, category_covered),
+        },
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Train and evaluate the local intent classifier')
+    commands = parser.add_subparsers(dest='command', required=True)
+    train = commands.add_parser('train')
+    train.add_argument('--logs', nargs='*', default=[], help='JSON lines with user_input, is_question, category')
+    train.add_argument('--out', required=True)
+    train.add_argument('--epochs', type=int, default=20)
+    train.add_argument('--holdout', type=float, default=0.2, help='share of the logs kept out for evaluation')
+    train.add_argument('--threshold', type=float, default=0.9)
+    evaluation = commands.add_parser('evaluate')
+    evaluation.add_argument('--model', required=True)
+    evaluation.add_argument('--logs', nargs='+', required=True)
+    evaluation.add_argument('--threshold', type=float, default=0.9)
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        logged = [example for path in args.logs for example in read_examples(path)]
+        random.shuffle(logged)
+        split = int(len(logged) * (1 - args.holdout))
+        model = IntentModel().fit(few_shot_examples() + logged[:split], epochs=args.epochs)
+        model.save(args.out)
+        print(json.dumps(evaluate(model, logged[split:], args.threshold), indent=2))
+    else:
+        model = IntentModel.load(args.model)
+        examples = [example for path in args.logs for example in read_examples(path)]
+        print(json.dumps(evaluate(model, examples, args.threshold), indent=2))
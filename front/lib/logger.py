@@ -1,12 +1,29 @@
 import sys
+import atexit
 import logging
+from queue import Queue
+from logging.handlers import QueueHandler, QueueListener
 from pythonjsonlogger import jsonlogger
 
+from .telemetry import PROFILE
+
 
 logger = logging.getLogger('api')
-logger.setLevel(logging.INFO)
+logger.setLevel(PROFILE.log_level)
 
 logHandler = logging.StreamHandler(sys.stdout)
 formatter = jsonlogger.JsonFormatter()
 logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
+if PROFILE.async_logging:
+    # JSON formatting and the write to stdout happen on the listener thread
+    log_queue = Queue()
+    listener = QueueListener(log_queue, logHandler)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(QueueHandler(log_queue))
+else:
+    logger.addHandler(logHandler)
+
+# intent labels for `python -m lib.intent train`, logged at INFO whatever level the telemetry profile sets
+intent_logger = logging.getLogger('api.intent')
+intent_logger.setLevel(logging.INFO)
@@ -1,3 +1,6 @@
+import hashlib
+from typing import NamedTuple
+
 QUESTION_PROMPT = '''
 Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
 
@@ -114,11 +117,29 @@ CATEGORIES = '\n'.join([
     '- Satellite',
     '- Security and Compliance',
     # Unknown Category
-    '- {CATEGORY_UNKNOWN}',
+    f'- {CATEGORY_UNKNOWN}',
 ])
 
 PROMPT = {
     'question': QUESTION_PROMPT,
     'category': CATEGORY_PROMPT,
     'chat': CHAT_PROMPT,
-}
\ No newline at end of file
+}
+
+
+class Template(NamedTuple):
+    version: str
+    text: str
+
+
+def _template(text: str) -> Template:
+    # the version follows the text, so a changed prompt never matches an older registration
+    return Template(hashlib.sha256(text.encode('utf-8')).hexdigest()[:12], text)
+
+
+# registered with the chat service, which tokenizes their static parts once
+TEMPLATES = {
+    'question': _template(QUESTION_PROMPT),
+    'category': _template(CATEGORY_PROMPT.replace('{categories}', CATEGORIES)),
+    'chat': _template(CHAT_PROMPT),
+}
@@ -0,0 +1,126 @@
+import re
+import sys
+import zlib
+import unicodedata
+from typing import Optional, Tuple
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SemanticCache(object):
+    """Serves orchestration results for inputs similar to one seen before.
+
+    Inputs are embedded as L2-normalized hashed char n-gram vectors, kept in one
+    matrix so a lookup is a single matrix-vector product. The matrix doubles as
+    entries are added, up to `max_entries` or `max_bytes`, after which entries
+    are evicted least recently used first. Inputs with nothing left once
+    normalized, e.g. only punctuation, are neither looked up nor cached.
+    """
+
+    def __init__(self,
+        threshold: float = 0.9,
+        max_entries: int = 4096,
+        max_bytes: int = 64 * 1024 * 1024,
+        dim: int = 4096,
+        ngram: int = 3,
+    ) -> None:
+        self.threshold = threshold
+        self.dim = dim
+        self.ngram = ngram
+        self.max_bytes = max_bytes
+        self.capacity = max(1, min(max_entries, max_bytes // (dim * 4)))
+        self.hits = 0
+        self.misses = 0
+        self._vectors = np.zeros((min(self.capacity, 64), dim), dtype=np.float32)
+        self._entries = OrderedDict()  # normalized input -> (slot, value, size)
+        self._slots = {}  # slot -> normalized input
+        self._free = list(range(len(self._vectors) - 1, -1, -1))
+        self._bytes = 0
+
+    @staticmethod
+    def normalize(user_input: str) -> str:
+        text = unicodedata.normalize('NFKC', user_input).lower()
+        text = re.sub(r'[^\w\s]', ' ', text)
+        return ' '.join(text.split())
+
+    def _embed(self, text: str) -> np.ndarray:
+        padded = f' {text} '
+        grams = [padded[i:i + self.ngram] for i in range(len(padded) - self.ngram + 1)]
+        grams += text.split()
+        vector = np.zeros(self.dim, dtype=np.float32)
+        if grams:
+            indexes = [zlib.crc32(gram.encode('utf-8')) % self.dim for gram in grams]
+            np.add.at(vector, indexes, 1.0)
+            vector /= np.linalg.norm(vector)
+        return vector
+
+    def _size(self, value: dict) -> int:
+        return self.dim * 4 + sum(sys.getsizeof(v) for v in value.values())
+
+    def get(self, user_input: str) -> Tuple[Optional[dict], float]:
+        """Returns the cached result of the most similar input and its similarity."""
+        text = self.normalize(user_input)
+        if not text:
+            return None, 0.0
+        entry = self._entries.get(text)
+        if entry is not None:
+            self._entries.move_to_end(text)
+            self.hits += 1
+            return entry[1], 1.0
+
+        if self._entries:
+            similarities = self._vectors @ self._embed(text)
+            slot = int(np.argmax(similarities))
+            similarity = float(similarities[slot])
+            if similarity >= self.threshold:
+                key = self._slots[slot]
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][1], similarity
+        else:
+            similarity = 0.0
+
+        self.misses += 1
+        return None, similarity
+
+    def put(self, user_input: str, value: dict):
+        text = self.normalize(user_input)
+        if not text:
+            return
+        if text in self._entries:
+            self._evict(text)
+        if not self._free and len(self._vectors) < self.capacity:
+            self._grow()
+        size = self._size(value)
+        while self._entries and (not self._free or self._bytes + size > self.max_bytes):
+            self._evict(next(iter(self._entries)))
+
+        slot = self._free.pop()
+        self._vectors[slot] = self._embed(text)
+        self._entries[text] = (slot, value, size)
+        self._slots[slot] = text
+        self._bytes += size
+
+    def _grow(self):
+        rows = len(self._vectors)
+        grown = min(self.capacity, rows * 2)
+        self._vectors = np.concatenate([self._vectors, np.zeros((grown - rows, self.dim), dtype=np.float32)])
+        self._free.extend(range(grown - 1, rows - 1, -1))
+
+    def _evict(self, text: str):
+        slot, _, size = self._entries.pop(text)
+        del self._slots[slot]
+        self._vectors[slot] = 0.0
+        self._free.append(slot)
+        self._bytes -= size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
@@ -1,53 +1,71 @@
-from .o11y import tracer
-from .logger import logger
+import time
+import asyncio
+
+from . import metrics
+from .o11y import tracer, set_payload
+from .logger import logger, intent_logger
 from .adapter import ChatbotAdapter
-from .prompt import PROMPT, CATEGORIES, CATEGORY_UNKNOWN
+from .context import ContextManager
+from .intent import IntentModel, INTENT_LOG_MESSAGE
+from .prompt import CATEGORIES, CATEGORY_UNKNOWN
+
+_STAGE = {
+    (stage, outcome): metrics.STAGE.labels(stage, outcome)
+    for stage in ('question', 'category', 'chat')
+    for outcome in ('ok', 'error', 'cancelled')
+}
+_CLASSIFICATIONS = {
+    (classifier, local): metrics.FAST_PATH.labels(classifier, 'local' if local else 'llm')
+    for classifier in ('question', 'category')
+    for local in (True, False)
+}
 
 
 class QuestionClassifier(object):
-    def __init__(self, adapter: ChatbotAdapter) -> None:
+    def __init__(self, adapter: ChatbotAdapter, model: str = '') -> None:
         self.adapter = adapter
+        self.model = model
+        self.labels = ['question', 'statement']
 
-    def classify(self, user_input: str) -> bool:
-        prompt = PROMPT['question'].format(user_input=user_input)
-        generation = self.adapter.generate(
-            prompt=prompt,
-            temperature=0,
-            max_new_tokens=32,
-            eos_token_id=29889, # '.' token
+    async def classify(self, user_input: str) -> bool:
+        scores = await self.adapter.score(
+            model=self.model,
+            template='question',
+            variables={'user_input': user_input},
+            candidates=[f' {label}.' for label in self.labels],
         )
-        logger.info(f'classify generation: {generation}')
-        return 'question' in generation.lower()
+        label = self.labels[scores.index(max(scores))]
+        logger.info('classify scores: %s => %s', scores, label)
+        return label == 'question'
 
 
 class CategoryClassifier(object):
-    def __init__(self, adapter: ChatbotAdapter) -> None:
-        self.categories = list(
-            map(lambda x: x.replace('- ', '').lower(), CATEGORIES.split('\n'))
+    def __init__(self, adapter: ChatbotAdapter, model: str = '') -> None:
+        self.labels = list(
+            map(lambda x: x.replace('- ', ''), CATEGORIES.split('\n'))
         )
+        self.categories = list(map(lambda x: x.lower(), self.labels))
         self.adapter = adapter
+        self.model = model
 
-    def classify( self, user_input: str) -> str:
-        prompt = PROMPT['category'].format(user_input=user_input, categories=CATEGORIES)
-        generation = self.adapter.generate(
-            prompt=prompt,
-            temperature=0,
-            max_new_tokens=32,
-            eos_token_id=29889, # '.' token
-        ).lower().strip()
-
-        for cate in self.categories:
-            if cate in generation:
-                logger.info(f'found category: {generation} => {cate}')
-                return cate
-
-        logger.warning(f'!! not found category for generation: {generation}')
-        return CATEGORY_UNKNOWN
+    async def classify( self, user_input: str) -> str:
+        scores = await self.adapter.score(
+            model=self.model,
+            template='category',
+            variables={'user_input': user_input},
+            candidates=[f' {label}.' for label in self.labels],
+        )
+        label = self.labels[scores.index(max(scores))]
+        logger.info('found category: %s', label)
+        if label == CATEGORY_UNKNOWN:
+            return CATEGORY_UNKNOWN
+        return label.lower()
 
 
 class ChatGenerator(object):
-    def __init__(self, adapter: ChatbotAdapter) -> None:
+    def __init__(self, adapter: ChatbotAdapter, model: str = '') -> None:
         self.adapter = adapter
+        self.model = model
         self.ID_SYMBOL = '[|'
 
     def refine(self, generation: str):
@@ -56,10 +74,11 @@ class ChatGenerator(object):
             generation = generation[:sindex]
         return generation
 
-    def generate(self, user_input: str, context: str = ''):
-        prompt = PROMPT['chat'].format(user_input=user_input, context=context)
-        generation = self.adapter.generate(
-            prompt=prompt,
+    async def generate(self, user_input: str, context: str = ''):
+        generation = await self.adapter.generate(
+            model=self.model,
+            template='chat',
+            variables={'user_input': user_input, 'context': context},
             top_k=0,
             top_p=0.95,
             temperature=0.7,
@@ -67,25 +86,138 @@ class ChatGenerator(object):
             max_new_tokens=320,
             eos_token_id=2, # default is 2, '<\s>' token
             num_return_sequences=1,
+            stop=[self.ID_SYMBOL],
         )
         refined = self.refine(generation)
-        logger.info(f'chat generation and refined: {generation} => {refined}')
+        logger.info('chat generation and refined: %s => %s', generation, refined)
         return refined
 
 
+class Stages(object):
+    """Times the orchestration stages onto the span, tagging a failure with its stage."""
+
+    def __init__(self, span) -> None:
+        self.span = span
+        self.elapsed = {}
+
+    async def timed(self, stage: str, coro):
+        started_at = time.monotonic()
+        outcome = 'error'
+        try:
+            result = await coro
+            outcome = 'ok'
+            return result
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            raise
+        except Exception as exc:
+            if not hasattr(exc, 'stage'):
+                exc.stage = stage
+            raise
+        finally:
+            self.elapsed[stage] = time.monotonic() - started_at
+            self.span.set_attribute(f'{stage}.elapsed', self.elapsed[stage])
+            _STAGE[stage, outcome].observe(self.elapsed[stage])
+
+
 class ArchitectureWhisperer(object):
+    """Classifies the user input and generates the chat reply.
+
+    In concurrent mode the chat generation does not wait for the classifiers:
+    all three calls start at once, and the category classification is
+    cancelled as soon as the input turns out not to be a question.
+
+    With an intent model, a classification the model is confident about at
+    `intent_threshold` is answered locally and only the rest go to the LLM.
+
+    With a context manager, the conversation context is trimmed to its token
+    budget before it goes into the chat prompt.
+
+    The classifiers and the chat generation each target a model of the chat
+    service by name, its default model when empty, so the short classification
+    prompts can run on a smaller model.
+    """
+
     def __init__(self,
         chatbot_adapter: ChatbotAdapter,
+        concurrent: bool = False,
+        intent_model: IntentModel = None,
+        intent_threshold: float = 0.9,
+        context_manager: ContextManager = None,
+        classifier_model: str = '',
+        chat_model: str = '',
     ) -> None:
-        self.question_classifier = QuestionClassifier(chatbot_adapter)
-        self.category_classifier = CategoryClassifier(chatbot_adapter)
-        self.chat_generator = ChatGenerator(chatbot_adapter)
+        self.question_classifier = QuestionClassifier(chatbot_adapter, classifier_model)
+        self.category_classifier = CategoryClassifier(chatbot_adapter, classifier_model)
+        self.chat_generator = ChatGenerator(chatbot_adapter, chat_model)
+        self.concurrent = concurrent
+        self.intent_model = intent_model
+        self.intent_threshold = intent_threshold
+        self.context_manager = context_manager
+
+    def _fast_path(self, span, user_input: str, threshold: float):
+        """Returns the question and category decided locally, None where the LLM is needed."""
+        if self.intent_model is None:
+            return None, None
+        prediction = self.intent_model.predict(user_input)
+        span.set_attribute('intent.question_confidence', prediction.question_confidence)
+        span.set_attribute('intent.category_confidence', prediction.category_confidence)
+        is_question, category = None, None
+        if prediction.question_confidence >= threshold:
+            is_question = prediction.is_question
+        if prediction.category_confidence >= threshold:
+            category = prediction.category
+        span.set_attribute('question.fast_path', is_question is not None)
+        span.set_attribute('category.fast_path', category is not None)
+        _CLASSIFICATIONS['question', is_question is not None].inc()
+        _CLASSIFICATIONS['category', category is not None].inc()
+        return is_question, category
 
-    def orchestrate(self, user_input: str, context: str = ''):
+    async def _run_sequential(self, stages: Stages, user_input: str, context: str, fast_question=None, fast_category=None):
+        is_question = fast_question
+        if is_question is None:
+            is_question = await stages.timed('question', self.question_classifier.classify(user_input))
+        category = None
+        if is_question:
+            category = fast_category
+            if category is None:
+                category = await stages.timed('category', self.category_classifier.classify(user_input))
+        generation = await stages.timed('chat', self.chat_generator.generate(user_input=user_input, context=context))
+        return is_question, category, generation
+
+    async def _run_concurrent(self, stages: Stages, user_input: str, context: str, fast_question=None, fast_category=None):
+        chat_task = asyncio.create_task(
+            stages.timed('chat', self.chat_generator.generate(user_input=user_input, context=context))
+        )
+        category_task = None
+        if fast_question is not False and fast_category is None:
+            category_task = asyncio.create_task(
+                stages.timed('category', self.category_classifier.classify(user_input))
+            )
+        try:
+            is_question = fast_question
+            if is_question is None:
+                is_question = await stages.timed('question', self.question_classifier.classify(user_input))
+            category = None
+            if is_question:
+                category = fast_category if category_task is None else await category_task
+            elif category_task is not None:
+                category_task.cancel()
+                stages.span.set_attribute('category.cancelled', True)
+            generation = await chat_task
+        except BaseException:
+            chat_task.cancel()
+            if category_task is not None:
+                category_task.cancel()
+            raise
+        return is_question, category, generation
+
+    async def orchestrate(self, user_input: str, context: str = '', intent_threshold: float = None):
         kind = 'chat'
         keyword = ''
         with tracer.start_as_current_span('orchestrate') as span:
             span.set_attribute('type', 'chat')
+            span.set_attribute('concurrent', self.concurrent)
 
             if not user_input:
                 span.set_attribute('no_input', True)
@@ -94,16 +226,32 @@ class ArchitectureWhisperer(object):
                     'generation': 'You must input something.',
                 }
 
-            logger.info(f'user_input: {user_input}')
-            span.set_attribute('user_input', user_input)
+            logger.info('user_input: %s', user_input)
+            set_payload(span, 'user_input', user_input)
+
+            if context and self.context_manager is not None:
+                context, stats = self.context_manager.fit(context)
+                for name, value in stats.items():
+                    span.set_attribute(f'context.{name}', value)
 
-            is_question = self.question_classifier.classify(user_input)
-            logger.info(f'is_question: {is_question}')
+            if intent_threshold is None:
+                intent_threshold = self.intent_threshold
+            fast_question, fast_category = self._fast_path(span, user_input, intent_threshold)
+            run = self._run_concurrent if self.concurrent else self._run_sequential
+            stages = Stages(span)
+            is_question, category, generation = await run(stages, user_input, context, fast_question, fast_category)
+            if fast_question is None and (not is_question or fast_category is None):
+                # labels that came from the LLM, to train the intent model on
+                intent_logger.info(INTENT_LOG_MESSAGE, extra={
+                    'user_input': user_input,
+                    'is_question': is_question,
+                    'category': category or '',
+                })
+            logger.info('is_question: %s', is_question)
             span.set_attribute('is_question', is_question)
 
             if is_question:
-                category = self.category_classifier.classify(user_input)
-                logger.info(f'category: {category}')
+                logger.info('category: %s', category)
                 span.set_attribute('category', category)
 
                 if category != CATEGORY_UNKNOWN:
@@ -112,11 +260,11 @@ class ArchitectureWhisperer(object):
                     span.set_attribute('type', 'search')
                     span.set_attribute('keyword', keyword)
 
-            generation = self.chat_generator.generate(user_input=user_input, context=context)
-            logger.info(f'generation: {generation}')
-            span.set_attribute('chat generation', generation)
+            logger.info('generation: %s', generation)
+            set_payload(span, 'chat generation', generation)
             return {
                 'kind': kind,
                 'keyword': keyword,
-                'generation': generation
-            }
\ No newline at end of file
+                'generation': generation,
+                'timings': stages.elapsed,
+            }
@@ -0,0 +1,30 @@
+import os
+from typing import NamedTuple
+
+
+class Profile(NamedTuple):
+    sample_ratio: float
+    payloads: bool  # prompts, generations and request bodies as span attributes
+    max_attribute_length: int  # 0 keeps attributes whole
+    async_logging: bool
+    log_level: str
+
+
+PROFILES = {
+    'full': Profile(sample_ratio=1.0, payloads=True, max_attribute_length=0, async_logging=False, log_level='INFO'),
+    'lean': Profile(sample_ratio=0.1, payloads=True, max_attribute_length=1024, async_logging=True, log_level='INFO'),
+    'minimal': Profile(sample_ratio=0.01, payloads=False, max_attribute_length=256, async_logging=True, log_level='WARNING'),
+}
+
+
+def load_profile() -> Profile:
+    """Picks the profile named by TELEMETRY_PROFILE, with per-setting overrides."""
+    profile = PROFILES[os.environ.get('TELEMETRY_PROFILE', 'full')]
+    if 'TELEMETRY_SAMPLE_RATIO' in os.environ:
+        profile = profile._replace(sample_ratio=float(os.environ['TELEMETRY_SAMPLE_RATIO']))
+    if 'TELEMETRY_MAX_ATTRIBUTE_LENGTH' in os.environ:
+        profile = profile._replace(max_attribute_length=int(os.environ['TELEMETRY_MAX_ATTRIBUTE_LENGTH']))
+    return profile
+
+
+PROFILE = load_profile()
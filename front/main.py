@@ -1,28 +1,96 @@
 import os
+import math
 import traceback
 
 from fastapi import FastAPI, Request, Response
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
+from typing import Optional
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from opentelemetry import trace
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 
+from lib import metrics
 from lib.logger import logger
-from lib.adapter import ChatbotAdapter
+from lib.adapter import ChatbotAdapter, ChatbotBusy
+from lib.intent import IntentModel
+from lib.context import ContextManager
 from lib.service import ArchitectureWhisperer
-from lib.o11y import tracer, context_from_headers
+from lib.semantic_cache import SemanticCache
+from lib.o11y import tracer, context_from_headers, set_payload
 
 load_dotenv()
 CHAT_ENDPOINT = os.environ['CHAT_ENDPOINT']
+CHAT_POOL_SIZE = int(os.environ.get('CHAT_POOL_SIZE', 100))
+CHAT_POOL_KEEPALIVE = int(os.environ.get('CHAT_POOL_KEEPALIVE', 20))
+CHAT_TIMEOUT = float(os.environ.get('CHAT_TIMEOUT', 30))
+CHAT_CONNECT_TIMEOUT = float(os.environ.get('CHAT_CONNECT_TIMEOUT', 5))
+CHAT_MAX_RETRIES = int(os.environ.get('CHAT_MAX_RETRIES', 2))
+CHAT_MAX_RETRY_WAIT = float(os.environ.get('CHAT_MAX_RETRY_WAIT', 5))
+ORCHESTRATE_CONCURRENT = bool(os.environ.get('ORCHESTRATE_CONCURRENT', False))
+INTENT_MODEL_PATH = os.environ.get('INTENT_MODEL_PATH', '')
+INTENT_THRESHOLD = float(os.environ.get('INTENT_THRESHOLD', 0.9))
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.9))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get('SEMANTIC_CACHE_MAX_ENTRIES', 0))
+SEMANTIC_CACHE_MAX_BYTES = int(os.environ.get('SEMANTIC_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+CONTEXT_MAX_TOKENS = int(os.environ.get('CONTEXT_MAX_TOKENS', 1024))
+CONTEXT_DIGEST_TOKENS = int(os.environ.get('CONTEXT_DIGEST_TOKENS', 64))
+CONTEXT_TOKENIZER = os.environ.get('CONTEXT_TOKENIZER', '')
+CLASSIFIER_MODEL = os.environ.get('CLASSIFIER_MODEL', '')
+CHAT_MODEL = os.environ.get('CHAT_MODEL', '')
 logger.info(f'CHAT_ENDPOINT: {CHAT_ENDPOINT}')
-
+logger.info(f'CHAT_POOL_SIZE: {CHAT_POOL_SIZE}, CHAT_POOL_KEEPALIVE: {CHAT_POOL_KEEPALIVE}, CHAT_TIMEOUT: {CHAT_TIMEOUT}, CHAT_CONNECT_TIMEOUT: {CHAT_CONNECT_TIMEOUT}')
+logger.info(f'CHAT_MAX_RETRIES: {CHAT_MAX_RETRIES}, CHAT_MAX_RETRY_WAIT: {CHAT_MAX_RETRY_WAIT}')
+logger.info(f'ORCHESTRATE_CONCURRENT: {ORCHESTRATE_CONCURRENT}')
+logger.info(f'CLASSIFIER_MODEL: {CLASSIFIER_MODEL}, CHAT_MODEL: {CHAT_MODEL}')
+logger.info(f'INTENT_MODEL_PATH: {INTENT_MODEL_PATH}, INTENT_THRESHOLD: {INTENT_THRESHOLD}')
+logger.info(f'CONTEXT_MAX_TOKENS: {CONTEXT_MAX_TOKENS}, CONTEXT_DIGEST_TOKENS: {CONTEXT_DIGEST_TOKENS}, CONTEXT_TOKENIZER: {CONTEXT_TOKENIZER}')
+logger.info(f'SEMANTIC_CACHE_THRESHOLD: {SEMANTIC_CACHE_THRESHOLD}, SEMANTIC_CACHE_MAX_ENTRIES: {SEMANTIC_CACHE_MAX_ENTRIES}, SEMANTIC_CACHE_MAX_BYTES: {SEMANTIC_CACHE_MAX_BYTES}')
+
+chatbot_adapter = ChatbotAdapter(
+    CHAT_ENDPOINT,
+    max_connections=CHAT_POOL_SIZE,
+    max_keepalive_connections=CHAT_POOL_KEEPALIVE,
+    timeout=CHAT_TIMEOUT,
+    connect_timeout=CHAT_CONNECT_TIMEOUT,
+    max_retries=CHAT_MAX_RETRIES,
+    max_retry_wait=CHAT_MAX_RETRY_WAIT,
+)
 whisperer = ArchitectureWhisperer(
-    chatbot_adapter=ChatbotAdapter(CHAT_ENDPOINT),
+    chatbot_adapter=chatbot_adapter,
+    concurrent=ORCHESTRATE_CONCURRENT,
+    intent_model=IntentModel.load(INTENT_MODEL_PATH) if INTENT_MODEL_PATH else None,
+    intent_threshold=INTENT_THRESHOLD,
+    context_manager=ContextManager.from_env(CONTEXT_MAX_TOKENS, CONTEXT_DIGEST_TOKENS, CONTEXT_TOKENIZER) if CONTEXT_MAX_TOKENS > 0 else None,
+    classifier_model=CLASSIFIER_MODEL,
+    chat_model=CHAT_MODEL,
 )
+semantic_cache = None
+if SEMANTIC_CACHE_MAX_ENTRIES > 0:
+    semantic_cache = SemanticCache(
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+        max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+        max_bytes=SEMANTIC_CACHE_MAX_BYTES,
+    )
 
 api = FastAPI()
-FastAPIInstrumentor.instrument_app(api, excluded_urls="healthz/")
+FastAPIInstrumentor.instrument_app(api, excluded_urls="healthz/,metrics")
+
+
+def _semantic_cache_lookups():
+    if semantic_cache is not None:
+        stats = semantic_cache.stats()
+        yield ('hit',), stats['hits']
+        yield ('miss',), stats['misses']
+
+
+def _semantic_cache_bytes():
+    if semantic_cache is not None:
+        yield (), semantic_cache.stats()['bytes']
+
+
+metrics.REGISTRY.callback('counter', 'front_semantic_cache_lookups_total', 'Semantic cache lookups', _semantic_cache_lookups, ('result',))
+metrics.REGISTRY.callback('gauge', 'front_semantic_cache_bytes', 'Bytes held by the semantic cache', _semantic_cache_bytes)
 
 
 class Message(BaseModel):
@@ -32,11 +100,14 @@ class Message(BaseModel):
     prompt: str = Field(
         default='', title='prompt texts',
     )
+    intent_threshold: Optional[float] = Field(
+        default=None, title='confidence needed to classify locally instead of with the LLM',
+    )
 
 
 @api.middleware("otel")
 async def init_otel_span(request: Request, call_next):
-    if request.url.path == '/healthz/':
+    if request.url.path in ('/healthz/', '/metrics'):
         return await call_next(request)
 
     context = context_from_headers(request.headers)
@@ -57,6 +128,11 @@ async def init_otel_span(request: Request, call_next):
         return response
 
 
+@api.on_event('shutdown')
+async def shutdown_event():
+    await chatbot_adapter.aclose()
+
+
 @api.get('/healthz')
 @api.get('/healthz/')
 def healthz():
@@ -65,12 +141,17 @@ def healthz():
     }
 
 
+@api.get('/metrics')
+def metrics_endpoint():
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @api.post('/v1/chat')
 @api.post('/v1/chat/')
-def chat(message: Message):
+async def chat(message: Message):
     with tracer.start_as_current_span('chat') as span:
-        logger.info(f'user_input: {message.json()}')
-        span.set_attribute('message', message.json())
+        logger.info('user_input: %s', message)
+        set_payload(span, 'message', message.json)
 
         user_input = message.prompt.strip()
 
@@ -95,19 +176,51 @@ def chat(message: Message):
             }, headers={'X-Error': str(exc)})
 
         try:
-            response = whisperer.orchestrate(
-                user_input=user_input,
-                context=message.context.strip(),
-            )
+            context = message.context.strip()
+            # results depend on the intent threshold, so only the default one is cached
+            use_cache = semantic_cache is not None and not context and message.intent_threshold in (None, INTENT_THRESHOLD)
+            response = None
+            if use_cache:
+                response, similarity = semantic_cache.get(user_input)
+                span.set_attribute('semantic_cache.hit', response is not None)
+                span.set_attribute('semantic_cache.similarity', similarity)
+                for name, value in semantic_cache.stats().items():
+                    span.set_attribute(f'semantic_cache.{name}', value)
+
+            if response is None:
+                response = await whisperer.orchestrate(
+                    user_input=user_input,
+                    context=context,
+                    intent_threshold=message.intent_threshold,
+                )
+                if use_cache:
+                    semantic_cache.put(user_input, {
+                        'kind': response['kind'],
+                        'keyword': response['keyword'],
+                        'generation': response['generation'],
+                    })
             span.set_attribute('kind', response['kind'])
             span.set_attribute('keyword', response['keyword'])
-            span.set_attribute('generation', response['generation'])
+            set_payload(span, 'generation', response['generation'])
+            # cached results carry no timings
+            timings = response.get('timings') or {}
+            headers = {}
+            if timings:
+                headers['Server-Timing'] = ', '.join(f'{stage};dur={elapsed * 1000:.1f}' for stage, elapsed in timings.items())
             return JSONResponse(content={
                 'status': 'ok',
                 'type': response['kind'],
                 'keyword': response['keyword'],
                 'generation': response['generation'],
-            })
+            }, headers=headers)
+        except ChatbotBusy as exc:
+            span.record_exception(exc)
+            span.set_status(trace.Status(trace.StatusCode.ERROR))
+            return JSONResponse(status_code=429, content={
+                'status': 'error',
+                'type': 'chat',
+                'generation': 'Sorry, I am talking with too many people right now. Please try again in a moment.',
+            }, headers={'Retry-After': str(math.ceil(exc.retry_after)), 'X-Error': str(exc)})
         except Exception as exc:
             logger.exception(traceback.format_exc())
             span.record_exception(exc)
@@ -117,7 +230,7 @@ def chat(message: Message):
                 'status': 'error',
                 'type': 'chat',
                 'generation': 'Sorry, it might be an internal error. I am calling my supervisor to fix it.'
-            }, headers={'X-Error': str(exc)})
+            }, headers={'X-Error': str(exc), 'X-Error-Stage': getattr(exc, 'stage', '')})
 
 
 if __name__ == '__main__':
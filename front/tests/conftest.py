@@ -0,0 +1,4 @@
+import os
+
+# no collector runs next to the tests, so no span is sampled for export
+os.environ.setdefault('TELEMETRY_SAMPLE_RATIO', '0')
@@ -0,0 +1,108 @@
+import json
+import asyncio
+
+import httpx
+import pytest
+
+from lib.adapter import ChatbotAdapter, ChatbotBusy
+from lib.prompt import TEMPLATES
+
+VARIABLES = {'question': 'What is Amazon S3?'}
+
+
+class ChatServer(object):
+    """Answers like a chat server worker that has not seen any template yet."""
+
+    def __init__(self) -> None:
+        self.requests = []
+        self.busy = 0
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        self.requests.append((request.url.path, body))
+        if self.busy:
+            self.busy -= 1
+            return httpx.Response(429, headers={'Retry-After': '0'})
+        if request.url.path == '/v1/chat/batch':
+            return httpx.Response(200, json={'status': 'ok', 'results': [self._result(item) for item in body['items']]})
+        if request.url.path == '/v1/score':
+            if body.get('template') and 'template_text' not in body:
+                return httpx.Response(404, json=self._unknown(body))
+            return httpx.Response(200, json={'status': 'ok', 'scores': [
+                {'candidate': c, 'logprob': -2.0, 'tokens': 2} for c in body['candidates']
+            ]})
+        if body.get('template') and 'template_text' not in body:
+            return httpx.Response(404, json=self._unknown(body))
+        return httpx.Response(200, json={'status': 'ok', 'generation': self._generation(body)})
+
+    @staticmethod
+    def _unknown(body: dict) -> dict:
+        return {'status': 'error', 'code': 'unknown_template', 'message': f"unknown template: {body['template']}"}
+
+    @staticmethod
+    def _generation(body: dict) -> str:
+        return f"{body.get('template') or body['prompt']}!"
+
+    def _result(self, item: dict) -> dict:
+        if item.get('template') and 'template_text' not in item:
+            return self._unknown(item)
+        return {'status': 'ok', 'generation': self._generation(item)}
+
+
+@pytest.fixture
+def server():
+    return ChatServer()
+
+
+@pytest.fixture
+def adapter(server):
+    adapter = ChatbotAdapter('http://chat/v1/chat', max_retries=1)
+    adapter._client = httpx.AsyncClient(transport=httpx.MockTransport(server))
+    return adapter
+
+
+def test_generate_resends_unknown_template_with_text(adapter, server):
+    generation = asyncio.run(adapter.generate(template='question', variables=VARIABLES))
+    assert generation == 'question!'
+    assert len(server.requests) == 2
+    (_, first), (_, retry) = server.requests
+    assert 'template_text' not in first
+    assert retry['template_text'] == TEMPLATES['question'].text
+    assert retry['template_version'] == TEMPLATES['question'].version
+    assert retry['variables'] == VARIABLES
+
+
+def test_generate_without_template_is_sent_once(adapter, server):
+    assert asyncio.run(adapter.generate(prompt='hello')) == 'hello!'
+    assert len(server.requests) == 1
+
+
+def test_score_resends_unknown_template_with_text(adapter, server):
+    scores = asyncio.run(adapter.score(template='category', variables=VARIABLES, candidates=['a', 'b']))
+    assert scores == [-1.0, -1.0]
+    assert [path for path, _ in server.requests] == ['/v1/score', '/v1/score']
+    assert server.requests[1][1]['template_text'] == TEMPLATES['category'].text
+
+
+def test_generate_many_resends_only_unknown_items(adapter, server):
+    results = asyncio.run(adapter.generate_many([
+        {'prompt': 'plain'},
+        {'template': 'question', 'variables': VARIABLES},
+        {'prompt': 'another'},
+        {'template': 'chat', 'variables': VARIABLES},
+    ]))
+    assert results == ['plain!', 'question!', 'another!', 'chat!']
+    assert len(server.requests) == 2
+    retried = server.requests[1][1]['items']
+    assert [item['template'] for item in retried] == ['question', 'chat']
+    assert [item['template_text'] for item in retried] == [TEMPLATES['question'].text, TEMPLATES['chat'].text]
+
+
+def test_retries_while_busy(adapter, server):
+    server.busy = 1
+    assert asyncio.run(adapter.generate(prompt='hello')) == 'hello!'
+    assert len(server.requests) == 2
+
+    server.busy = 2
+    with pytest.raises(ChatbotBusy):
+        asyncio.run(adapter.generate(prompt='hello'))
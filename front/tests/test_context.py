@@ -0,0 +1,88 @@
+from lib.context import ContextManager
+
+TURNS = [
+    '[|Human|]: What is Amazon S3?\n',
+    '[|SA|]: Amazon S3 is an object storage service.\n',
+    '[|Human|]: 파이썬 코드를 보여줘.\n',
+    '[|SA|]: print("hello")\n',
+    '[|Human|]: And EC2?\n',
+]
+CONTEXT = ''.join(TURNS)
+
+
+def _size(text: str) -> int:
+    return len(text.encode('utf-8'))
+
+
+def test_split_turns():
+    assert ContextManager.split_turns(CONTEXT) == TURNS
+    assert ContextManager.split_turns('') == []
+
+
+def test_counts_bytes_without_tokenizer():
+    manager = ContextManager()
+    # Korean takes three bytes a character, as many tokens as a byte fallback could
+    assert manager.count('파이썬') == 9
+    assert manager.count('S3') == 2
+
+
+def test_fits_within_budget_unchanged():
+    context, stats = ContextManager(max_tokens=_size(CONTEXT)).fit(CONTEXT)
+    assert context == CONTEXT
+    assert stats == {
+        'tokens_before': _size(CONTEXT),
+        'tokens_after': _size(CONTEXT),
+        'turns': len(TURNS),
+        'kept_turns': len(TURNS),
+    }
+
+
+def test_keeps_recent_turns_and_digests_older_ones():
+    digest_tokens = 64
+    kept = ''.join(TURNS[2:])
+    manager = ContextManager(max_tokens=_size(kept) + digest_tokens, digest_tokens=digest_tokens)
+    context, stats = manager.fit(CONTEXT)
+    digest = 'Earlier, the human asked: What is Amazon S3?\n\n'
+    assert context == digest + kept
+    assert stats['kept_turns'] == 3
+    assert stats['tokens_after'] == _size(context) <= manager.max_tokens
+
+
+def test_never_starts_on_an_answer():
+    # room for the last two turns, but the first of them answers a dropped question
+    manager = ContextManager(max_tokens=_size(''.join(TURNS[3:])), digest_tokens=0)
+    context, stats = manager.fit(CONTEXT)
+    assert context == TURNS[4]
+    assert stats['kept_turns'] == 1
+
+
+def test_digest_is_bounded():
+    manager = ContextManager(max_tokens=_size(TURNS[4]) + 40, digest_tokens=40)
+    context, stats = manager.fit(CONTEXT)
+    assert context.endswith(TURNS[4])
+    assert stats['tokens_after'] <= manager.max_tokens
+
+
+class _Encoding(object):
+    def __init__(self, ids) -> None:
+        self.ids = ids
+
+
+class _WordTokenizer(object):
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def encode(self, text: str, add_special_tokens: bool = True):
+        self.calls += 1
+        return _Encoding(text.split())
+
+
+def test_memoizes_turn_counts():
+    tokenizer = _WordTokenizer()
+    manager = ContextManager(max_tokens=1024, tokenizer=tokenizer)
+    _, stats = manager.fit(CONTEXT)
+    assert stats['tokens_before'] == len(CONTEXT.split())
+    assert tokenizer.calls == len(TURNS)
+
+    manager.fit(CONTEXT + '[|SA|]: EC2 is a compute service.\n')
+    assert tokenizer.calls == len(TURNS) + 1
@@ -0,0 +1,67 @@
+from lib.semantic_cache import SemanticCache
+
+RESULT = {'intent': 'question', 'category': 'aws'}
+
+
+def test_exact_and_normalized_hits():
+    cache = SemanticCache()
+    cache.put('What is Amazon S3?', RESULT)
+    assert cache.get('What is Amazon S3?') == (RESULT, 1.0)
+    assert cache.get('  what is AMAZON s3 ') == (RESULT, 1.0)
+
+
+def test_similar_hit_and_dissimilar_miss():
+    cache = SemanticCache(threshold=0.8)
+    cache.put('What is Amazon S3 used for', RESULT)
+    value, similarity = cache.get('What is Amazon S3 used for in practice')
+    assert value == RESULT
+    assert 0.8 <= similarity < 1.0
+
+    value, similarity = cache.get('파이썬 코드를 보여줘')
+    assert value is None
+    assert similarity < 0.8
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_punctuation_only_is_not_cached():
+    cache = SemanticCache()
+    cache.put('?!', RESULT)
+    assert cache.get('?!') == (None, 0.0)
+    assert cache.stats()['entries'] == 0
+
+
+def test_evicts_least_recently_used():
+    cache = SemanticCache(max_entries=2)
+    cache.put('first question', {'n': 1})
+    cache.put('second question', {'n': 2})
+    cache.get('first question')
+    cache.put('a third one', {'n': 3})
+    assert cache.stats()['entries'] == 2
+    assert cache.get('first question')[0] == {'n': 1}
+    assert cache.get('second question')[0] != {'n': 2}
+
+
+def test_grows_past_initial_rows():
+    cache = SemanticCache(threshold=1.0, max_entries=200)
+    for i in range(100):
+        cache.put(f'question number {i}', {'n': i})
+    assert cache.stats()['entries'] == 100
+    assert all(cache.get(f'question number {i}')[0] == {'n': i} for i in range(100))
+
+
+def test_bounded_by_bytes():
+    cache = SemanticCache(dim=64, max_bytes=64 * 4 * 3)
+    for i in range(10):
+        cache.put(f'question {i}', {'text': 'answer'})
+    assert cache.stats()['entries'] < 3
+    assert cache.stats()['bytes'] <= cache.max_bytes
+    assert cache.get('question 9')[0] == {'text': 'answer'}
+
+
+def test_replacing_an_entry_keeps_one_slot():
+    cache = SemanticCache()
+    cache.put('What is S3', {'n': 1})
+    cache.put('what is s3?', {'n': 2})
+    assert cache.stats()['entries'] == 1
+    assert cache.get('What is S3')[0] == {'n': 2}